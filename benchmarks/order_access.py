@@ -0,0 +1,134 @@
+"""Order page latency of Order.can_user_access as the company and driver tables grow
+
+The previous condition compared the order with company, company_membership and
+driver_role as bare WHERE predicates, so every order page was an implicit join of
+those tables. The current condition compares the order columns with the role ids
+of the user, so the page is read from the order indexes alone and its latency
+does not depend on the number of companies or drivers.
+
+	python -m benchmarks.order_access [--scales 100 1000 5000] [--repeat 50]
+
+`total` is the count of the page, `tables` the number of tables in the query plan.
+"""
+from typing import Callable
+import argparse, datetime, statistics, tempfile, time
+
+import sqlalchemy as sa
+from sqlalchemy import orm
+
+from jhsolution import model
+
+ORDERS_PER_COMPANY = 10
+
+def legacy_can_user_access(user: model.User) -> sa.ColumnElement[bool]:
+	Order = model.Order
+	condition = sa.true() == sa.true()
+
+	if user.is_sender:
+		if user.company:
+			sub_condition = Order.sender_role_id == model.Company.sender_role_id
+			sub_condition &= model.Company.id == model.CompanyMembership.company_id
+			sub_condition &= model.CompanyMembership.member_id == user.id
+		else:
+			sub_condition = Order.sender_role_id == user.sender_role_id
+		condition &= sub_condition
+
+	if user.is_driver:
+		condition &= Order.driver_role_id == model.DriverRole.id
+		condition &= model.DriverRole.uid == user.id
+
+	return condition
+
+def seed(session: orm.Session, num_companies: int) -> None:
+	"""One owner per company and as many drivers as companies"""
+	now = datetime.datetime.now()
+
+	session.execute(sa.insert(model.SenderRole), [{"id": i} for i in range(1, 2 * num_companies + 1)])
+	session.execute(sa.insert(model.User), [
+		{"id": i, "sender_role_id": i} for i in range(1, num_companies + 1)
+	] + [
+		{"id": num_companies + i} for i in range(1, num_companies + 1)
+	])
+	session.execute(sa.insert(model.Company), [
+		{"id": i, "name": f"company{i}", "owner_id": i, "sender_role_id": num_companies + i}
+		for i in range(1, num_companies + 1)
+	])
+	session.execute(sa.insert(model.CompanyMembership), [
+		{"company_id": i, "member_id": i} for i in range(1, num_companies + 1)
+	])
+	session.execute(sa.insert(model.DriverRole), [{
+		"id": i, "uid": num_companies + i, "name": "driver", "HP": f"HP{i}",
+		"birthday": datetime.date(2000, 1, 1), "vehicle_id": f"vehicle{i}",
+		"vehicle_type": model.VehicleType.TRUCK_1T,
+	} for i in range(1, num_companies + 1)])
+
+	session.execute(sa.insert(model.Document), [{
+		"id": 1, "doc_type": model.DocumentType.PDF, "sha256": b"", "sha512": b""
+	}])
+	session.execute(sa.insert(model.Order), [{
+		"did": 1,
+		"sender_role_id": num_companies + company,
+		"driver_role_id": (company + j) % num_companies + 1,
+		"ordered_time": now - datetime.timedelta(minutes=company * ORDERS_PER_COMPANY + j),
+		"state": model.OrderStatusEnum.COMPLETED,
+	} for company in range(1, num_companies + 1) for j in range(ORDERS_PER_COMPANY)])
+	session.commit()
+
+def page_latency(
+	session: orm.Session,
+	user: model.User,
+	can_user_access: Callable[[model.User], sa.ColumnElement[bool]],
+	repeat: int,
+) -> tuple[float, int, int]:
+	"""Median latency, total count and the number of tables the plan reads"""
+	condition = model.Order.state == model.OrderStatusEnum.COMPLETED
+	condition &= can_user_access(user)
+	board = model.PageBoard(model.Order, condition, session)
+
+	stmt = board.pages_stmt(1, 10, model.Order.ordered_time, with_count=True)
+	query = stmt.compile(dialect=session.get_bind().dialect, compile_kwargs={"literal_binds": True})
+	plan = session.connection().exec_driver_sql(f"EXPLAIN QUERY PLAN {query}").all()
+	num_tables = len([row for row in plan if row[-1].startswith(("SCAN", "SEARCH"))])
+
+	timings = []
+	for _ in range(repeat):
+		start = time.perf_counter()
+		orders, count = board.pages_with_count(1, 10, model.Order.ordered_time)
+		timings.append(time.perf_counter() - start)
+	return statistics.median(timings), count, num_tables
+
+def main() -> None:
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--scales", type=int, nargs="+", default=[100, 1000, 5000])
+	parser.add_argument("--repeat", type=int, default=50)
+	args = parser.parse_args()
+
+	print(f"Median latency of the first completed order page ({ORDERS_PER_COMPANY} orders per company)")
+	print(f"{'companies':>10} {'user':>7} {'before':>10} {'after':>10} {'total':>13} {'tables':>7}")
+
+	for num_companies in args.scales:
+		with tempfile.NamedTemporaryFile(suffix=".sqlite3") as database_file:
+			engine = sa.create_engine(f"sqlite:///{database_file.name}")
+			model.Base.metadata.create_all(engine)
+
+			with orm.Session(engine) as session:
+				seed(session, num_companies)
+				member = model.User.get(session, num_companies // 2)
+				driver = model.User.get(session, num_companies + num_companies // 2)
+
+				for name, user in [("member", member), ("driver", driver)]:
+					before, before_count, before_tables = page_latency(
+						session, user, legacy_can_user_access, args.repeat
+					)
+					after, after_count, after_tables = page_latency(
+						session, user, model.Order.can_user_access, args.repeat
+					)
+					print(
+						f"{num_companies:>10} {name:>7} {before * 1000:>8.2f}ms {after * 1000:>8.2f}ms"
+						f" {before_count:>6}/{after_count:<6} {before_tables:>3}/{after_tables}"
+					)
+
+			engine.dispose()
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,81 @@
+"""Order posting throughput, one order per request versus the bulk endpoint
+
+`/orders/json` posts one order per request with its own transaction, while
+`/orders/json/bulk` validates a batch and inserts its documents and orders with
+one multi-row INSERT each in one transaction. SQLite inserts the rows of a
+RETURNING one by one, so the gap is larger on PostgreSQL.
+
+	python -m benchmarks.order_ingest [--orders 500] [--batch 100] [--rows 20]
+"""
+import argparse, asyncio, logging, structlog, tempfile, time
+
+import httpx
+
+import sqlalchemy as sa
+from sqlalchemy import orm
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from fastapi import FastAPI
+
+from jhsolution import blob, model, router
+from jhsolution.router import dependency
+
+def order_data(index: int, num_rows: int) -> dict[str, list[str] | list[list[str]]]:
+	columns = ["name", "address", "phone", "weight"]
+	return {"columns": columns, "data": [[f"{column}{index}" for column in columns]] * num_rows}
+
+async def measure(client: httpx.AsyncClient, path: str, payloads: list[object]) -> float:
+	start = time.perf_counter()
+	for payload in payloads:
+		response = await client.post(path, json=payload)
+		assert response.status_code == 200, response.text
+	return time.perf_counter() - start
+
+async def main() -> None:
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--orders", type=int, default=500)
+	parser.add_argument("--batch", type=int, default=100)
+	parser.add_argument("--rows", type=int, default=20)
+	args = parser.parse_args()
+
+	# The handlers log every posted order
+	structlog.configure(wrapper_class=structlog.make_filtering_bound_logger(logging.WARNING))
+
+	with (
+		tempfile.NamedTemporaryFile(suffix=".sqlite3") as database_file,
+		tempfile.TemporaryDirectory() as blob_directory,
+	):
+		model.engine = sa.create_engine(f"sqlite:///{database_file.name}")
+		model.async_engine = create_async_engine(f"sqlite+aiosqlite:///{database_file.name}")
+		blob.store = blob.LocalBlobStore(blob_directory)
+		model.Base.metadata.create_all(model.engine)
+
+		with orm.Session(model.engine) as session:
+			auth = model.UserAuth(password="benchmark")
+			sender = model.User.create_user(session, auth, sender_role=model.SenderRole(), commit=True)
+			token = dependency.api_access_token_signer.sign(sender.id).decode()
+
+		app = FastAPI()
+		app.include_router(router.api)
+		transport = httpx.ASGITransport(app=app)
+		headers = {"Authorization": f"Bearer {token}"}
+
+		orders = [order_data(index, args.rows) for index in range(args.orders)]
+		batches = [orders[i:i + args.batch] for i in range(0, len(orders), args.batch)]
+
+		print(f"{args.orders} orders of {args.rows} rows, {args.batch} orders per bulk request")
+		async with httpx.AsyncClient(
+			transport=transport, base_url="http://benchmark", headers=headers
+		) as client:
+			for name, path, payloads in [
+				("single", "/orders/json", orders),
+				("bulk", "/orders/json/bulk", batches),
+			]:
+				elapsed = await measure(client, path, payloads)
+				print(f"{name:<16} {elapsed:6.2f}s total, {args.orders / elapsed:8.1f} orders/s")
+
+		await model.async_engine.dispose()
+		model.engine.dispose()
+
+if __name__ == "__main__":
+	asyncio.run(main())
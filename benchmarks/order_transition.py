@@ -0,0 +1,141 @@
+"""Order allocation under contention, locking transitions versus a conditional UPDATE
+
+Every order is allocated by `--allocators` drivers at once. The previous handlers
+locked the user and the order with SELECT ... FOR UPDATE, checked the state in
+Python, inserted the action, updated the order and refreshed it. `Order.atransition`
+guards the change by the WHERE clause of one UPDATE, which on PostgreSQL also
+inserts the action, so a losing allocator costs one statement. SQLite ignores
+FOR UPDATE, so there the locking variant allocates an order more than once.
+
+	python -m benchmarks.order_transition [--orders 100] [--allocators 8]
+	python -m benchmarks.order_transition --database-url postgresql+asyncpg://...
+
+The database URL should point to a scratch database, its tables are created if missing.
+"""
+from typing import Any, Awaitable, Callable
+import argparse, asyncio, datetime, logging, structlog, tempfile, time, uuid
+
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
+
+from jhsolution import model
+
+Status, Action = model.OrderStatusEnum, model.OrderActionEnum
+Allocate = Callable[[AsyncEngine, int, int, int], Awaitable[bool]]
+
+async def allocate_locking(engine: AsyncEngine, oid: int, sender_id: int, driver_role_id: int) -> bool:
+	async with AsyncSession(engine, expire_on_commit=False) as session:
+		await model.User.aget(session, sender_id, lock=True)
+		order = await model.Order.aget(session, oid, lock=True)
+		if order.state != Status.REQUESTED or order.driver_role_id is not None:
+			return False
+
+		session.add(model.OrderAction(oid=oid, uid=sender_id, action=Action.ALLOCATE))
+		order.state = Status.ALLOCATED
+		order.driver_role_id = driver_role_id
+		await session.commit()
+		await session.refresh(order)
+		return True
+
+async def allocate_transition(
+	engine: AsyncEngine, oid: int, sender_id: int, driver_role_id: int
+) -> bool:
+	async with AsyncSession(engine, expire_on_commit=False) as session:
+		order = await model.Order.aget(session, oid)
+		if order.state != Status.REQUESTED:
+			return False
+
+		return await order.atransition(
+			session, sender_id, Action.ALLOCATE, [Status.REQUESTED], Status.ALLOCATED,
+			values={"driver_role_id": driver_role_id},
+			conditions=[model.Order.driver_role_id.is_(None)],
+		)
+
+async def seed(engine: AsyncEngine, num_orders: int, num_drivers: int) -> tuple[int, list[int], list[int]]:
+	"""Returns the sender, the driver roles and the orders"""
+	tag = uuid.uuid4().hex[:8]
+	async with AsyncSession(engine, expire_on_commit=False) as session:
+		sender = model.User(sender_role=model.SenderRole())
+		drivers = [model.DriverRole(
+			user=model.User(), name="driver", HP=f"{tag}-{i}",
+			birthday=datetime.date(2000, 1, 1), vehicle_id=f"{tag}-{i}",
+			vehicle_type=model.VehicleType.TRUCK_1T,
+		) for i in range(num_drivers)]
+		document = model.Document(doc_type=model.DocumentType.PDF, sha256=b"", sha512=b"")
+		session.add_all([sender, *drivers, document])
+		await session.flush()
+
+		oids = (await session.scalars(
+			sa.insert(model.Order).returning(model.Order.id, sort_by_parameter_order=True),
+			[{"did": document.id, "sender_role_id": sender.sender_role_id} for _ in range(num_orders)]
+		)).all()
+
+		await session.commit()
+		return sender.id, [driver.id for driver in drivers], list(oids)
+
+async def reset(engine: AsyncEngine, oids: list[int]) -> None:
+	async with engine.begin() as connection:
+		await connection.execute(sa.delete(model.OrderAction).where(model.OrderAction.oid.in_(oids)))
+		await connection.execute(
+			sa.update(model.Order).where(model.Order.id.in_(oids))
+			.values(state=Status.REQUESTED, driver_role_id=None)
+		)
+
+async def measure(
+	engine: AsyncEngine, allocate: Allocate, sender_id: int, driver_role_ids: list[int], oids: list[int]
+) -> tuple[float, int, int]:
+	"""Returns the elapsed time, the successful allocations and the executed statements"""
+	statements = 0
+	def before_cursor_execute(*args: Any) -> None:
+		nonlocal statements
+		statements += 1
+
+	sa.event.listen(engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+	try:
+		start = time.perf_counter()
+		results = await asyncio.gather(*[
+			allocate(engine, oid, sender_id, driver_role_id)
+			for oid in oids for driver_role_id in driver_role_ids
+		])
+		elapsed = time.perf_counter() - start
+	finally:
+		sa.event.remove(engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+
+	return elapsed, sum(results), statements
+
+async def main() -> None:
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--orders", type=int, default=100)
+	parser.add_argument("--allocators", type=int, default=8)
+	parser.add_argument("--database-url")
+	args = parser.parse_args()
+
+	# The transitions log every retry
+	structlog.configure(wrapper_class=structlog.make_filtering_bound_logger(logging.WARNING))
+
+	with tempfile.NamedTemporaryFile(suffix=".sqlite3") as database_file:
+		database_url = args.database_url or f"sqlite+aiosqlite:///{database_file.name}"
+		engine = create_async_engine(database_url, pool_size=args.allocators, max_overflow=0)
+		model.async_engine = engine
+		async with engine.begin() as connection:
+			await connection.run_sync(model.Base.metadata.create_all)
+
+		sender_id, driver_role_ids, oids = await seed(engine, args.orders, args.allocators)
+
+		print(f"{args.orders} orders, {args.allocators} concurrent allocators per order on {engine.dialect.name}")
+		variants: list[tuple[str, Allocate]] = [
+			("locking (before)", allocate_locking), ("conditional UPDATE", allocate_transition)
+		]
+		for name, allocate in variants:
+			await reset(engine, oids)
+			elapsed, allocated, statements = await measure(engine, allocate, sender_id, driver_role_ids, oids)
+			attempts = len(oids) * len(driver_role_ids)
+			print(
+				f"{name:<20} {elapsed:6.2f}s total, {attempts / elapsed:8.1f} attempts/s, "
+				f"{statements / attempts:5.2f} statements per attempt, {allocated} allocations"
+			)
+
+		await engine.dispose()
+
+if __name__ == "__main__":
+	asyncio.run(main())
@@ -0,0 +1,85 @@
+"""Request concurrency under a slow query, sync Session versus AsyncSession
+
+Every request runs a query which takes `--query-time` seconds on the database.
+The sync handler blocks the event loop (the previous `orm.Session` path), so the
+requests are served one by one, while the async handler yields the event loop
+while it is waiting the database and the requests are served concurrently.
+
+	python -m benchmarks.session_concurrency [--requests 20] [--query-time 0.2]
+"""
+from typing import Any
+import argparse, asyncio, tempfile, time
+
+import httpx
+
+import sqlalchemy as sa
+from sqlalchemy import orm
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from fastapi import FastAPI
+
+def slow_query_engines(path: str, pool_size: int) -> tuple[sa.Engine, Any]:
+	def sleep(seconds: float) -> float:
+		time.sleep(seconds)
+		return seconds
+
+	def register_sleep(dbapi_connection: Any, connection_record: Any) -> None:
+		dbapi_connection.create_function("sleep", 1, sleep)
+
+	engine = sa.create_engine(f"sqlite:///{path}", pool_size=pool_size)
+	async_engine = create_async_engine(f"sqlite+aiosqlite:///{path}", pool_size=pool_size)
+
+	sa.event.listen(engine, "connect", register_sleep)
+	sa.event.listen(async_engine.sync_engine, "connect", register_sleep)
+	return engine, async_engine
+
+def application(engine: sa.Engine, async_engine: Any, query_time: float) -> FastAPI:
+	app = FastAPI()
+	stmt = sa.select(sa.func.sleep(query_time))
+
+	@app.get("/sync")
+	async def sync_handler() -> float:
+		with orm.Session(engine) as session:
+			return session.scalars(stmt).one()
+
+	@app.get("/async")
+	async def async_handler() -> float:
+		async with AsyncSession(async_engine) as session:
+			return (await session.scalars(stmt)).one()
+
+	return app
+
+async def measure(app: FastAPI, path: str, num_requests: int) -> float:
+	transport = httpx.ASGITransport(app=app)
+	async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+		await client.get(path) # warm up the connection pool
+
+		start = time.perf_counter()
+		responses = await asyncio.gather(*[client.get(path) for _ in range(num_requests)])
+		elapsed = time.perf_counter() - start
+
+	assert all(response.status_code == 200 for response in responses)
+	return elapsed
+
+async def main() -> None:
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--requests", type=int, default=20)
+	parser.add_argument("--query-time", type=float, default=0.2)
+	args = parser.parse_args()
+
+	with tempfile.NamedTemporaryFile(suffix=".sqlite3") as database_file:
+		engine, async_engine = slow_query_engines(
+			database_file.name, args.requests
+		)
+		app = application(engine, async_engine, args.query_time)
+
+		print(f"{args.requests} concurrent requests, {args.query_time}s query per request")
+		for name, path in [("orm.Session (before)", "/sync"), ("AsyncSession (after)", "/async")]:
+			elapsed = await measure(app, path, args.requests)
+			print(f"{name:<24} {elapsed:6.2f}s total, {args.requests / elapsed:6.1f} req/s")
+
+		await async_engine.dispose()
+		engine.dispose()
+
+if __name__ == "__main__":
+	asyncio.run(main())
@@ -1,20 +1,32 @@
 from typing import Generator, List
-import pytest, alembic, pytest_alembic
+import pytest, alembic, pytest_alembic, tempfile
 
 from jhsolution import env
 
 import sqlalchemy as sa
 from sqlalchemy import orm
+from sqlalchemy.ext.asyncio import create_async_engine
 
-from jhsolution import model
+from jhsolution import blob, model
 
-model.engine = sa.create_engine("sqlite://",
+# Sync and async engines should see the same database, so in-memory database cannot be used
+database_file = tempfile.NamedTemporaryFile(suffix=".sqlite3")
+
+model.engine = sa.create_engine(f"sqlite:///{database_file.name}",
 	connect_args={"check_same_thread": False},
 	poolclass=sa.pool.StaticPool
 )
 
+# Each TestClient request runs on its own event loop, so connections are not pooled
+model.async_engine = create_async_engine(f"sqlite+aiosqlite:///{database_file.name}",
+	poolclass=sa.pool.NullPool
+)
+
 model.Base.metadata.create_all(model.engine)
 
+blob_directory = tempfile.TemporaryDirectory()
+blob.store = blob.LocalBlobStore(blob_directory.name)
+
 @pytest.fixture
 def alembic_engine() -> sa.Engine:
 	# Override this fixture to configure the exact alembic context setup required
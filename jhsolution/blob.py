@@ -0,0 +1,363 @@
+"""Content addressed store of the document blobs
+
+Blobs are keyed by their sha256 digest, so the same content is stored only once
+no matter how many documents refer to it.
+
+	python -m jhsolution.blob export [--batch-size 100]
+	python -m jhsolution.blob import [--batch-size 100]
+	python -m jhsolution.blob index [--batch-size 100]
+	python -m jhsolution.blob compress [--batch-size 100]
+	python -m jhsolution.blob gc [--grace-hours 24]
+
+`export` moves the contents still stored in the document table to the store,
+`import` moves them back before downgrading the schema. `index` builds the row
+indexes of the JSON documents posted before the indexes were built at ingest.
+`compress` compresses the blobs stored before the documents were compressed at ingest.
+`gc` deletes the blobs no document refers to anymore, like the raw blobs left by `compress`.
+"""
+from typing import Any, IO, Iterable, Iterator, Optional
+from pathlib import Path
+from urllib.parse import urlsplit
+import abc, argparse, base64, datetime, hashlib, io, lzma, os, shutil, structlog, tempfile, zlib
+
+from jhsolution import env
+
+logger = structlog.get_logger("JHsolution")
+
+class BlobStore(abc.ABC):
+	@abc.abstractmethod
+	def exists(self, key: bytes) -> bool: ...
+
+	@abc.abstractmethod
+	def get(self, key: bytes) -> bytes: ...
+
+	@abc.abstractmethod
+	def size(self, key: bytes) -> int: ...
+
+	@abc.abstractmethod
+	def iter_range(self, key: bytes, start: int, stop: int, chunk_size: int) -> Iterator[bytes]:
+		"""Chunks of the bytes [start, stop) of the blob, read one at a time"""
+
+	@abc.abstractmethod
+	def write_file(self, key: bytes, file: IO[bytes]) -> None: ...
+
+	@abc.abstractmethod
+	def delete(self, key: bytes) -> None: ...
+
+	@abc.abstractmethod
+	def touch(self, key: bytes) -> None:
+		"""Update the modified time of the blob, so the garbage collection leaves it for a while"""
+
+	@abc.abstractmethod
+	def modified(self, key: bytes) -> Optional[datetime.datetime]:
+		"""The last time the blob was written or touched, None if it is not stored"""
+
+	@abc.abstractmethod
+	def iter_keys(self) -> Iterator[tuple[bytes, datetime.datetime]]:
+		"""Keys of all the blobs and the last times they were written or touched"""
+
+	def put(self, data: bytes, key: Optional[bytes] = None) -> bytes:
+		"""Store the data unless the same content is already stored, and return its key"""
+		if key is None: key = hashlib.sha256(data).digest()
+		self.put_file(io.BytesIO(data), key)
+		return key
+
+	def put_file(self, file: IO[bytes], key: bytes) -> None:
+		"""Same as put, but copies from the file so the content is never held in memory"""
+		# A blob shared by a new document may have no committed document yet
+		if self.exists(key): self.touch(key)
+		else: self.write_file(key, file)
+
+	def spool(self) -> IO[bytes]:
+		"""Temporary file for a content whose key is known only after it is written"""
+		return tempfile.TemporaryFile()
+
+	def commit_spool(self, file: IO[bytes], key: bytes) -> None:
+		file.seek(0)
+		self.put_file(file, key)
+
+class LocalBlobStore(BlobStore):
+	"""Blobs are files named by the hex digest under two levels of shard directories"""
+
+	def __init__(self, root: os.PathLike[str] | str):
+		self.root = Path(root)
+
+	def path(self, key: bytes) -> Path:
+		name = key.hex()
+		return self.root / name[:2] / name[2:4] / name
+
+	def exists(self, key: bytes) -> bool:
+		return self.path(key).exists()
+
+	def get(self, key: bytes) -> bytes:
+		return self.path(key).read_bytes()
+
+	def size(self, key: bytes) -> int:
+		return self.path(key).stat().st_size
+
+	def iter_range(self, key: bytes, start: int, stop: int, chunk_size: int) -> Iterator[bytes]:
+		with self.path(key).open("rb") as blob_file:
+			blob_file.seek(start)
+			while start < stop:
+				chunk = blob_file.read(min(chunk_size, stop - start))
+				if not chunk: break
+				start += len(chunk)
+				yield chunk
+
+	def write_file(self, key: bytes, file: IO[bytes]) -> None:
+		path = self.path(key)
+		path.parent.mkdir(parents=True, exist_ok=True)
+
+		# Readers never see a partial blob, and concurrent writers of the same blob write the same bytes
+		fd, temp_name = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+		try:
+			with os.fdopen(fd, "wb") as temp_file:
+				shutil.copyfileobj(file, temp_file)
+				temp_file.flush()
+				os.fsync(temp_file.fileno())
+			os.replace(temp_name, path)
+		except BaseException:
+			os.unlink(temp_name)
+			raise
+
+	def delete(self, key: bytes) -> None:
+		self.path(key).unlink(missing_ok=True)
+
+	def touch(self, key: bytes) -> None:
+		os.utime(self.path(key))
+
+	def modified(self, key: bytes) -> Optional[datetime.datetime]:
+		try:
+			mtime = self.path(key).stat().st_mtime
+		except FileNotFoundError:
+			return None
+		return datetime.datetime.fromtimestamp(mtime, datetime.timezone.utc)
+
+	def iter_keys(self) -> Iterator[tuple[bytes, datetime.datetime]]:
+		for path in self.root.glob("??/??/*"):
+			if path.name.startswith(".tmp-"): continue
+			mtime = path.stat().st_mtime
+			yield bytes.fromhex(path.name), datetime.datetime.fromtimestamp(mtime, datetime.timezone.utc)
+
+	def spool(self) -> IO[bytes]:
+		# Spooled in the store, so committing is a link instead of a copy
+		self.root.mkdir(parents=True, exist_ok=True)
+		return tempfile.NamedTemporaryFile(dir=self.root, prefix=".tmp-")
+
+	def commit_spool(self, file: IO[bytes], key: bytes) -> None:
+		file.flush()
+		os.fsync(file.fileno())
+		path = self.path(key)
+		path.parent.mkdir(parents=True, exist_ok=True)
+		try:
+			os.link(file.name, path)
+		except FileExistsError:
+			self.touch(key)
+
+class S3BlobStore(BlobStore):
+	"""Blobs are objects of an S3 compatible bucket, `client` is a boto3 S3 client"""
+
+	def __init__(self, client: Any, bucket: str, prefix: str = ""):
+		self.client = client
+		self.bucket = bucket
+		self.prefix = prefix
+
+	def object_key(self, key: bytes) -> str:
+		name = key.hex()
+		return f"{self.prefix}{name[:2]}/{name}"
+
+	def exists(self, key: bytes) -> bool:
+		object_key = self.object_key(key)
+		response = self.client.list_objects_v2(Bucket=self.bucket, Prefix=object_key, MaxKeys=1)
+		return any(item["Key"] == object_key for item in response.get("Contents", []))
+
+	def get(self, key: bytes) -> bytes:
+		response = self.client.get_object(Bucket=self.bucket, Key=self.object_key(key))
+		data: bytes = response["Body"].read()
+		return data
+
+	def size(self, key: bytes) -> int:
+		response = self.client.head_object(Bucket=self.bucket, Key=self.object_key(key))
+		size: int = response["ContentLength"]
+		return size
+
+	def iter_range(self, key: bytes, start: int, stop: int, chunk_size: int) -> Iterator[bytes]:
+		if start >= stop: return
+		response = self.client.get_object(
+			Bucket=self.bucket, Key=self.object_key(key), Range=f"bytes={start}-{stop - 1}"
+		)
+		body = response["Body"]
+		try:
+			while chunk := body.read(chunk_size):
+				yield chunk
+		finally:
+			body.close()
+
+	def write_file(self, key: bytes, file: IO[bytes]) -> None:
+		# The server rejects the upload if the content does not match the key
+		self.client.put_object(
+			Bucket=self.bucket, Key=self.object_key(key), Body=file,
+			ChecksumSHA256=base64.b64encode(key).decode()
+		)
+
+	def delete(self, key: bytes) -> None:
+		self.client.delete_object(Bucket=self.bucket, Key=self.object_key(key))
+
+	def touch(self, key: bytes) -> None:
+		# Copying an object onto itself updates its LastModified on the server side
+		object_key = self.object_key(key)
+		self.client.copy_object(
+			Bucket=self.bucket, Key=object_key,
+			CopySource={"Bucket": self.bucket, "Key": object_key}, MetadataDirective="REPLACE"
+		)
+
+	def modified(self, key: bytes) -> Optional[datetime.datetime]:
+		object_key = self.object_key(key)
+		response = self.client.list_objects_v2(Bucket=self.bucket, Prefix=object_key, MaxKeys=1)
+		for item in response.get("Contents", []):
+			if item["Key"] == object_key:
+				modified: datetime.datetime = item["LastModified"]
+				return modified
+		return None
+
+	def iter_keys(self) -> Iterator[tuple[bytes, datetime.datetime]]:
+		paginator = self.client.get_paginator("list_objects_v2")
+		for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+			for item in page.get("Contents", []):
+				yield bytes.fromhex(item["Key"].rsplit("/", 1)[-1]), item["LastModified"]
+
+# Compressed blobs are keyed by the sha256 of the compressed bytes like any other blob
+
+def compressor(codec: str) -> Any:
+	if codec == "zlib": return zlib.compressobj(6)
+	if codec == "lzma": return lzma.LZMACompressor(preset=6)
+	raise ValueError(f"Unknown codec {codec}")
+
+def decompress(chunks: Iterable[bytes], codec: str) -> Iterator[bytes]:
+	decompressor: Any
+	if codec == "zlib": decompressor = zlib.decompressobj()
+	elif codec == "lzma": decompressor = lzma.LZMADecompressor()
+	else: raise ValueError(f"Unknown codec {codec}")
+
+	for chunk in chunks:
+		if data := decompressor.decompress(chunk): yield data
+	if codec == "zlib" and (data := decompressor.flush()): yield data
+
+def slice_chunks(chunks: Iterable[bytes], start: int, stop: int) -> Iterator[bytes]:
+	"""Chunks of the bytes [start, stop) of the stream of the chunks"""
+	pos = 0
+	for chunk in chunks:
+		end = pos + len(chunk)
+		if end > start and pos < stop: yield chunk[max(start - pos, 0):stop - pos]
+		if end >= stop: return
+		pos = end
+
+class Ingest:
+	"""Hashes the chunks in one pass while spooling them, then stores them by the sha256
+
+	hashlib releases the GIL on large chunks, so the writes can run on a worker thread.
+	"""
+
+	def __init__(self, store: BlobStore):
+		self.store = store
+		self.file = store.spool()
+		self.sha256 = hashlib.sha256()
+		self.sha512 = hashlib.sha512()
+		self.size = 0
+
+	def __enter__(self) -> "Ingest":
+		return self
+
+	def __exit__(self, *args: Any) -> None:
+		self.file.close()
+
+	def write(self, chunk: bytes) -> None:
+		self.file.write(chunk)
+		self.sha256.update(chunk)
+		self.sha512.update(chunk)
+		self.size += len(chunk)
+
+	def write_all(self, chunks: Iterable[bytes]) -> None:
+		for chunk in chunks: self.write(chunk)
+
+	def commit(self) -> bytes:
+		key = self.sha256.digest()
+		self.store.commit_spool(self.file, key)
+		return key
+
+	def commit_compressed(self, codec: str, max_ratio: float) -> Optional[tuple[bytes, int]]:
+		"""Store the content compressed unless it is larger than max_ratio of the content
+
+		Returns the key and the size of the compressed blob, or None if nothing is stored.
+		"""
+		compressor_ = compressor(codec)
+		sha256 = hashlib.sha256()
+		size = 0
+
+		with self.store.spool() as compressed:
+			self.file.seek(0)
+			while True:
+				chunk = self.file.read(1 << 20)
+				data = compressor_.compress(chunk) if chunk else compressor_.flush()
+				compressed.write(data)
+				sha256.update(data)
+				size += len(data)
+				# Incompressible contents, like most of the images, are given up early
+				if size > self.size * max_ratio: return None
+				if not chunk: break
+
+			key = sha256.digest()
+			self.store.commit_spool(compressed, key)
+
+		return key, size
+
+def open_store(url: str) -> BlobStore:
+	"""`s3://bucket/prefix/` for an S3 compatible bucket, otherwise a local directory"""
+	parts = urlsplit(url)
+	if parts.scheme != "s3":
+		return LocalBlobStore(parts.path if parts.scheme == "file" else url)
+
+	try:
+		import boto3
+	except ImportError:
+		raise RuntimeError("boto3 is required for the s3 blob store")
+
+	client = boto3.client("s3", endpoint_url=env.BLOB_S3_ENDPOINT_URL)
+	return S3BlobStore(client, parts.netloc, parts.path.lstrip("/"))
+
+store = open_store(env.BLOB_STORE_URL)
+
+################################################################################
+# Maintaining the contents of the document table
+################################################################################
+
+def main() -> None:
+	from sqlalchemy import orm
+	from jhsolution import model
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("command", choices=["export", "import", "index", "compress", "gc"])
+	parser.add_argument("--batch-size", type=int, default=100)
+	parser.add_argument("--grace-hours", type=float, default=24)
+	args = parser.parse_args()
+
+	with orm.Session(model.engine) as session:
+		if args.command == "export":
+			count = model.Document.export_contents(session, args.batch_size)
+		elif args.command == "import":
+			count = model.Document.import_contents(session, args.batch_size)
+		elif args.command == "index":
+			count = model.Document.index_rows(session, args.batch_size)
+		elif args.command == "gc":
+			now = datetime.datetime.now(datetime.timezone.utc)
+			grace = datetime.timedelta(hours=args.grace_hours)
+			count = model.Document.collect_garbage(session, now, grace, args.batch_size)
+			logger.info(f"{count} blobs have been deleted", command=args.command)
+			return
+		else:
+			count, saved = model.Document.compress_contents(session, args.batch_size)
+			logger.info(f"{saved} bytes have been saved", command=args.command)
+	logger.info(f"{count} documents have been processed", command=args.command)
+
+if __name__ == "__main__":
+	main()
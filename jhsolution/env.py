@@ -4,6 +4,22 @@ dotenv.load_dotenv()
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite://")
 TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
 assert DATABASE_URL != TEST_DATABASE_URL
+DATABASE_REPLICA_URLS = [url for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url]
+DATABASE_REPLICA_LAG_TOLERANCE = float(os.getenv("DATABASE_REPLICA_LAG_TOLERANCE", "5")) # seconds
+
+BLOB_STORE_URL = os.getenv("BLOB_STORE_URL", "blobs") # local directory or s3://bucket/prefix/
+BLOB_S3_ENDPOINT_URL = os.getenv("BLOB_S3_ENDPOINT_URL") # S3 compatible storage other than AWS
+
+PDF_MERGE_WORKERS = int(os.getenv("PDF_MERGE_WORKERS", "2"))
+PDF_MERGE_MAX_PENDING = int(os.getenv("PDF_MERGE_MAX_PENDING", "8")) # merges running or waiting
+PDF_OPTIMIZE = os.getenv("PDF_OPTIMIZE", "yes") == "yes"
+
+ORDER_SWEEP_INTERVAL = float(os.getenv("ORDER_SWEEP_INTERVAL", "0")) # seconds, 0 disables the sweeper failing the orders
+JOB_CONCURRENCY = int(os.getenv("JOB_CONCURRENCY", "16")) # jobs run by each web process, 0 leaves them to `python -m jhsolution.worker`
+SIGN_CONCURRENCY = int(os.getenv("SIGN_CONCURRENCY", "8")) # calls to each vender made by a process at once
+SIGN_BREAKER_THRESHOLD = int(os.getenv("SIGN_BREAKER_THRESHOLD", "5")) # failed or slow calls in a row opening the circuit
+SIGN_BREAKER_TIMEOUT = float(os.getenv("SIGN_BREAKER_TIMEOUT", "30")) # seconds failing fast until the next probe
+SIGN_SLOW_CALL = float(os.getenv("SIGN_SLOW_CALL", "5")) # seconds of a barocert call counted as failed
 
 OPEN_TELEMETRY_URL = os.getenv("OPEN_TELEMETRY_URL", "localhost:4317")
 
@@ -1,5 +1,5 @@
-from typing import Any, Awaitable, Callable, Optional, Union
-import enum, time
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional, Union
+import asyncio, contextlib, enum, time
 
 from opentelemetry.sdk.resources import SERVICE_NAME as OTEL_SERVICE_NAME
 from opentelemetry.sdk.resources import Resource as OtelResource
@@ -37,8 +37,9 @@ from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.exception_handlers import http_exception_handler
 
-from jhsolution import env, model
+from jhsolution import env, model, pdf
 from jhsolution.router import api, admin, site, misc, car365_api_test
+from jhsolution.router import background
 
 ################################################################################
 # Config open telemetry exporter
@@ -195,7 +196,20 @@ for logger_name in ["uvicorn", "uvicorn.access", "uvicorn.error"]:
 # Config app
 ################################################################################
 
-app = FastAPI()
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+	# Every worker sweeps and runs jobs, and they skip the rows locked by each other
+	tasks = []
+	if env.ORDER_SWEEP_INTERVAL > 0:
+		tasks.append(asyncio.create_task(background.sweep_failable_orders(env.ORDER_SWEEP_INTERVAL)))
+	if env.JOB_CONCURRENCY > 0:
+		tasks.append(asyncio.create_task(background.run_jobs(env.JOB_CONCURRENCY)))
+	yield
+	for task in tasks: task.cancel()
+	await asyncio.gather(*tasks, return_exceptions=True)
+	pdf.merger.shutdown()
+
+app = FastAPI(lifespan=lifespan)
 
 # Middlewares
 
@@ -227,10 +241,8 @@ async def logging_middleware(
 
 	response: Optional[Response]
 	try:
-		with orm.Session(model.engine) as database_session:
-			request.scope["database_session"] = database_session
-			start_time = time.perf_counter_ns()
-			response = await call_next(request)
+		start_time = time.perf_counter_ns()
+		response = await call_next(request)
 	except Exception as e:
 		response, exception = None, e
 
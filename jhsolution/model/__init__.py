@@ -1,19 +1,115 @@
 from __future__ import annotations
-from typing import Any, Generic, Optional, Type, TypeVar, Union
-import enum, datetime
+from typing import Any, Generic, Optional, Sequence, Type, TypeAlias, TypeVar, Union
+import enum, datetime, base64, itertools, json, time
 
 import sqlalchemy as sa
 from sqlalchemy import orm
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
+from sqlalchemy.orm.strategy_options import _AbstractLoad
 
 from jhsolution import env
 url = env.DATABASE_URL
 
+# Async drivers used for each backend of the DATABASE_URL
+ASYNC_DRIVERS = {
+	"postgresql": "postgresql+asyncpg",
+	"sqlite": "sqlite+aiosqlite",
+}
+
+def to_async_url(url: Union[str, sa.URL]) -> sa.URL:
+	url = sa.make_url(url)
+	return url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()])
+
 engine = sa.create_engine(url, echo=env.DATABASE_ECHO)
+async_engine = create_async_engine(to_async_url(url), echo=env.DATABASE_ECHO)
 CLS = TypeVar("CLS", bound="Base")
+LoaderOption: TypeAlias = _AbstractLoad
+
+################################################################################
+# Read replicas
+################################################################################
+
+class ReplicaSet:
+	"""Round robin over the replica engines, skipping the ones which failed recently
+
+	A user who wrote within `lag_tolerance` seconds reads from the primary until the
+	replicas are likely to have caught up, see `User.last_write_time`.
+	"""
+
+	def __init__(self,
+		engines: Sequence[AsyncEngine],
+		lag_tolerance: float = env.DATABASE_REPLICA_LAG_TOLERANCE,
+		retry_after: float = 30.0,
+	):
+		self.engines = list(engines)
+		self.lag_tolerance = lag_tolerance
+		self.retry_after = retry_after
+		self.failed_until: dict[AsyncEngine, float] = {}
+		self.counter = itertools.count()
+
+	def candidates(self) -> list[AsyncEngine]:
+		if not self.engines: return []
+		start = next(self.counter) % len(self.engines)
+		rotation = self.engines[start:] + self.engines[:start]
+		now = time.monotonic()
+		return [engine for engine in rotation if self.failed_until.get(engine, 0) <= now]
+
+	def mark_failed(self, engine: AsyncEngine) -> None:
+		self.failed_until[engine] = time.monotonic() + self.retry_after
+
+replicas = ReplicaSet([
+	create_async_engine(to_async_url(url), echo=env.DATABASE_ECHO)
+	for url in env.DATABASE_REPLICA_URLS
+])
+
+class RoutingSession(orm.Session):
+	"""Sends reads to `info["replica"]` when it is set, and everything else to the primary
+
+	`info["uid"]` is the user whose writes are recorded in `User.last_write_time`.
+	"""
+
+	def get_bind(self,
+		mapper: Optional[Any] = None,
+		clause: Optional[Any] = None,
+		bind: Optional[Any] = None,
+		**kwargs: Any,
+	) -> Any:
+		replica = self.info.get("replica")
+		if bind is None and replica is not None and not self._flushing:
+			is_select = isinstance(clause, sa.Select) and clause._for_update_arg is None
+			if is_select: return replica
+		return super().get_bind(mapper, clause=clause, bind=bind, **kwargs)
+
+@sa.event.listens_for(RoutingSession, "after_flush")
+def mark_written(session: orm.Session, flush_context: Any) -> None:
+	session.info["written"] = True
+
+@sa.event.listens_for(RoutingSession, "do_orm_execute")
+def mark_bulk_written(orm_execute_state: orm.ORMExecuteState) -> None:
+	# INSERT, UPDATE and DELETE statements executed directly do not flush
+	if not orm_execute_state.is_select:
+		orm_execute_state.session.info["written"] = True
+
+@sa.event.listens_for(RoutingSession, "after_rollback")
+def clear_written(session: orm.Session) -> None:
+	session.info.pop("written", None)
 
 class Base(orm.DeclarativeBase):
 	id: orm.Mapped[int] = orm.mapped_column(primary_key=True)
 
+	@classmethod
+	def loader_options(cls) -> Sequence[LoaderOption]:
+		"""Relationships loaded by the async getters, lazy loading is not allowed on AsyncSession"""
+		return ()
+
+	@classmethod
+	def select_by_id(
+		cls: Type[CLS], id: int, lock: bool = False, options: Sequence[LoaderOption] = ()
+	) -> sa.Select[Any]:
+		stmt = sa.select(cls).where(cls.id == id).options(*options)
+		if lock: stmt = stmt.with_for_update()
+		return stmt
+
 	@classmethod
 	def get(
 		cls: Type[CLS],
@@ -31,9 +127,31 @@ class Base(orm.DeclarativeBase):
 	def get_or_none(
 		cls: Type[CLS], session: orm.Session, id: int, lock: bool = False
 	) -> Optional[CLS]:
-		stmt = sa.select(cls).where(cls.id == id)
-		if lock: stmt = stmt.with_for_update()
-		return session.scalars(stmt).one_or_none()
+		stmt = cls.select_by_id(id, lock)
+		ret: Optional[CLS] = session.scalars(stmt).one_or_none()
+		return ret
+
+	@classmethod
+	async def aget(
+		cls: Type[CLS],
+		session: AsyncSession,
+		id: int,
+		*args: Any,
+		exception: Exception = sa.exc.NoResultFound(),
+		**kwargs: Any
+	) -> CLS:
+		if ret := await cls.aget_or_none(session, id, *args, **kwargs):
+			return ret
+		raise exception
+
+	@classmethod
+	async def aget_or_none(
+		cls: Type[CLS], session: AsyncSession, id: int, lock: bool = False,
+		options: Optional[Sequence[LoaderOption]] = None,
+	) -> Optional[CLS]:
+		stmt = cls.select_by_id(id, lock, cls.loader_options() if options is None else options)
+		ret: Optional[CLS] = (await session.scalars(stmt)).one_or_none()
+		return ret
 
 	def to_dict(self) -> dict[str, Any]:
 		ret: dict[str, Any] = {}
@@ -47,38 +165,225 @@ class Base(orm.DeclarativeBase):
 					ret[column.name] = column_value
 		return ret
 
+class CursorPage(Generic[CLS]):
+	def __init__(self, rows: list[CLS], next_cursor: Optional[str], prev_cursor: Optional[str]):
+		self.rows = rows
+		self.next_cursor = next_cursor
+		self.prev_cursor = prev_cursor
+
 class PageBoard(Generic[CLS]):
+	"""Offset pages (`apages`) or keyset pages (`acursor_pages`) of the rows matching `condition`
+
+	A cursor is an opaque string encoding the (sort key, id) of the row at the edge of the
+	page and the direction to read. Reading a keyset page costs the same at any depth,
+	so offset pages are kept only as a fallback for page-number navigation.
+	"""
+
 	def __init__(self,
 		Table: Type[CLS],
 		condition: sa.ColumnExpressionArgument[bool],
-		session: orm.Session
+		session: AsyncSession
 	):
 		self.Table = Table
 		self.condition = condition
 		self.session = session
 
-	@property
-	def count(self) -> int:
-		stmt = sa.select(sa.func.count()).select_from(self.Table).where(self.condition)
-		return self.session.scalars(stmt).one()
+	# Statements
 
-	def pages(
+	def count_stmt(self) -> sa.Select[Any]:
+		return sa.select(sa.func.count()).select_from(self.Table).where(self.condition)
+
+	def estimated_count_sql(self) -> Optional[str]:
+		"""EXPLAIN of the rows on PostgreSQL, whose planner estimate stands in for the count"""
+		dialect = self.session.get_bind().dialect
+		if dialect.name != "postgresql": return None
+
+		stmt = sa.select(self.Table.id).where(self.condition)
+		query = stmt.compile(dialect=dialect, compile_kwargs={"literal_binds": True})
+		return f"EXPLAIN (FORMAT JSON) {query}"
+
+	@staticmethod
+	def plan_rows(plan: Any) -> int:
+		if isinstance(plan, str): plan = json.loads(plan)
+		return int(plan[0]["Plan"]["Plan Rows"])
+
+	def rows_stmt(
 		self,
-		index: int,
-		size: int,
 		sort_key: sa.ColumnExpressionArgument[Any],
-		desc: bool = True
-	) -> list[CLS]:
+		desc: bool = True,
+		options: Sequence[LoaderOption] = (),
+	) -> sa.Select[Any]:
 		order_func = sa.desc if desc else sa.asc
 		stmt = sa.select(self.Table).where(self.condition)
-		stmt = stmt.offset((index-1) * size).limit(size)
 		stmt = stmt.order_by(order_func(sort_key))
-		rows = self.session.execute(stmt).all()
-		return [row._t[0] for row in rows]
+		return stmt.options(*options)
+
+	def pages_stmt(
+		self,
+		index: int,
+		size: int,
+		sort_key: sa.ColumnExpressionArgument[Any],
+		desc: bool = True,
+		options: Sequence[LoaderOption] = (),
+		with_count: bool = False,
+		lookahead: bool = False,
+	) -> sa.Select[Any]:
+		"""With `lookahead` the first row of the next page is read too, if there is one"""
+		stmt = self.rows_stmt(sort_key, desc, options)
+		stmt = stmt.offset((index-1) * size).limit(size + lookahead)
+
+		# The window is evaluated before LIMIT, so each row carries the total count
+		if with_count: stmt = stmt.add_columns(sa.func.count().over())
+		return stmt
+
+	def split_count(self, rows: Sequence[Any]) -> tuple[list[CLS], Optional[int]]:
+		"""Rows and the total of a `with_count` page, the total is unknown on an empty page"""
+		if not rows: return [], None
+		return [row[0] for row in rows], rows[0][1]
+
+	def cursor_stmt(
+		self,
+		size: int,
+		sort_key: orm.InstrumentedAttribute[Any],
+		cursor: Optional[str] = None,
+		desc: bool = True,
+		options: Sequence[LoaderOption] = (),
+	) -> sa.Select[Any]:
+		stmt = sa.select(self.Table).where(self.condition)
+		keys = sa.tuple_(sort_key, self.Table.id)
+
+		# Reading backward scans in the opposite order and reverses the rows later
+		descending = desc
+		if cursor is not None:
+			value, id, backward = self.decode_cursor(cursor)
+			descending = desc != backward
+			edge = sa.tuple_(sa.literal(value, sort_key.type), sa.literal(id, sa.Integer))
+			stmt = stmt.where(keys < edge if descending else keys > edge)
+
+		order_func = sa.desc if descending else sa.asc
+		stmt = stmt.order_by(order_func(sort_key), order_func(self.Table.id))
+		return stmt.limit(size + 1).options(*options)
+
+	# Cursors
+
+	@staticmethod
+	def encode_cursor(value: Any, id: int, backward: bool = False) -> str:
+		if isinstance(value, datetime.datetime):
+			key = ["datetime", value.isoformat()]
+		elif isinstance(value, datetime.date):
+			key = ["date", value.isoformat()]
+		else:
+			key = ["value", value]
+		payload = json.dumps([*key, id, backward], separators=(",", ":"))
+		return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+	@staticmethod
+	def decode_cursor(cursor: str) -> tuple[Any, int, bool]:
+		"""Raises ValueError on a malformed cursor"""
+		try:
+			payload = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+			kind, value, id, backward = json.loads(payload)
+		except (TypeError, ValueError) as e:
+			raise ValueError(f"Invalid cursor: {cursor}") from e
+
+		if not isinstance(id, int) or not isinstance(backward, bool):
+			raise ValueError(f"Invalid cursor: {cursor}")
+		if kind == "datetime":
+			value = datetime.datetime.fromisoformat(value)
+		elif kind == "date":
+			value = datetime.date.fromisoformat(value)
+		elif kind != "value" or not isinstance(value, (str, int, float)):
+			raise ValueError(f"Invalid cursor: {cursor}")
+		return value, id, backward
+
+	def to_cursor_page(
+		self,
+		rows: Sequence[CLS],
+		size: int,
+		sort_key: orm.InstrumentedAttribute[Any],
+		cursor: Optional[str] = None,
+	) -> CursorPage[CLS]:
+		backward = cursor is not None and self.decode_cursor(cursor)[2]
+		has_more = len(rows) > size
+		page = list(rows[:size])
+		if backward: page.reverse()
+		if not page: return CursorPage(page, None, None)
+
+		first, last = page[0], page[-1]
+		first_key = getattr(first, sort_key.key), first.id
+		last_key = getattr(last, sort_key.key), last.id
+
+		# Backward reads always come from a later page, forward reads from an earlier one
+		has_next = has_more if not backward else True
+		has_prev = has_more if backward else cursor is not None
+		return CursorPage(
+			page,
+			self.encode_cursor(*last_key) if has_next else None,
+			self.encode_cursor(*first_key, backward=True) if has_prev else None,
+		)
+
+	# Rows
+
+	async def acount(self) -> int:
+		count: int = (await self.session.scalars(self.count_stmt())).one()
+		return count
+
+	async def apages(
+		self,
+		index: int,
+		size: int,
+		sort_key: sa.ColumnExpressionArgument[Any],
+		desc: bool = True,
+		options: Sequence[LoaderOption] = (),
+		lookahead: bool = False,
+	) -> list[CLS]:
+		stmt = self.pages_stmt(index, size, sort_key, desc, options, lookahead=lookahead)
+		return list((await self.session.scalars(stmt)).all())
+
+	async def aestimated_count(self) -> int:
+		if (sql := self.estimated_count_sql()) is None: return await self.acount()
+		connection = await self.session.connection()
+		return self.plan_rows((await connection.exec_driver_sql(sql)).scalar_one())
+
+	async def apages_with_count(
+		self,
+		index: int,
+		size: int,
+		sort_key: sa.ColumnExpressionArgument[Any],
+		desc: bool = True,
+		options: Sequence[LoaderOption] = (),
+	) -> tuple[list[CLS], int]:
+		"""Rows of a page and the total count, in one statement"""
+		stmt = self.pages_stmt(index, size, sort_key, desc, options, with_count=True)
+		rows, count = self.split_count((await self.session.execute(stmt)).all())
+		if count is None: count = await self.acount() if index > 1 else 0
+		return rows, count
+
+	async def arows(
+		self,
+		sort_key: sa.ColumnExpressionArgument[Any],
+		desc: bool = True,
+		options: Sequence[LoaderOption] = (),
+	) -> list[CLS]:
+		stmt = self.rows_stmt(sort_key, desc, options)
+		return list((await self.session.scalars(stmt)).all())
+
+	async def acursor_pages(
+		self,
+		size: int,
+		sort_key: orm.InstrumentedAttribute[Any],
+		cursor: Optional[str] = None,
+		desc: bool = True,
+		options: Sequence[LoaderOption] = (),
+	) -> CursorPage[CLS]:
+		stmt = self.cursor_stmt(size, sort_key, cursor, desc, options)
+		rows = (await self.session.scalars(stmt)).all()
+		return self.to_cursor_page(rows, size, sort_key, cursor)
 
 from .user import *
 from .company import *
 from .order import *
 from .role import *
 from .cert import *
+from .job import *
 from .dto import *
@@ -25,6 +25,7 @@ class CertStateEnum(enum.Enum):
 	FAILED = 'FAILED'
 
 class CertErrorStageEnum(enum.Enum):
+	ADMISSION = 'ADMISSION' # not requested as the vender is down
 	REQUEST = 'REQUEST'
 	GET_STATUS = 'GET_STATUS'
 	VERIFY = 'VERIFY'
@@ -44,7 +45,7 @@ class CertResult(model.Base):
 		sa.Enum(CertVenderEnum, name='cert_vender'), nullable=False
 	)
 
-	receipt_id: orm.Mapped[str] = orm.mapped_column(nullable=True)
+	receipt_id: orm.Mapped[Optional[str]] = orm.mapped_column(nullable=True)
 	signed_data: orm.Mapped[str] = orm.mapped_column(nullable=True, deferred=True)
 
 	cert_time: orm.Mapped[datetime.datetime] = orm.mapped_column(
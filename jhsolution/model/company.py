@@ -1,9 +1,10 @@
 from __future__ import annotations
-from typing import Any, Optional, TYPE_CHECKING
+from typing import Any, Optional, Sequence, TYPE_CHECKING
 import datetime, enum, hashlib, secrets, string
 
 import sqlalchemy as sa
 from sqlalchemy import orm
+from sqlalchemy.ext.asyncio import AsyncSession
 from jhsolution import model
 
 if TYPE_CHECKING:
@@ -17,7 +18,10 @@ class MemberPermissionEnum(enum.Enum):
 
 class Company(model.Base):
 	__tablename__ = "company"
-	__table_args__ = (sa.UniqueConstraint("name", name="company_unique_name"),)
+	__table_args__ = (
+		sa.UniqueConstraint("name", name="company_unique_name"),
+		sa.Index("ix_company_sender_role_id", "sender_role_id"),
+	)
 
 	# Columns
 	
@@ -42,11 +46,20 @@ class Company(model.Base):
 	# Class Methods
 
 	@classmethod
-	def get_company_or_none(cls,
-		session: orm.Session,
+	def loader_options(cls) -> Sequence[model.LoaderOption]:
+		return (
+			orm.selectinload(cls.owner),
+			orm.selectinload(cls.sender_role),
+			orm.selectinload(cls.memberships)
+				.selectinload(CompanyMembership.user)
+				.selectinload(model.User.auth),
+		)
+
+	@classmethod
+	def select_company(cls,
 		name: Optional[str] = None,
 		owner_id: Optional[int] = None,
-	) -> Optional[Company]:
+	) -> Optional[sa.Select[Any]]:
 		stmt = sa.select(cls)
 
 		if name is not None and owner_id is not None:
@@ -58,14 +71,36 @@ class Company(model.Base):
 			stmt = stmt.where(cls.owner_id == owner_id)
 		else:
 			return None
-		
-		return session.scalars(stmt).one_or_none()
+
+		return stmt
+
+	@classmethod
+	def get_company_or_none(cls,
+		session: orm.Session,
+		name: Optional[str] = None,
+		owner_id: Optional[int] = None,
+	) -> Optional[Company]:
+		if (stmt := cls.select_company(name, owner_id)) is None:
+			return None
+		company: Optional[Company] = session.scalars(stmt).one_or_none()
+		return company
 
 	@classmethod
 	def get_company(cls, *args: Any, **kwargs: Any) -> Company:
 		if company := cls.get_company_or_none(*args, **kwargs): return company
 		raise sa.exc.NoResultFound()
 
+	@classmethod
+	async def aget_company_or_none(cls,
+		session: AsyncSession,
+		name: Optional[str] = None,
+		owner_id: Optional[int] = None,
+	) -> Optional[Company]:
+		if (stmt := cls.select_company(name, owner_id)) is None:
+			return None
+		company: Optional[Company] = (await session.scalars(stmt)).one_or_none()
+		return company
+
 	# Object Methods
 
 	def can_modify(self, order: model.Order) -> bool:
@@ -73,7 +108,10 @@ class Company(model.Base):
 
 class CompanyMembership(model.Base):
 	__tablename__ = "company_membership"
-	__table_args__ = (sa.UniqueConstraint("member_id", name="unique_member"),)
+	__table_args__ = (
+		sa.UniqueConstraint("member_id", name="unique_member"),
+		sa.Index("ix_company_membership_company_id", "company_id"),
+	)
 
 	# Columns
 
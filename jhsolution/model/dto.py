@@ -46,6 +46,7 @@ class OrderInfo(BaseModel):
 	id: int
 	ordered_time: datetime.datetime
 	state: model.OrderStatusEnum
+	shipped_time: Optional[datetime.datetime] = None
 	driver_id: Optional[int] = None
 
 	@classmethod
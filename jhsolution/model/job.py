@@ -0,0 +1,92 @@
+from __future__ import annotations
+from typing import Any, Optional, Sequence
+import datetime, enum
+
+import sqlalchemy as sa
+from sqlalchemy import orm
+from sqlalchemy.ext.asyncio import AsyncSession
+from jhsolution import model
+
+# Enums
+
+class JobStateEnum(enum.Enum):
+	PENDING = 'PENDING'
+	DONE = 'DONE'
+	FAILED = 'FAILED'
+
+# Models
+
+# A claimed job is due again after the lease, so the jobs of a stopped worker are not lost
+JOB_LEASE = datetime.timedelta(minutes=10)
+# Doubled on every failed attempt
+JOB_RETRY_DELAY = datetime.timedelta(seconds=10)
+
+class Job(model.Base):
+	"""Work run by the job workers of any process, see background.run_jobs
+
+	A worker claims the due pending jobs with SELECT ... FOR UPDATE SKIP LOCKED and
+	postpones them by JOB_LEASE while running them, so the workers never run a job at
+	the same time and a job whose worker has stopped is claimed again after its lease.
+	"""
+	__tablename__ = 'job'
+	__table_args__ = (
+		# Workers claim the pending jobs in the order of run_after
+		sa.Index('ix_job_state_run_after', 'state', 'run_after', 'id'),
+	)
+
+	# Columns
+
+	kind: orm.Mapped[str]
+	payload: orm.Mapped[dict[str, Any]] = orm.mapped_column(sa.JSON)
+	state: orm.Mapped[JobStateEnum] = orm.mapped_column(
+		sa.Enum(JobStateEnum, name='job_state'), nullable=False,
+		server_default=JobStateEnum.PENDING.value
+	)
+	attempts: orm.Mapped[int] = orm.mapped_column(server_default='0')
+	max_attempts: orm.Mapped[int] = orm.mapped_column(server_default='5')
+	run_after: orm.Mapped[datetime.datetime] = orm.mapped_column(
+		sa.DateTime(timezone=True), server_default=sa.func.now()
+	)
+	created_time: orm.Mapped[datetime.datetime] = orm.mapped_column(
+		sa.DateTime(timezone=True), server_default=sa.func.now()
+	)
+	last_error: orm.Mapped[Optional[str]] = orm.mapped_column(nullable=True)
+
+	# Object methods
+
+	def finish(self) -> None:
+		self.state = JobStateEnum.DONE
+
+	def retry(self, error: str, now: datetime.datetime) -> None:
+		"""Postpone the job by the backoff of its attempts, or fail it after the last attempt"""
+		self.last_error = error
+		if self.attempts >= self.max_attempts:
+			self.state = JobStateEnum.FAILED
+		else:
+			self.run_after = now + JOB_RETRY_DELAY * 2 ** (self.attempts - 1)
+
+	def defer(self, delay: datetime.timedelta, now: datetime.datetime) -> None:
+		"""Postpone the job by the delay without spending its attempt"""
+		self.attempts -= 1
+		self.run_after = now + delay
+
+	# Class Methods
+
+	@classmethod
+	async def aclaim(
+		cls, session: AsyncSession, kinds: Sequence[str], limit: int,
+		now: datetime.datetime, lease: datetime.timedelta = JOB_LEASE,
+	) -> Sequence[Job]:
+		"""Claim at most limit due jobs of the kinds, which the other workers skip meanwhile"""
+		jobs = (await session.scalars(
+			sa.select(cls)
+			.where(cls.state == JobStateEnum.PENDING, cls.run_after <= now, cls.kind.in_(kinds))
+			.order_by(cls.run_after, cls.id).limit(limit)
+			.with_for_update(skip_locked=True)
+		)).all()
+
+		for job in jobs:
+			job.attempts += 1
+			job.run_after = now + lease
+		await session.commit()
+		return jobs
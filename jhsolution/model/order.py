@@ -1,12 +1,15 @@
 from __future__ import annotations
-from typing import Any, Optional, TYPE_CHECKING
-import enum, datetime, hashlib
+from typing import Any, AsyncIterable, Iterable, Iterator, Optional, Sequence, Union, TYPE_CHECKING
+import asyncio, enum, datetime, hashlib, json, random
 
 import sqlalchemy as sa
 from sqlalchemy import orm
-from jhsolution import model
+from sqlalchemy.ext.asyncio import AsyncSession
+from jhsolution import blob, model, order_json
 import structlog
 
+logger = structlog.get_logger("JHsolution")
+
 if TYPE_CHECKING:
 	from .user import User
 	from .role import DriverRole, SenderRole
@@ -37,14 +40,33 @@ class DocumentType(enum.Enum):
 	PDF = 'PDF'
 	JSON = 'JSON'
 
+class DocumentCodec(enum.Enum):
+	NONE = 'NONE'
+	ZLIB = 'ZLIB'
+	LZMA = 'LZMA'
+
 class SignPurposeEnum(enum.Enum):
 	CONFIRM_ONBOARD = 'CONFIRM_ONBOARD'
 	CONFIRM_OUTBOARD = 'CONFIRM_OUTBOARD'
 
 # Models
 
+# Orders shipping this long can be failed by the sender
+FAILABLE_AFTER = datetime.timedelta(days=2)
+
+MAX_TRANSITION_ATTEMPTS = 3
+# Serialization failure and deadlock, after which the whole transaction can be retried
+RETRYABLE_SQLSTATES = {"40001", "40P01"}
+
 class Order(model.Base):
 	__tablename__ = 'order'
+	__table_args__ = (
+		# Order pages filter by the role and state of can_user_access and page on (ordered_time, id)
+		sa.Index('ix_order_sender_role_state', 'sender_role_id', 'state', 'ordered_time', 'id'),
+		sa.Index('ix_order_driver_role_state', 'driver_role_id', 'state', 'ordered_time', 'id'),
+		# The failable orders are the oldest shipping orders
+		sa.Index('ix_order_state_shipped_time', 'state', 'shipped_time', 'id'),
+	)
 
 	# Columns
 
@@ -64,6 +86,10 @@ class Order(model.Base):
 		sa.Enum(OrderStatusEnum, name='order_state'), nullable=False,
 		server_default=OrderStatusEnum.REQUESTED.name
 	)
+	# Time of the ONBOARD action, kept on the order so the failable orders are found by an index
+	shipped_time: orm.Mapped[Optional[datetime.datetime]] = orm.mapped_column(
+		sa.DateTime(timezone=True), nullable=True
+	)
 
 	# Relations
 
@@ -75,13 +101,6 @@ class Order(model.Base):
 
 	# Properties
 
-	@property
-	def shipped_time(self) -> Optional[datetime.datetime]:
-		for action in self.actions:
-			if action.action == OrderActionEnum.ONBOARD:
-				return action.timestamp
-		return None
-
 	@property
 	def driver(self) -> Optional[User]:
 		return self.driver_role.user if self.driver_role else None
@@ -99,7 +118,7 @@ class Order(model.Base):
 		now = datetime.datetime.now(tz=self.ordered_time.tzinfo)
 		if not self.shipped_time:
 			return False
-		if now - self.shipped_time < datetime.timedelta(days=2):
+		if now - self.shipped_time < FAILABLE_AFTER:
 			return False
 		if self.state != model.OrderStatusEnum.SHIPPING:
 			return False
@@ -107,46 +126,193 @@ class Order(model.Base):
 
 	# Object methods
 
-	def get_contact(
-		self, name: str, HP: str, role: Optional[OrderContactRole] = None
+	async def aget_contact(
+		self, session: AsyncSession, name: str, HP: str, role: OrderContactRole
 	) -> Optional[OrderContact]:
-		for contact in self.contacts:
-			if contact.name == name and contact.HP == HP and (not role or role == contact.role):
-				return contact
-		return None
+		"""Looked up by ix_order_contact_oid_role however many contacts the order has"""
+		stmt = sa.select(OrderContact).where(
+			OrderContact.oid == self.id, OrderContact.role == role,
+			OrderContact.HP == HP, OrderContact.name == name,
+		)
+		contact: Optional[OrderContact] = (await session.scalars(stmt.limit(1))).first()
+		return contact
+
+	async def atransition(
+		self,
+		session: AsyncSession,
+		uid: int,
+		action: OrderActionEnum,
+		states: Sequence[OrderStatusEnum],
+		state: OrderStatusEnum,
+		values: dict[str, Any] = {},
+		conditions: Sequence[sa.ColumnElement[bool]] = (),
+		description: Optional[str] = None,
+	) -> bool:
+		"""Move the order to the state and record the action, and return whether it has moved
+
+		The order moves only if it is still in one of the states and meets the conditions, which
+		one conditional UPDATE checks instead of locking the order and the user. On PostgreSQL the
+		UPDATE and the INSERT of the action are one statement. The transaction is committed, and
+		retried on serialization failures and deadlocks.
+		"""
+		oid = self.id
+		values = {**values, "state": state}
+		update = sa.update(Order).where(Order.id == oid, Order.state.in_(states), *conditions)
+		# The committed values are set after the commit instead of evaluating the conditions in Python
+		update = update.values(**values).returning(Order.id).execution_options(synchronize_session=False)
+		action_values = {"oid": oid, "uid": uid, "action": action, "description": description}
+
+		for attempt in range(MAX_TRANSITION_ATTEMPTS):
+			try:
+				if model.async_engine.dialect.name == "postgresql":
+					updated = update.cte("updated")
+					columns = [
+						updated.c.id if key == "oid" else sa.literal(value, getattr(OrderAction, key).type)
+						for key, value in action_values.items()
+					]
+					stmt = sa.insert(OrderAction).from_select(list(action_values), sa.select(*columns))
+					stmt = stmt.returning(OrderAction.id)
+					moved = (await session.execute(stmt)).first() is not None
+				else:
+					moved = (await session.execute(update)).first() is not None
+					if moved: await session.execute(sa.insert(OrderAction).values(**action_values))
+
+				if not moved: return False
+				await session.commit()
+				break
+
+			except sa.exc.DBAPIError as e:
+				sqlstate = getattr(e.orig, "sqlstate", None) or getattr(e.orig, "pgcode", None)
+				if sqlstate not in RETRYABLE_SQLSTATES or attempt + 1 == MAX_TRANSITION_ATTEMPTS: raise
+
+				# The rollback expires the loaded objects, which the log context renders
+				await session.rollback()
+				for instance in list(session.identity_map.values()):
+					await session.refresh(instance)
+				await asyncio.sleep(random.uniform(0, 0.01 * 2 ** attempt))
+				logger.info("Order transition is retried", oid=oid, sqlstate=sqlstate)
+
+		for key, value in values.items():
+			orm.attributes.set_committed_value(self, key, value)
+		return True
 
 	# Class Methods
 
 	@classmethod
-	def can_user_access(cls, user: model.User) -> sa.BooleanClauseList:
-		"""Used for order page query"""
-		# ???: Should consider when user is both sender and driver?
+	def loader_options(cls) -> Sequence[model.LoaderOption]:
+		# Every relation touched by the order properties and the order viewer,
+		# scalar relations are joined and collections are loaded by one query each
+		return (
+			orm.joinedload(cls.document),
+			orm.joinedload(cls.sender_role),
+			orm.joinedload(cls.driver_role)
+				.joinedload(model.DriverRole.user)
+				.options(*model.User.loader_options()),
+			orm.selectinload(cls.contacts),
+			orm.selectinload(cls.actions).joinedload(OrderAction.user),
+			orm.raiseload("*", sql_only=True),
+		)
+
+	@classmethod
+	def transition_loader_options(cls) -> Sequence[model.LoaderOption]:
+		# The transitions only check the roles, the actions and the contacts are queried by SQL
+		return (
+			orm.joinedload(cls.sender_role),
+			orm.joinedload(cls.driver_role)
+				.joinedload(model.DriverRole.user)
+				.options(*model.User.loader_options()),
+			orm.raiseload("*", sql_only=True),
+		)
 
-		condition = sa.true() == sa.true()
-		condition &= sa.true() == sa.true()
+	@classmethod
+	def page_loader_options(cls) -> Sequence[model.LoaderOption]:
+		# Order pages only show the order columns
+		return (orm.raiseload("*", sql_only=True),)
 
-		# Check sender access permission
+	@classmethod
+	def can_user_access(cls, user: model.User) -> sa.ColumnElement[bool]:
+		"""Used for order page query
+
+		The roles of the user are already loaded, so the condition compares the order columns
+		with their ids instead of joining company, company_membership and driver_role, which
+		keeps the plan on the order indexes and cannot duplicate rows.
+		"""
+		# ???: Should consider when user is both sender and driver?
 
 		assert user.is_sender or user.is_driver
+		conditions: list[sa.ColumnElement[bool]] = []
+
+		# Check sender access permission
 
 		if user.is_sender:
 			if user.company:
-				sub_condition = cls.sender_role_id == model.Company.sender_role_id
-				sub_condition &= model.Company.id == model.CompanyMembership.company_id
-				sub_condition &= model.CompanyMembership.member_id == user.id
+				sender_role_id = user.company.sender_role_id
 				# TODO: Make sender can select its role and check the role of the order
-				#sub_condition |= cls.sender_role_id == user.sender_role_id
 			else:
-				sub_condition = cls.sender_role_id == user.sender_role_id
-			condition &= sub_condition
+				sender_role_id = user.sender_role_id
+			conditions.append(cls.role_condition(cls.sender_role_id, sender_role_id))
 
 		# Check driver access permission
 
-		if user.is_driver:
-			condition &= cls.driver_role_id == model.DriverRole.id
-			condition &= model.DriverRole.uid == user.id
+		if user.driver_role:
+			conditions.append(cls.role_condition(cls.driver_role_id, user.driver_role.id))
+
+		return sa.and_(*conditions)
+
+	@classmethod
+	def failable_condition(cls, now: datetime.datetime) -> sa.ColumnElement[bool]:
+		"""Orders shipping for FAILABLE_AFTER or longer, served by ix_order_state_shipped_time"""
+		return sa.and_(cls.state == OrderStatusEnum.SHIPPING, cls.shipped_time <= now - FAILABLE_AFTER)
 
-		return condition
+	@classmethod
+	async def afail_failable(
+		cls, session: AsyncSession, now: datetime.datetime, batch_size: int = 100,
+		description: Optional[str] = None,
+	) -> int:
+		"""Fail the failable orders in batches of one transaction each, and return their count
+
+		Each batch selects the oldest failable orders, fails those still shipping with one
+		UPDATE and records their actions with one INSERT. Concurrent sweepers skip the rows
+		locked by each other on PostgreSQL, and the state guard of the UPDATE keeps a failed
+		order from being failed twice elsewhere.
+		"""
+		count = 0
+		while True:
+			oids = (await session.scalars(
+				sa.select(cls.id).where(cls.failable_condition(now))
+				.order_by(cls.shipped_time, cls.id).limit(batch_size)
+				.with_for_update(skip_locked=True)
+			)).all()
+			if not oids: break
+
+			failed = (await session.scalars(
+				sa.update(cls).where(cls.id.in_(oids), cls.state == OrderStatusEnum.SHIPPING)
+				.values(state=OrderStatusEnum.FAILED).returning(cls.id)
+				.execution_options(synchronize_session=False)
+			)).all()
+			if failed:
+				await session.execute(sa.insert(OrderAction), [{
+					"oid": oid, "action": OrderActionEnum.SET_FAILED, "description": description
+				} for oid in failed])
+			await session.commit()
+
+			count += len(failed)
+			if len(oids) < batch_size: break
+
+		return count
+
+	@staticmethod
+	def role_condition(
+		column: orm.InstrumentedAttribute[Optional[int]], role_id: Optional[int]
+	) -> sa.ColumnElement[bool]:
+		# A missing role matches no order, not the orders without a role
+		if role_id is None: return sa.false()
+		return column == role_id
+
+MIN_COMPRESSED_SIZE = 4096
+MAX_LZMA_SIZE = 8 << 20
+# Compressed blobs larger than this ratio of the content are not worth decompressing
+MAX_COMPRESSION_RATIO = 0.9
 
 class Document(model.Base):
 	__tablename__ = 'document'
@@ -156,9 +322,21 @@ class Document(model.Base):
 	doc_type: orm.Mapped[DocumentType] = orm.mapped_column(
 		sa.Enum(DocumentType, name='document_type')
 	)
-	content: orm.Mapped[bytes] = orm.mapped_column(deferred=True)
+	# Contents are stored in blob.store by sha256, this keeps the ones not exported yet
+	inline_content: orm.Mapped[Optional[bytes]] = orm.mapped_column('content', deferred=True)
 	sha256: orm.Mapped[bytes]
 	sha512: orm.Mapped[bytes]
+	size: orm.Mapped[Optional[int]] = orm.mapped_column(sa.BigInteger)
+	# Compressed blobs are stored by stored_sha256, the hashes and the size above are of the content
+	codec: orm.Mapped[DocumentCodec] = orm.mapped_column(
+		sa.Enum(DocumentCodec, name='document_codec'), server_default=DocumentCodec.NONE.name
+	)
+	stored_sha256: orm.Mapped[Optional[bytes]]
+	stored_size: orm.Mapped[Optional[int]] = orm.mapped_column(sa.BigInteger)
+	# Total size of the uploaded files which were merged and optimized into the content
+	original_size: orm.Mapped[Optional[int]] = orm.mapped_column(sa.BigInteger)
+	# Row index of JSON documents in blob.store, see order_json
+	row_index_sha256: orm.Mapped[Optional[bytes]]
 	upload_time: orm.Mapped[datetime.datetime] = orm.mapped_column(
 		sa.DateTime(timezone=True), server_default=sa.func.now()
 	)
@@ -169,13 +347,285 @@ class Document(model.Base):
 
 	# Methods
 
-	def __init__(self, **kwargs: Any) -> None:
-		super().__init__(**kwargs)
-		self.sha256 = hashlib.sha256(self.content).digest()
-		self.sha512 = hashlib.sha512(self.content).digest()
+	@property
+	def content(self) -> bytes:
+		if self.inline_content is not None: return self.inline_content
+		return self.read_blob()
+
+	@content.setter
+	def content(self, content: bytes) -> None:
+		with blob.Ingest(blob.store) as ingest:
+			ingest.write(content)
+			self.set_ingested(ingest)
+
+	def read_blob(self) -> bytes:
+		if self.codec == DocumentCodec.NONE: return blob.store.get(self.sha256)
+		assert self.stored_sha256 is not None
+		return b"".join(blob.decompress([blob.store.get(self.stored_sha256)], self.codec.name.lower()))
+
+	def set_ingested(self, ingest: blob.Ingest) -> None:
+		self.sha256 = ingest.sha256.digest()
+		self.sha512 = ingest.sha512.digest()
+		self.size = ingest.size
+
+		codec = self.choose_codec(self.doc_type, ingest.size)
+		stored = None
+		if codec != DocumentCodec.NONE:
+			stored = ingest.commit_compressed(codec.name.lower(), MAX_COMPRESSION_RATIO)
+
+		if stored is None:
+			ingest.commit()
+			self.codec, self.stored_sha256, self.stored_size = DocumentCodec.NONE, None, None
+		else:
+			self.codec = codec
+			self.stored_sha256, self.stored_size = stored
+
+	@staticmethod
+	def choose_codec(doc_type: DocumentType, size: int) -> DocumentCodec:
+		if size < MIN_COMPRESSED_SIZE: return DocumentCodec.NONE
+		# lzma shrinks JSON the most but compresses slowly, so the large ones use zlib
+		if doc_type == DocumentType.JSON and size <= MAX_LZMA_SIZE: return DocumentCodec.LZMA
+		return DocumentCodec.ZLIB
+
+	@classmethod
+	def ingest(cls, doc_type: DocumentType, chunks: Iterable[bytes]) -> Document:
+		"""Stores the chunks while hashing them in one pass, without joining them"""
+		document = cls(doc_type=doc_type)
+		with blob.Ingest(blob.store) as ingest:
+			ingest.write_all(chunks)
+			document.set_ingested(ingest)
+		return document
+
+	@classmethod
+	async def aingest(
+		cls, doc_type: DocumentType, chunks: Union[AsyncIterable[bytes], Iterable[bytes]]
+	) -> Document:
+		"""Same as ingest, but the hashing and the I/O run on a worker thread"""
+		document = cls(doc_type=doc_type)
+		with await asyncio.to_thread(blob.Ingest, blob.store) as ingest:
+			if isinstance(chunks, AsyncIterable):
+				async for chunk in chunks:
+					await asyncio.to_thread(ingest.write, chunk)
+			else:
+				await asyncio.to_thread(ingest.write_all, chunks)
+			await asyncio.to_thread(document.set_ingested, ingest)
+		return document
+
+	async def aget_size(self, session: AsyncSession) -> tuple[int, bool]:
+		"""Size of the content and whether it is still in the table, without loading it"""
+		stmt = sa.select(sa.func.length(Document.inline_content)).where(Document.id == self.id)
+		inline_size: Optional[int] = (await session.scalars(stmt)).one()
+		if inline_size is not None: return inline_size, True
+		if self.size is not None: return self.size, False
+		return await asyncio.to_thread(blob.store.size, self.sha256), False
+
+	async def aread_inline(self, session: AsyncSession, start: int, stop: int) -> bytes:
+		"""Bytes [start, stop) of a content still in the table, read by the session of the
+		request so that it follows its replica routing"""
+		stmt = sa.select(sa.func.substr(Document.inline_content, start + 1, stop - start))
+		chunk: Optional[bytes] = (await session.scalars(stmt.where(Document.id == self.id))).one()
+		return chunk or b""
+
+	def iter_content(
+		self, start: int, stop: int, inline: Optional[bytes] = None, chunk_size: int = 1 << 20
+	) -> Iterator[bytes]:
+		"""Chunks of the bytes [start, stop) of the content, without holding the whole content
+
+		`inline` is the content still in the table, read by the caller with its own session.
+		"""
+		if inline is not None:
+			for offset in range(start, min(stop, len(inline)), chunk_size):
+				yield inline[offset:min(offset + chunk_size, stop)]
+			return
+
+		if self.codec == DocumentCodec.NONE:
+			yield from blob.store.iter_range(self.sha256, start, stop, chunk_size)
+			return
+
+		# Compressed blobs are decompressed from the start, skipping the bytes before the range
+		assert self.stored_sha256 is not None and self.stored_size is not None
+		chunks = blob.store.iter_range(self.stored_sha256, 0, self.stored_size, chunk_size)
+		yield from blob.slice_chunks(blob.decompress(chunks, self.codec.name.lower()), start, stop)
+
+	def read(self, start: int, stop: int, inline: Optional[bytes] = None) -> bytes:
+		return b"".join(self.iter_content(start, stop, inline))
+
+	def read_rows(
+		self, offset: int, limit: int, size: int, inline: Optional[bytes] = None
+	) -> tuple[list[str], list[list[str]], int]:
+		"""Columns, rows [offset, offset + limit) and the number of rows of a JSON document
+
+		Only the columns and the rows of the page are read when the row index exists.
+		"""
+		if self.row_index_sha256 is not None:
+			index_key = self.row_index_sha256
+			num_entries = blob.store.size(index_key) // 8
+			def read_index(start: int, stop: int) -> Sequence[int]:
+				data = b"".join(blob.store.iter_range(index_key, start * 8, stop * 8, 1 << 20))
+				return order_json.unpack_row_index(data)
+		else:
+			index = order_json.unpack_row_index(
+				order_json.build_row_index(self.iter_content(0, size, inline))
+			)
+			num_entries = len(index)
+			def read_index(start: int, stop: int) -> Sequence[int]:
+				return index[start:stop]
+
+		num_rows = num_entries - 3
+		columns_start, columns_end = read_index(0, 2)
+		columns: list[str] = json.loads(self.read(columns_start, columns_end, inline))
+
+		stop = min(offset + limit, num_rows)
+		if offset >= stop: return columns, [], num_rows
+		row_bounds = read_index(2 + offset, 2 + stop + 1)
+		rows = order_json.parse_rows(self.read(row_bounds[0], row_bounds[-1], inline))
+		return columns, rows, num_rows
+
+	def set_row_index(self, row_index: bytes) -> None:
+		self.row_index_sha256 = blob.store.put(row_index)
+
+	@classmethod
+	def index_rows(cls, session: orm.Session, batch_size: int = 100) -> int:
+		"""Build the row indexes of the JSON documents stored before they were indexed"""
+		stmt = sa.select(cls).where(cls.doc_type == DocumentType.JSON, cls.row_index_sha256.is_(None))
+		stmt = stmt.order_by(cls.id).limit(batch_size)
+		count, last_id = 0, 0
+
+		while documents := session.scalars(stmt.where(cls.id > last_id)).all():
+			for document in documents:
+				size = document.size or len(document.content)
+				inline = document.inline_content
+				try:
+					row_index = order_json.build_row_index(document.iter_content(0, size, inline))
+				except order_json.OrderDataError as e:
+					logger.error("Document is not a valid JSON order", did=document.id, error=str(e))
+					continue
+				document.set_row_index(row_index)
+				count += 1
+			session.commit()
+			last_id = documents[-1].id
+
+		return count
+
+	@classmethod
+	def export_contents(cls, session: orm.Session, batch_size: int = 100) -> int:
+		"""Move the contents of the table to the blob store, committing each batch"""
+		stmt = sa.select(cls.id, cls.sha256, cls.inline_content)
+		stmt = stmt.where(cls.inline_content.is_not(None)).order_by(cls.id).limit(batch_size)
+		count, last_id = 0, 0
+
+		while rows := session.execute(stmt.where(cls.id > last_id)).all():
+			ids = []
+			for id, sha256, content in rows:
+				assert content is not None
+				if hashlib.sha256(content).digest() != sha256:
+					logger.error("Document content does not match its sha256", did=id)
+					continue
+				blob.store.put(content, sha256)
+				ids.append(id)
+
+			session.execute(sa.update(cls).where(cls.id.in_(ids)).values(inline_content=None))
+			session.commit()
+			count += len(ids)
+			last_id = rows[-1].id
+
+		return count
+
+	@classmethod
+	def import_contents(cls, session: orm.Session, batch_size: int = 100) -> int:
+		"""Copy the contents back to the table, the blobs are kept since others may share them"""
+		stmt = sa.select(cls).where(cls.inline_content.is_(None))
+		stmt = stmt.order_by(cls.id).limit(batch_size)
+		count, last_id = 0, 0
+
+		while documents := session.scalars(stmt.where(cls.id > last_id)).all():
+			for document in documents:
+				document.inline_content = document.read_blob()
+			session.commit()
+			count += len(documents)
+			last_id = documents[-1].id
+
+		return count
+
+	@classmethod
+	def compress_contents(cls, session: orm.Session, batch_size: int = 100) -> tuple[int, int]:
+		"""Compress the blobs stored raw, and return the number of documents and the bytes saved
+
+		Blobs which do not shrink enough are kept raw. The raw blobs are left to
+		collect_garbage, as a new document of the same content may be sharing them.
+		"""
+		stmt = sa.select(cls).where(cls.codec == DocumentCodec.NONE, cls.inline_content.is_(None))
+		stmt = stmt.order_by(cls.id).limit(batch_size)
+		count, saved, last_id = 0, 0, 0
+
+		while documents := session.scalars(stmt.where(cls.id > last_id)).all():
+			for document in documents:
+				size = document.size
+				if size is None: size = blob.store.size(document.sha256)
+				if cls.choose_codec(document.doc_type, size) == DocumentCodec.NONE: continue
+
+				with blob.Ingest(blob.store) as ingest:
+					ingest.write_all(blob.store.iter_range(document.sha256, 0, size, 1 << 20))
+					if ingest.sha256.digest() != document.sha256:
+						logger.error("Document content does not match its sha256", did=document.id)
+						continue
+					document.set_ingested(ingest)
+
+				if document.stored_size is None: continue
+				saved += size - document.stored_size
+				count += 1
+
+			session.commit()
+			last_id = documents[-1].id
+
+		return count, saved
+
+	@classmethod
+	def collect_garbage(
+		cls, session: orm.Session, now: datetime.datetime, grace: datetime.timedelta,
+		batch_size: int = 1000,
+	) -> int:
+		"""Delete the blobs untouched for the grace and referred to by no document
+
+		Storing a content which is already stored touches its blob, so the blob of a document
+		being uploaded is never older than the grace before the document is committed. The
+		modified time is checked again right before deleting, after the references.
+		"""
+		def collect(keys: list[bytes]) -> int:
+			stmt = sa.select(cls.sha256, cls.codec, cls.stored_sha256, cls.row_index_sha256)
+			stmt = stmt.where(sa.or_(
+				cls.sha256.in_(keys), cls.stored_sha256.in_(keys), cls.row_index_sha256.in_(keys)
+			))
+			referred = set()
+			for row in session.execute(stmt):
+				if row.codec == DocumentCodec.NONE: referred.add(row.sha256)
+				referred.update([row.stored_sha256, row.row_index_sha256])
+
+			count = 0
+			for key in keys:
+				if key in referred: continue
+				modified = blob.store.modified(key)
+				if modified is None or modified > now - grace: continue
+				blob.store.delete(key)
+				count += 1
+			return count
+
+		count, keys = 0, []
+		for key, modified in blob.store.iter_keys():
+			if modified > now - grace: continue
+			keys.append(key)
+			if len(keys) >= batch_size:
+				count += collect(keys)
+				keys = []
+		if keys: count += collect(keys)
+		return count
 
 class OrderAction(model.Base):
 	__tablename__ = 'order_action_history'
+	__table_args__ = (
+		# The history of an order, and whether a user has taken an action on it
+		sa.Index('ix_order_action_history_oid_uid_action', 'oid', 'uid', 'action'),
+	)
 
 	# Columns
 
@@ -196,6 +646,10 @@ class OrderAction(model.Base):
 
 class OrderContact(model.Base):
 	__tablename__ = 'order_contact'
+	__table_args__ = (
+		# The contacts of an order, and a contact by its role, phone number and name
+		sa.Index('ix_order_contact_oid_role', 'oid', 'role', 'HP', 'name'),
+	)
 
 	oid: orm.Mapped[int] = orm.mapped_column(sa.ForeignKey('order.id'))
 	name: orm.Mapped[str]
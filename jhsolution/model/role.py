@@ -1,9 +1,10 @@
 from __future__ import annotations
-from typing import Any, Optional, TYPE_CHECKING
+from typing import Any, Optional, Sequence, TYPE_CHECKING
 import datetime, enum
 
 import sqlalchemy as sa
 from sqlalchemy import orm
+from sqlalchemy.ext.asyncio import AsyncSession
 from jhsolution import model
 
 if TYPE_CHECKING:
@@ -48,11 +49,14 @@ class DriverRole(model.Base):
 	# Class Methods
 
 	@classmethod
-	def get_driver_role_or_none(cls,
-		session: orm.Session,
+	def loader_options(cls) -> Sequence[model.LoaderOption]:
+		return (orm.joinedload(cls.user).options(*model.User.loader_options()),)
+
+	@classmethod
+	def select_driver_role(cls,
 		HP: Optional[str] = None,
 		vehicle_id: Optional[str] = None,
-	) -> Optional[DriverRole]:
+	) -> Optional[sa.Select[Any]]:
 		if not HP and not vehicle_id:
 			return None
 
@@ -62,7 +66,18 @@ class DriverRole(model.Base):
 		if vehicle_id:
 			stmt = stmt.where(cls.vehicle_id == vehicle_id)
 
-		return session.execute(stmt).scalar_one_or_none()
+		return stmt
+
+	@classmethod
+	def get_driver_role_or_none(cls,
+		session: orm.Session,
+		HP: Optional[str] = None,
+		vehicle_id: Optional[str] = None,
+	) -> Optional[DriverRole]:
+		if (stmt := cls.select_driver_role(HP, vehicle_id)) is None:
+			return None
+		driver_role: Optional[DriverRole] = session.execute(stmt).scalar_one_or_none()
+		return driver_role
 
 	@classmethod
 	def get_driver_role(cls, *args: Any, **kwargs: Any) -> DriverRole:
@@ -70,6 +85,18 @@ class DriverRole(model.Base):
 			return driver_role
 		raise sa.exc.NoResultFound()
 
+	@classmethod
+	async def aget_driver_role_or_none(cls,
+		session: AsyncSession,
+		HP: Optional[str] = None,
+		vehicle_id: Optional[str] = None,
+	) -> Optional[DriverRole]:
+		if (stmt := cls.select_driver_role(HP, vehicle_id)) is None:
+			return None
+		stmt = stmt.options(*cls.loader_options())
+		driver_role: Optional[DriverRole] = (await session.execute(stmt)).scalar_one_or_none()
+		return driver_role
+
 	# Object Methods
 
 	def can_access(self, order: model.Order) -> bool:
@@ -1,9 +1,11 @@
 from __future__ import annotations
-from typing import Any, Optional, TYPE_CHECKING
+from typing import Any, Optional, Sequence, TYPE_CHECKING
 import datetime, enum, hashlib, secrets, string
 
 import sqlalchemy as sa
 from sqlalchemy import orm
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
 from jhsolution import model
 
 if TYPE_CHECKING:
@@ -12,6 +14,11 @@ if TYPE_CHECKING:
 
 class User(model.Base):
 	__tablename__ = "user"
+	__table_args__ = (
+		# Admin lists page on (register_time, id)
+		sa.Index("ix_user_register_time", "register_time", "id"),
+		sa.Index("ix_user_sender_role_id", "sender_role_id"),
+	)
 
 	# Columns
 
@@ -132,23 +139,45 @@ class User(model.Base):
 		if self.company and self.company.sender_role == order.sender_role: return True
 		return False
 
-	def has_deallocated(self, order: model.Order) -> bool:
-		for action in order.actions:
-			DEALLOCATE = model.OrderActionEnum.DEALLOCATE
-			if self == action.user and action.action == DEALLOCATE:
-				return True
-		return False
+	def has_deallocated_condition(self, oid: int) -> sa.Exists:
+		"""Served by ix_order_action_history_oid_uid_action however many actions the order has"""
+		Action = model.OrderAction
+		return sa.exists().where(
+			Action.oid == oid, Action.uid == self.id,
+			Action.action == model.OrderActionEnum.DEALLOCATE,
+		)
+
+	async def ahas_deallocated(self, session: AsyncSession, order: model.Order) -> bool:
+		return bool(await session.scalar(sa.select(self.has_deallocated_condition(order.id))))
 
 	# Class methods
 
 	@classmethod
-	def get_user_or_none(cls,
-		session: orm.Session,
+	def loader_options(cls) -> Sequence[model.LoaderOption]:
+		# Every relation touched by the user properties, all of them are scalar
+		# so the whole graph is joined into the query loading the user
+		Company, CompanyMembership = model.Company, model.CompanyMembership
+		owner_options = (orm.joinedload(cls.sender_role), orm.joinedload(cls.membership))
+		return (
+			orm.joinedload(cls.auth),
+			orm.joinedload(cls.driver_role),
+			orm.joinedload(cls.sender_role),
+			orm.joinedload(cls.membership)
+				.joinedload(CompanyMembership.company)
+				.options(
+					orm.joinedload(Company.sender_role),
+					orm.joinedload(Company.owner).options(*owner_options),
+				),
+			orm.raiseload("*", sql_only=True),
+		)
+
+	@classmethod
+	def select_user(cls,
 		email: Optional[str] = None,
 		google_id: Optional[str] = None,
 		HP: Optional[str] = None,
 		vehicle_id: Optional[str] = None,
-	) -> Optional[User]:
+	) -> Optional[sa.Select[Any]]:
 		stmt = sa.select(cls)
 
 		kwarg_list = [email, google_id, HP, vehicle_id]
@@ -172,13 +201,45 @@ class User(model.Base):
 		else:
 			return None
 
-		return session.scalars(stmt).one_or_none()
+		return stmt
+
+	@classmethod
+	def get_user_or_none(cls,
+		session: orm.Session,
+		email: Optional[str] = None,
+		google_id: Optional[str] = None,
+		HP: Optional[str] = None,
+		vehicle_id: Optional[str] = None,
+	) -> Optional[User]:
+		if (stmt := cls.select_user(email, google_id, HP, vehicle_id)) is None:
+			return None
+		user: Optional[User] = session.scalars(stmt).one_or_none()
+		return user
 
 	@classmethod
 	def get_user(cls, *args: Any, **kwargs: Any) -> User:
 		if user := cls.get_user_or_none(*args, **kwargs): return user
 		raise sa.exc.NoResultFound()
 
+	@classmethod
+	async def aget_user_or_none(cls,
+		session: AsyncSession,
+		email: Optional[str] = None,
+		google_id: Optional[str] = None,
+		HP: Optional[str] = None,
+		vehicle_id: Optional[str] = None,
+	) -> Optional[User]:
+		if (stmt := cls.select_user(email, google_id, HP, vehicle_id)) is None:
+			return None
+		stmt = stmt.options(*cls.loader_options())
+		user: Optional[User] = (await session.scalars(stmt)).one_or_none()
+		return user
+
+	@classmethod
+	async def aget_user(cls, *args: Any, **kwargs: Any) -> User:
+		if user := await cls.aget_user_or_none(*args, **kwargs): return user
+		raise sa.exc.NoResultFound()
+
 	@classmethod
 	def create_user(cls,
 		session: orm.Session,
@@ -215,9 +276,60 @@ class User(model.Base):
 
 		return user
 
+class UserWrite(model.Base):
+	"""Last write time of a user, whose reads stay on the primary for a while after it
+
+	It is kept in the database so that every process serving the user sees it, and out of
+	the user row so that recording it does not lock the user.
+	"""
+	__tablename__ = "user_write"
+	__table_args__ = (
+		sa.UniqueConstraint("uid"),
+	)
+
+	# Columns
+
+	uid: orm.Mapped[int] = orm.mapped_column(sa.ForeignKey("user.id", ondelete="CASCADE"))
+	last_write_time: orm.Mapped[datetime.datetime] = orm.mapped_column(sa.DateTime(timezone=True))
+
+	# Class methods
+
+	@classmethod
+	def upsert_stmt(cls, dialect: sa.Dialect, uid: int, now: datetime.datetime) -> Any:
+		values = {"uid": uid, "last_write_time": now}
+		if dialect.name == "postgresql":
+			stmt = postgresql.insert(cls).values(values)
+			return stmt.on_conflict_do_update(index_elements=[cls.uid], set_={"last_write_time": now})
+		sqlite_stmt = sqlite.insert(cls).values(values)
+		return sqlite_stmt.on_conflict_do_update(index_elements=[cls.uid], set_={"last_write_time": now})
+
+	@classmethod
+	async def ahas_recent_write(cls, session: AsyncSession, uid: int, within: float) -> bool:
+		"""Read on the primary, the replicas may not have the last write time yet"""
+		since = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=within)
+		stmt = sa.select(cls.id).where(cls.uid == uid, cls.last_write_time > since)
+		return (await session.scalar(stmt)) is not None
+
+@sa.event.listens_for(model.RoutingSession, "before_commit")
+def record_write(session: orm.Session) -> None:
+	# Without replicas every read is on the primary already
+	if not model.replicas.engines:
+		session.info.pop("written", None)
+		return
+
+	session.flush() # The pending changes are flushed only after this hook otherwise
+	if session.info.pop("written", False) and (uid := session.info.get("uid")) is not None:
+		now = datetime.datetime.now(datetime.timezone.utc)
+		session.execute(UserWrite.upsert_stmt(session.get_bind().dialect, uid, now))
+		session.info.pop("written", None)
+
 class UserAuth(model.Base):
 	__tablename__ = "user_auth"
-	__table_args__ = (sa.UniqueConstraint("google_id"),)
+	__table_args__ = (
+		sa.UniqueConstraint("google_id"),
+		sa.Index("ix_user_auth_email", "email"),
+		sa.Index("ix_user_auth_uid", "uid"),
+	)
 
 	# Columns
 
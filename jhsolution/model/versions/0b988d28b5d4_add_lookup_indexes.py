@@ -0,0 +1,47 @@
+"""Add lookup indexes
+
+Revision ID: 0b988d28b5d4
+Revises: 314e55f71f24
+Create Date: 2026-10-18 12:30:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0b988d28b5d4'
+down_revision: Union[str, None] = '314e55f71f24'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# (index name, table name, columns)
+indexes = [
+	('ix_order_sender_role_state', 'order', ['sender_role_id', 'state', 'ordered_time', 'id']),
+	('ix_order_driver_role_state', 'order', ['driver_role_id', 'state', 'ordered_time', 'id']),
+	('ix_order_action_history_oid', 'order_action_history', ['oid']),
+	('ix_order_contact_oid', 'order_contact', ['oid']),
+	('ix_user_register_time', 'user', ['register_time', 'id']),
+	('ix_user_sender_role_id', 'user', ['sender_role_id']),
+	('ix_user_auth_email', 'user_auth', ['email']),
+	('ix_user_auth_uid', 'user_auth', ['uid']),
+	('ix_company_sender_role_id', 'company', ['sender_role_id']),
+	('ix_company_membership_company_id', 'company_membership', ['company_id']),
+]
+
+
+def upgrade() -> None:
+	# CREATE INDEX CONCURRENTLY does not lock writes but cannot run inside a transaction
+	with op.get_context().autocommit_block():
+		for name, table, columns in indexes:
+			op.create_index(
+				name, table, columns, postgresql_concurrently=True, if_not_exists=True
+			)
+
+
+def downgrade() -> None:
+	with op.get_context().autocommit_block():
+		for name, table, columns in reversed(indexes):
+			op.drop_index(name, table, postgresql_concurrently=True, if_exists=True)
@@ -0,0 +1,27 @@
+"""Add document row index
+
+Revision ID: 3e8d1f6a4b52
+Revises: 9a4e6b3c2d71
+Create Date: 2026-10-18 18:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3e8d1f6a4b52'
+down_revision: Union[str, None] = '9a4e6b3c2d71'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+	# Indexes of the existing JSON documents are built by `python -m jhsolution.blob index`
+	op.add_column('document', sa.Column('row_index_sha256', sa.LargeBinary(), nullable=True))
+
+
+def downgrade() -> None:
+	op.drop_column('document', 'row_index_sha256')
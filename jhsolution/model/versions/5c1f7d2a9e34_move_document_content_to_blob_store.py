@@ -0,0 +1,28 @@
+"""Move document content to blob store
+
+Revision ID: 5c1f7d2a9e34
+Revises: 0b988d28b5d4
+Create Date: 2026-10-18 15:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5c1f7d2a9e34'
+down_revision: Union[str, None] = '0b988d28b5d4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+	# The contents are moved afterwards by `python -m jhsolution.blob export`
+	op.alter_column('document', 'content', existing_type=sa.LargeBinary(), nullable=True)
+
+
+def downgrade() -> None:
+	# Run `python -m jhsolution.blob import` first to fill the exported contents
+	op.alter_column('document', 'content', existing_type=sa.LargeBinary(), nullable=False)
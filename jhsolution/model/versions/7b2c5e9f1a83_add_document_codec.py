@@ -0,0 +1,35 @@
+"""Add document codec
+
+Revision ID: 7b2c5e9f1a83
+Revises: 3e8d1f6a4b52
+Create Date: 2026-10-18 20:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7b2c5e9f1a83'
+down_revision: Union[str, None] = '3e8d1f6a4b52'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+	# The stored blobs are compressed afterwards by `python -m jhsolution.blob compress`
+	document_codec = sa.Enum('NONE', 'ZLIB', 'LZMA', name='document_codec')
+	document_codec.create(op.get_bind())
+	op.add_column('document', sa.Column('codec', document_codec, server_default='NONE', nullable=False))
+	op.add_column('document', sa.Column('stored_sha256', sa.LargeBinary(), nullable=True))
+	op.add_column('document', sa.Column('stored_size', sa.BigInteger(), nullable=True))
+
+
+def downgrade() -> None:
+	# Run `python -m jhsolution.blob import` first, the compressed blobs are unreadable without the codec
+	op.drop_column('document', 'stored_size')
+	op.drop_column('document', 'stored_sha256')
+	op.drop_column('document', 'codec')
+	op.execute('DROP TYPE document_codec')
@@ -0,0 +1,28 @@
+"""Add document size
+
+Revision ID: 9a4e6b3c2d71
+Revises: 5c1f7d2a9e34
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9a4e6b3c2d71'
+down_revision: Union[str, None] = '5c1f7d2a9e34'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+	op.add_column('document', sa.Column('size', sa.BigInteger(), nullable=True))
+	# Contents already exported to the blob store keep NULL and are measured by the store
+	op.execute("UPDATE document SET size = octet_length(content) WHERE content IS NOT NULL")
+
+
+def downgrade() -> None:
+	op.drop_column('document', 'size')
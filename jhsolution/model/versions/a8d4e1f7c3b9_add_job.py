@@ -0,0 +1,41 @@
+"""Add job
+
+Revision ID: a8d4e1f7c3b9
+Revises: f5a3c8d1b9e2
+Create Date: 2026-10-19 00:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a8d4e1f7c3b9'
+down_revision: Union[str, None] = 'f5a3c8d1b9e2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+	op.create_table('job',
+		sa.Column('kind', sa.String(), nullable=False),
+		sa.Column('payload', sa.JSON(), nullable=False),
+		sa.Column('state', sa.Enum('PENDING', 'DONE', 'FAILED', name='job_state'), server_default='PENDING', nullable=False),
+		sa.Column('attempts', sa.Integer(), server_default='0', nullable=False),
+		sa.Column('max_attempts', sa.Integer(), server_default='5', nullable=False),
+		sa.Column('run_after', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+		sa.Column('created_time', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+		sa.Column('last_error', sa.String(), nullable=True),
+		sa.Column('id', sa.Integer(), nullable=False),
+		sa.PrimaryKeyConstraint('id')
+	)
+	op.create_index('ix_job_state_run_after', 'job', ['state', 'run_after', 'id'])
+
+
+def downgrade() -> None:
+	# The pending jobs are lost, run them first by `python -m jhsolution.worker`
+	op.drop_index('ix_job_state_run_after', 'job')
+	op.drop_table('job')
+	op.execute('DROP TYPE job_state')
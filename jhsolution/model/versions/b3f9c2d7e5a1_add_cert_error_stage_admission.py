@@ -0,0 +1,36 @@
+"""Add cert error stage admission
+
+Revision ID: b3f9c2d7e5a1
+Revises: a8d4e1f7c3b9
+Create Date: 2026-10-19 01:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b3f9c2d7e5a1'
+down_revision: Union[str, None] = 'a8d4e1f7c3b9'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+	# ALTER TYPE ... ADD VALUE cannot run inside a transaction before PostgreSQL 12
+	with op.get_context().autocommit_block():
+		op.execute("ALTER TYPE cert_error_stage ADD VALUE IF NOT EXISTS 'ADMISSION' BEFORE 'REQUEST'")
+
+
+def downgrade() -> None:
+	# Values cannot be dropped from a type, so the type is recreated without it
+	op.execute("UPDATE cert_result SET error_stage = 'REQUEST' WHERE error_stage = 'ADMISSION'")
+	op.execute("ALTER TYPE cert_error_stage RENAME TO cert_error_stage_old")
+	op.execute("CREATE TYPE cert_error_stage AS ENUM ('REQUEST', 'GET_STATUS', 'VERIFY')")
+	op.execute(
+		"ALTER TABLE cert_result ALTER COLUMN error_stage TYPE cert_error_stage "
+		"USING error_stage::text::cert_error_stage"
+	)
+	op.execute("DROP TYPE cert_error_stage_old")
@@ -0,0 +1,26 @@
+"""Add document original size
+
+Revision ID: c4a9d2e7f615
+Revises: 7b2c5e9f1a83
+Create Date: 2026-10-18 21:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4a9d2e7f615'
+down_revision: Union[str, None] = '7b2c5e9f1a83'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+	op.add_column('document', sa.Column('original_size', sa.BigInteger(), nullable=True))
+
+
+def downgrade() -> None:
+	op.drop_column('document', 'original_size')
@@ -0,0 +1,33 @@
+"""Add user write
+
+Revision ID: d6e1a4b8c2f3
+Revises: b3f9c2d7e5a1
+Create Date: 2026-10-19 02:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd6e1a4b8c2f3'
+down_revision: Union[str, None] = 'b3f9c2d7e5a1'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+	op.create_table('user_write',
+		sa.Column('uid', sa.Integer(), nullable=False),
+		sa.Column('last_write_time', sa.DateTime(timezone=True), nullable=False),
+		sa.Column('id', sa.Integer(), nullable=False),
+		sa.ForeignKeyConstraint(['uid'], ['user.id'], ondelete='CASCADE'),
+		sa.PrimaryKeyConstraint('id'),
+		sa.UniqueConstraint('uid')
+	)
+
+
+def downgrade() -> None:
+	op.drop_table('user_write')
@@ -0,0 +1,45 @@
+"""Add order shipped time
+
+Revision ID: e2b7c4f9a1d6
+Revises: c4a9d2e7f615
+Create Date: 2026-10-18 22:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e2b7c4f9a1d6'
+down_revision: Union[str, None] = 'c4a9d2e7f615'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+	op.add_column('order', sa.Column('shipped_time', sa.DateTime(timezone=True), nullable=True))
+
+	# The shipped time was the time of the ONBOARD action
+	op.execute(
+		'UPDATE "order" SET shipped_time = ('
+		'SELECT max(timestamp) FROM order_action_history '
+		'WHERE order_action_history.oid = "order".id AND order_action_history.action = \'ONBOARD\''
+		') WHERE state IN (\'SHIPPING\', \'COMPLETED\', \'FAILED\')'
+	)
+
+	# CREATE INDEX CONCURRENTLY does not lock writes but cannot run inside a transaction
+	with op.get_context().autocommit_block():
+		op.create_index(
+			'ix_order_state_shipped_time', 'order', ['state', 'shipped_time', 'id'],
+			postgresql_concurrently=True, if_not_exists=True
+		)
+
+
+def downgrade() -> None:
+	with op.get_context().autocommit_block():
+		op.drop_index(
+			'ix_order_state_shipped_time', 'order', postgresql_concurrently=True, if_exists=True
+		)
+	op.drop_column('order', 'shipped_time')
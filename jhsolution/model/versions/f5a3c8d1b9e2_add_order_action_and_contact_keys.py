@@ -0,0 +1,43 @@
+"""Add order action and contact keys
+
+Revision ID: f5a3c8d1b9e2
+Revises: e2b7c4f9a1d6
+Create Date: 2026-10-18 23:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f5a3c8d1b9e2'
+down_revision: Union[str, None] = 'e2b7c4f9a1d6'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# (index name, replaced index name, table name, columns, replaced columns)
+indexes = [
+	('ix_order_action_history_oid_uid_action', 'ix_order_action_history_oid',
+		'order_action_history', ['oid', 'uid', 'action'], ['oid']),
+	('ix_order_contact_oid_role', 'ix_order_contact_oid',
+		'order_contact', ['oid', 'role', 'HP', 'name'], ['oid']),
+]
+
+
+def upgrade() -> None:
+	# The new indexes start with oid, so they replace the indexes on oid once they are built
+	with op.get_context().autocommit_block():
+		for name, replaced, table, columns, _ in indexes:
+			op.create_index(name, table, columns, postgresql_concurrently=True, if_not_exists=True)
+			op.drop_index(replaced, table, postgresql_concurrently=True, if_exists=True)
+
+
+def downgrade() -> None:
+	with op.get_context().autocommit_block():
+		for name, replaced, table, _, replaced_columns in reversed(indexes):
+			op.create_index(
+				replaced, table, replaced_columns, postgresql_concurrently=True, if_not_exists=True
+			)
+			op.drop_index(name, table, postgresql_concurrently=True, if_exists=True)
@@ -0,0 +1,135 @@
+"""Conversion of CSV orders to JSON orders
+
+The first non-blank record of a CSV order is the columns and the others are the rows.
+The converter writes the same JSON order as `JsonOrderData.model_dump_json` while the
+chunks of the upload arrive, keeping only the record being read. Rows of a wrong width
+are collected as errors instead of stopping at the first one, so the sender can fix
+every broken row at once.
+"""
+from typing import Optional
+from array import array
+import codecs, csv, io, json
+
+from jhsolution.order_json import OrderDataError, pack_row_index
+
+ENCODINGS = ["utf-8", "cp949"]
+
+encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+def dump(value: list[str]) -> bytes:
+	return encoder.encode(value).encode()
+
+class OrderCsvConverter:
+	def __init__(self, encoding: str = "utf-8", max_row_size: int = 1_000_000, max_errors: int = 100):
+		# Spreadsheets prepend a BOM to the utf-8 exports
+		if encoding == "utf-8": encoding = "utf-8-sig"
+		self.decoder = codecs.getincrementaldecoder(encoding)()
+		self.max_row_size = max_row_size
+		self.max_errors = max_errors
+
+		# Input after the last complete record and the line where it starts
+		self.buffer = ""
+		self.line_number = 1
+
+		self.columns: Optional[list[str]] = None
+		self.num_rows = 0
+		self.errors: list[str] = []
+
+		# Byte offsets of the row index, see order_json
+		self.byte_pos = 0
+		self.columns_span = (0, 0)
+		self.row_starts = array("Q")
+		self.rows_end = 0
+
+	def feed(self, chunk: bytes, final: bool = False) -> bytes:
+		"""Convert the complete records of the input so far, and return the JSON of them"""
+		try:
+			self.buffer += self.decoder.decode(chunk, final)
+		except UnicodeDecodeError:
+			raise OrderDataError("Invalid encoding")
+
+		# A newline ends a record only out of a quoted cell, that is after an even number of quotes
+		end = self.buffer.rfind("\n")
+		num_quotes = self.buffer.count('"', 0, end)
+		while end >= 0 and num_quotes % 2:
+			start = self.buffer.rfind("\n", 0, end)
+			num_quotes -= self.buffer.count('"', max(start, 0), end)
+			end = start
+
+		output: list[bytes] = []
+		if end >= 0:
+			self.convert(self.buffer[:end + 1], output)
+			self.buffer = self.buffer[end + 1:]
+
+		if len(self.buffer) > self.max_row_size:
+			raise OrderDataError(f"Too large row at line {self.line_number}")
+		return b"".join(output)
+
+	def close(self) -> bytes:
+		"""Raises OrderDataError if the order is incomplete or has broken rows"""
+		output = [self.feed(b"", final=True)]
+
+		if self.buffer:
+			if self.buffer.count('"') % 2:
+				raise OrderDataError(f"Unterminated quoted cell at line {self.line_number}")
+			self.convert(self.buffer, output)
+			self.buffer = ""
+
+		if self.columns is None: raise OrderDataError("Missing columns")
+		if self.errors: raise OrderDataError(f"{len(self.errors)} broken rows")
+
+		output.append(self.write(b"]}"))
+		return b"".join(output)
+
+	def row_index(self) -> bytes:
+		return pack_row_index(self.columns_span, self.row_starts, self.rows_end)
+
+	def write(self, data: bytes) -> bytes:
+		self.byte_pos += len(data)
+		return data
+
+	def convert(self, records: str, output: list[bytes]) -> None:
+		reader = csv.reader(io.StringIO(records, newline=""), strict=True)
+		line_number = self.line_number
+
+		while True:
+			try:
+				cells = next(reader, None)
+			except csv.Error as e:
+				self.error(f"Line {line_number}: {e}")
+				line_number = self.line_number + reader.line_num
+				continue
+			if cells is None: break
+
+			record_line_number, line_number = line_number, self.line_number + reader.line_num
+			if sum(map(len, cells)) > self.max_row_size:
+				raise OrderDataError(f"Too large row at line {record_line_number}")
+
+			# Spreadsheets export the formatted blank rows as empty cells
+			if not any(cells): continue
+
+			if self.columns is None:
+				self.columns = cells
+				output.append(self.write(b'{"columns":'))
+				start = self.byte_pos
+				output.append(self.write(dump(cells)))
+				self.columns_span = (start, self.byte_pos)
+				output.append(self.write(b',"data":['))
+				self.rows_end = self.byte_pos
+			elif len(cells) != len(self.columns):
+				self.error(
+					f"Line {record_line_number}: expected {len(self.columns)} cells, got {len(cells)}"
+				)
+			else:
+				if self.num_rows: output.append(self.write(b","))
+				self.row_starts.append(self.byte_pos)
+				output.append(self.write(dump(cells)))
+				self.rows_end = self.byte_pos
+				self.num_rows += 1
+
+		self.line_number = line_number
+
+	def error(self, message: str) -> None:
+		self.errors.append(message)
+		if len(self.errors) >= self.max_errors:
+			raise OrderDataError("Too many broken rows")
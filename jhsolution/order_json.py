@@ -0,0 +1,196 @@
+"""Incremental validation of JSON order documents
+
+A JSON order is `{"columns": [str, ...], "data": [[str, ...], ...]}` whose rows have
+as many cells as the columns. The parser checks this shape as the chunks of the body
+arrive and keeps only the row being parsed, so its memory scales with the width of a
+row rather than the size of the document. The columns should precede the data, as
+`JsonOrderData.model_dump_json` and the order publishing page write them.
+
+While parsing, it also builds the row index of the document: little-endian uint64
+byte offsets of `[columns start, columns end, row 0 start, ..., row n-1 start, rows end]`.
+A page of rows is read with the index without parsing the rest of the document.
+"""
+from typing import Any, Generator, Iterable, Optional, Sequence
+from array import array
+import codecs, json, sys
+
+Parsing = Generator[None, None, Any]
+decoder = json.JSONDecoder()
+
+class OrderDataError(ValueError):
+	pass
+
+class OrderDataParser:
+	def __init__(self, max_row_size: int = 1_000_000):
+		self.max_row_size = max_row_size
+		self.decoder = codecs.getincrementaldecoder("utf-8")()
+		self.buffer = ""
+		self.pos = 0
+		self.closed = False
+		self.columns: Optional[list[str]] = None
+		self.num_rows = 0
+
+		# Byte offsets of the row index
+		self.byte_pos = 0
+		self.value_start = 0
+		self.columns_span = (0, 0)
+		self.row_starts = array("Q")
+		self.rows_end = 0
+
+		self.parsing = self.parse()
+		self.done = False
+		self.failed = False
+		next(self.parsing)
+
+	def feed(self, chunk: bytes) -> None:
+		try:
+			self.buffer += self.decoder.decode(chunk, final=self.closed)
+		except UnicodeDecodeError:
+			raise OrderDataError("Invalid utf-8")
+		self.resume()
+
+	def close(self) -> None:
+		"""Raises OrderDataError if the document is incomplete"""
+		self.closed = True
+		self.feed(b"")
+		if not self.done: raise OrderDataError("Incomplete document")
+
+	def resume(self) -> None:
+		if self.failed: raise OrderDataError("Invalid document")
+		try:
+			next(self.parsing)
+		except StopIteration:
+			self.done = True
+		except OrderDataError:
+			self.failed = True
+			raise
+
+	def row_index(self) -> bytes:
+		assert self.done
+		return pack_row_index(self.columns_span, self.row_starts, self.rows_end)
+
+	# Parsing steps, each yields until the buffer has enough input
+
+	def advance(self, pos: int) -> None:
+		self.byte_pos += len(self.buffer[self.pos:pos].encode())
+		self.pos = pos
+
+	def more(self, error: str = "Incomplete document") -> Parsing:
+		if self.closed: raise OrderDataError(error)
+		if len(self.buffer) - self.pos > self.max_row_size: raise OrderDataError("Too large row")
+
+		# Drop the parsed input while waiting, so the buffer keeps at most a chunk and a row
+		self.buffer = self.buffer[self.pos:]
+		self.pos = 0
+		yield
+
+	def skip_whitespace(self) -> Parsing:
+		while True:
+			pos = self.pos
+			while pos < len(self.buffer) and self.buffer[pos] in " \t\n\r":
+				pos += 1
+			self.advance(pos)
+			if self.pos < len(self.buffer): return
+			yield from self.more()
+
+	def token(self, expected: str) -> Parsing:
+		"""Consume one of the expected characters and return it"""
+		yield from self.skip_whitespace()
+		char = self.buffer[self.pos]
+		if char not in expected: raise OrderDataError(f"Expected one of {expected!r}")
+		self.advance(self.pos + 1)
+		return char
+
+	def peek(self) -> Parsing:
+		yield from self.skip_whitespace()
+		return self.buffer[self.pos]
+
+	def value(self) -> Parsing:
+		"""Decode a string or a list which ends within the buffer"""
+		yield from self.skip_whitespace()
+		if self.buffer[self.pos] not in '"[': raise OrderDataError("Expected a string or a list")
+		self.value_start = self.byte_pos
+
+		while True:
+			try:
+				value, end = decoder.raw_decode(self.buffer, self.pos)
+			except json.JSONDecodeError as e:
+				# The value may continue in the next chunk, so it is invalid only if no more comes
+				yield from self.more(e.msg)
+				continue
+
+			if end - self.pos > self.max_row_size: raise OrderDataError("Too large row")
+			self.advance(end)
+			return value
+
+	def strings(self) -> Parsing:
+		values = yield from self.value()
+		if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+			raise OrderDataError("Expected a list of strings")
+		return values
+
+	def parse(self) -> Parsing:
+		yield
+		yield from self.token("{")
+		keys: set[str] = set()
+
+		while True:
+			key = yield from self.value()
+			if not isinstance(key, str) or key not in {"columns", "data"} - keys:
+				raise OrderDataError(f"Unexpected key {key!r}")
+			keys.add(key)
+			yield from self.token(":")
+
+			if key == "columns":
+				self.columns = yield from self.strings()
+				if not self.columns: raise OrderDataError("Empty column")
+				self.columns_span = (self.value_start, self.byte_pos)
+			else:
+				if self.columns is None: raise OrderDataError("Data before the columns")
+				yield from self.token("[")
+				self.rows_end = self.byte_pos
+				if (yield from self.peek()) == "]":
+					self.advance(self.pos + 1)
+				else:
+					while True:
+						row = yield from self.strings()
+						if len(row) != len(self.columns): raise OrderDataError("Broken row data")
+						self.num_rows += 1
+						self.row_starts.append(self.value_start)
+						self.rows_end = self.byte_pos
+						if (yield from self.token(",]")) == "]": break
+
+			if (yield from self.token(",}")) == "}": break
+
+		if keys != {"columns", "data"}: raise OrderDataError("Missing key")
+
+		# Only whitespace may follow the document
+		while True:
+			if self.buffer[self.pos:].strip(" \t\n\r"): raise OrderDataError("Extra data")
+			if self.closed: return
+			self.buffer, self.pos = "", 0
+			yield
+
+def build_row_index(chunks: Iterable[bytes]) -> bytes:
+	parser = OrderDataParser()
+	for chunk in chunks: parser.feed(chunk)
+	parser.close()
+	return parser.row_index()
+
+def pack_row_index(columns_span: tuple[int, int], row_starts: Iterable[int], rows_end: int) -> bytes:
+	index = array("Q", columns_span)
+	index.extend(row_starts)
+	index.append(rows_end)
+	if sys.byteorder == "big": index.byteswap()
+	return index.tobytes()
+
+def unpack_row_index(data: bytes) -> Sequence[int]:
+	index = array("Q")
+	index.frombytes(data)
+	if sys.byteorder == "big": index.byteswap()
+	return index
+
+def parse_rows(data: bytes) -> list[list[str]]:
+	"""Rows of the bytes between the start of a row and the start of another row or the end"""
+	rows: list[list[str]] = json.loads(b"[" + data.rstrip(b" \t\n\r,") + b"]")
+	return rows
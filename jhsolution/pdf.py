@@ -0,0 +1,139 @@
+"""PDF merging on a bounded process pool
+
+Merging is CPU bound and holds the GIL, so it runs on worker processes while the
+event loop keeps serving other requests. Uploads and the merged document are spooled
+to temporary files, so neither the loop nor the workers hold a whole document in memory.
+
+The optional optimization pass compresses the content streams, merges the identical
+objects, like the fonts and images repeated across the merged files, and drops the
+unused resources, before the document is hashed and stored.
+"""
+from typing import Any, BinaryIO, Iterator, Optional, Sequence
+from concurrent.futures import ProcessPoolExecutor
+import asyncio, multiprocessing, pypdf, shutil, structlog, tempfile, time
+
+from opentelemetry import metrics as otel_metrics
+
+from jhsolution import env
+
+logger = structlog.get_logger("JHsolution")
+meter = otel_metrics.get_meter("JHsolution")
+
+CHUNK_SIZE = 1 << 20
+
+def iter_file(path: str) -> Iterator[bytes]:
+	with open(path, "rb") as file:
+		while chunk := file.read(CHUNK_SIZE):
+			yield chunk
+
+class MergeQueueFull(Exception):
+	pass
+
+def spool(files: Sequence[BinaryIO], directory: str) -> list[str]:
+	"""Copy the uploaded files to the directory, the workers read them by path"""
+	paths = []
+	for file in files:
+		file.seek(0)
+		with tempfile.NamedTemporaryFile(dir=directory, suffix=".pdf", delete=False) as spooled:
+			shutil.copyfileobj(file, spooled, CHUNK_SIZE)
+		paths.append(spooled.name)
+	return paths
+
+def remove_unused_resources(pages: Sequence[pypdf.PageObject]) -> None:
+	"""Drop the fonts and the XObjects which the contents of the pages never use
+
+	The pages may share their resources, so a name is dropped only if no page sharing it uses it.
+	"""
+	used: dict[int, set[str]] = {}
+	kept: set[int] = set()
+	names: dict[int, Any] = {}
+
+	for page in pages:
+		resources: Any = page.get("/Resources")
+		if resources is None: continue
+		resources = resources.get_object()
+		contents = page.get_contents()
+		operations = contents.operations if contents is not None else []
+		page_used = {
+			operands[0] for operands, operator in operations if operator in (b"Tf", b"Do") and operands
+		}
+
+		for category in ["/Font", "/XObject"]:
+			if category not in resources: continue
+			category_names = resources[category].get_object()
+			key = id(category_names)
+			names[key] = category_names
+			used.setdefault(key, set()).update(page_used)
+			# Appearance streams of old annotations may use the resources of the page
+			if "/Annots" in page: kept.add(key)
+
+	for key, category_names in names.items():
+		if key in kept: continue
+		for name in [name for name in category_names if name not in used[key]]:
+			del category_names[name]
+
+def optimize_writer(writer: pypdf.PdfWriter) -> None:
+	remove_unused_resources(writer.pages)
+	for page in writer.pages:
+		page.compress_content_streams()
+	writer.compress_identical_objects(remove_duplicates=True, remove_unreferenced=True)
+
+def merge(paths: Sequence[str], directory: str, optimize: bool = False) -> str:
+	"""Runs on a worker process, and returns the path of the merged file"""
+	writer = pypdf.PdfWriter()
+	for path in paths:
+		for page in pypdf.PdfReader(path).pages:
+			writer.add_page(page)
+
+	if optimize: optimize_writer(writer)
+
+	with tempfile.NamedTemporaryFile(dir=directory, suffix=".pdf", delete=False) as merged:
+		writer.write(merged)
+	return merged.name
+
+class PdfMerger:
+	"""Runs `merge` on at most `workers` processes and rejects merges beyond `max_pending`"""
+
+	def __init__(self, workers: int, max_pending: int, optimize: bool = False):
+		self.workers = workers
+		self.max_pending = max_pending
+		self.optimize = optimize
+		self.pending = 0
+		self.executor: Optional[ProcessPoolExecutor] = None
+
+		self.queue_depth = meter.create_up_down_counter(
+			"pdf_merge.queue_depth", description="Merges waiting for or running on a worker"
+		)
+		self.duration = meter.create_histogram(
+			"pdf_merge.duration", unit="s", description="Latency of a merge including the wait"
+		)
+
+	async def merge(self, paths: Sequence[str], directory: str) -> str:
+		if self.pending >= self.max_pending:
+			raise MergeQueueFull()
+
+		if self.executor is None:
+			# Forking the threads of the server is unsafe, so the workers are spawned
+			context = multiprocessing.get_context("spawn")
+			self.executor = ProcessPoolExecutor(self.workers, mp_context=context)
+
+		self.pending += 1
+		self.queue_depth.add(1)
+		start_time = time.perf_counter()
+		try:
+			loop = asyncio.get_running_loop()
+			return await loop.run_in_executor(self.executor, merge, paths, directory, self.optimize)
+		finally:
+			duration = time.perf_counter() - start_time
+			self.pending -= 1
+			self.queue_depth.add(-1)
+			self.duration.record(duration)
+			logger.debug("PDF merge has finished", duration=duration, pending=self.pending)
+
+	def shutdown(self) -> None:
+		"""Stop the workers, the merges not started yet are cancelled"""
+		if self.executor is None: return
+		self.executor.shutdown(cancel_futures=True)
+		self.executor = None
+
+merger = PdfMerger(env.PDF_MERGE_WORKERS, env.PDF_MERGE_MAX_PENDING, env.PDF_OPTIMIZE)
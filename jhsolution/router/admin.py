@@ -1,4 +1,4 @@
-from typing import Annotated, Optional
+from typing import Annotated, Any, Optional, Sequence
 import datetime, structlog
 
 from fastapi import APIRouter, Depends, Form, HTTPException, Request, Response
@@ -7,6 +7,7 @@ from fastapi.templating import Jinja2Templates
 
 import sqlalchemy as sa
 from sqlalchemy import orm
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from jhsolution import model, utils
 from jhsolution.env import ADMIN_SECRET_KEY
@@ -24,16 +25,48 @@ async def check_admin(request: Request)-> None:
 		raise HTTPException(404)
 
 async def get_company(
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
 	company_id: int,
 ) -> model.Company:
-	if company := model.Company.get_or_none(session, company_id):
+	if company := await model.Company.aget_or_none(session, company_id):
 		structlog.contextvars.bind_contextvars(company=company)
 		return company
 
 	logger.warning("Company does not exist", company_id=company_id)
 	raise HTTPException(404)
 
+async def board_page(
+	board: model.PageBoard[model.CLS],
+	sort_key: orm.InstrumentedAttribute[Any],
+	page: Optional[int], page_size: int, cursor: Optional[str],
+	options: Sequence[model.LoaderOption] = (),
+) -> tuple[list[model.CLS], dict[str, Any]]:
+	"""Rows of a keyset page, or of an offset page when a page number is given, with the
+	template context of the pagination
+
+	Admin tables can grow large, so offset pages count their rows by the planner estimate.
+	The estimate can be off, so it only sizes the page count shown and the next page is
+	decided by reading one row past the page.
+	"""
+	if page is not None:
+		rows = await board.apages(page, page_size, sort_key, options=options, lookahead=True)
+		is_last_page = len(rows) <= page_size
+		num_pages = utils.num_pages(await board.aestimated_count(), page_size)
+		num_pages = max(num_pages, page if is_last_page else page + 1)
+		return rows[:page_size], {"page": page, "is_last_page": is_last_page, "num_pages": num_pages}
+
+	try:
+		cursor_page = await board.acursor_pages(page_size, sort_key, cursor, options=options)
+	except ValueError:
+		logger.warning("Invalid page cursor", cursor=cursor)
+		raise HTTPException(404)
+
+	return cursor_page.rows, {
+		"page": None,
+		"next_cursor": cursor_page.next_cursor,
+		"prev_cursor": cursor_page.prev_cursor,
+	}
+
 def failed_redirection(path: str, reason: str) -> RedirectResponse:
 	return RedirectResponse(f"/ADMIN{path}?failed_reason={reason}", status_code=302)
 
@@ -59,42 +92,46 @@ async def logout(request: Request) -> Response:
 
 # Sender management pages
 
-@router.get("/senders", dependencies=[Depends(check_admin)])
+@router.get("/senders", dependencies=[Depends(check_admin), Depends(dependency.use_replica)])
 async def sender_list(
 	request: Request,
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
-	page: int = 1, page_size: int = 50
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
+	page: Optional[int] = None, page_size: int = 50, cursor: Optional[str] = None
 ) -> Response:
 	condition = model.User.sender_role_id != None
 	board = model.PageBoard(model.User, condition, session)
-	max_page = utils.num_pages(board.count, page_size)
-	senders = board.pages(page, page_size, model.User.register_time)
+	senders, pagination = await board_page(
+		board, model.User.register_time, page, page_size, cursor,
+		options=model.User.loader_options()
+	)
 
 	return templates.TemplateResponse(request, "admin/senders.jinja", {
-		"admin": True, "senders": senders, "page": page, "is_last_page": page >= max_page
+		"admin": True, "senders": senders, **pagination
 	})
 
 # Driver management pages
 
-@router.get("/drivers", dependencies=[Depends(check_admin)])
+@router.get("/drivers", dependencies=[Depends(check_admin), Depends(dependency.use_replica)])
 async def driver_list(
 	request: Request,
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
-	page: int = 1, page_size: int = 50, failed_reason: Optional[str] = None
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
+	page: Optional[int] = None, page_size: int = 50, cursor: Optional[str] = None,
+	failed_reason: Optional[str] = None
 ) -> Response:
 	condition = model.User.id == model.DriverRole.uid
 	board = model.PageBoard(model.User, condition, session)
-	max_page = utils.num_pages(board.count, page_size)
-	drivers = board.pages(page, page_size, model.User.register_time)
+	drivers, pagination = await board_page(
+		board, model.User.register_time, page, page_size, cursor,
+		options=model.User.loader_options()
+	)
 
 	return templates.TemplateResponse(request, "admin/drivers.jinja", {
-		"admin": True, "drivers": drivers, "page": page,
-		"is_last_page": page >= max_page, "failed_reason": failed_reason,
+		"admin": True, "drivers": drivers, "failed_reason": failed_reason, **pagination
 	})
 
 @router.post("/drivers", dependencies=[Depends(check_admin)])
 async def post_driver(
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
 	name: Annotated[str, Form()],
 	HP: Annotated[str, Form()],
 	birthday: Annotated[datetime.date, Form()],
@@ -102,10 +139,10 @@ async def post_driver(
 	vehicle_type: Annotated[model.VehicleType, Form()],
 	password: Annotated[str, Form()],
 ) -> Response:
-	if model.DriverRole.get_driver_role_or_none(session, HP=HP):
+	if await model.DriverRole.aget_driver_role_or_none(session, HP=HP):
 		return RedirectResponse("/ADMIN/drivers?failed_reason=HP_EXIST", status_code=302)
 
-	if model.DriverRole.get_driver_role_or_none(session, vehicle_id=vehicle_id):
+	if await model.DriverRole.aget_driver_role_or_none(session, vehicle_id=vehicle_id):
 		return RedirectResponse("/ADMIN/drivers?failed_reason=VEHICLE_ID_EXIST", status_code=302)
 
 	auth = model.UserAuth()
@@ -114,21 +151,21 @@ async def post_driver(
 		name=name, HP=HP, birthday=birthday,
 		vehicle_id=vehicle_id, vehicle_type=vehicle_type
 	)
-	driver = model.User.create_user(
-		session, auth, driver_role=driver_role, commit=True
+	driver = await session.run_sync(
+		model.User.create_user, auth, driver_role=driver_role, commit=True
 	)
 
 	return RedirectResponse("/ADMIN/drivers", status_code=302)
 
 # User management pages
 
-@router.get("/users/{uid}", dependencies=[Depends(check_admin)])
+@router.get("/users/{uid}", dependencies=[Depends(check_admin), Depends(dependency.use_replica)])
 async def driver_page(
 	request: Request, uid: int,
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
 	failed_reason: Optional[str] = None
 ) -> Response:
-	user = model.User.get_or_none(session, uid)
+	user = await model.User.aget_or_none(session, uid)
 	if not user: raise HTTPException(404)
 
 	return templates.TemplateResponse(request, "admin/user.jinja", {
@@ -138,7 +175,7 @@ async def driver_page(
 @router.post("/users/{uid}", dependencies=[Depends(check_admin)])
 async def edit_user_info(
 	uid: int,
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
 	company_name: Annotated[Optional[str], Form()] = None,
 	company_address: Annotated[Optional[str], Form()] = None,
 	name: Annotated[Optional[str], Form()] = None,
@@ -147,24 +184,24 @@ async def edit_user_info(
 	vehicle_id: Annotated[Optional[str], Form()] = None,
 	vehicle_type: Annotated[Optional[model.VehicleType], Form()] = None,
 ) -> Response:
-	user = model.User.get_or_none(session, uid)
+	user = await model.User.aget_or_none(session, uid)
 	if user is None: raise HTTPException(404)
 
 	if sender_role := user.sender_role:
 		logger.debug("sender fields", company_name=company_name, company_address=company_address)
 		if company_name: sender_role.company_name = company_name
 		if company_address: sender_role.company_address = company_address
-		session.commit()
+		await session.commit()
 
 	elif driver_role := user.driver_role:
 		# Check duplicated field
 
-		get_driver_role_or_none = model.DriverRole.get_driver_role_or_none
+		get_driver_role_or_none = model.DriverRole.aget_driver_role_or_none
 
-		other_driver_role = get_driver_role_or_none(session, HP=HP)
+		other_driver_role = await get_driver_role_or_none(session, HP=HP)
 		if other_driver_role and other_driver_role != driver_role:
 			return failed_redirection(f"/users/{uid}", "HP_EXIST")
-		other_driver_role = get_driver_role_or_none(session, vehicle_id=vehicle_id)
+		other_driver_role = await get_driver_role_or_none(session, vehicle_id=vehicle_id)
 		if other_driver_role and other_driver_role != driver_role:
 			return failed_redirection(f"/users/{uid}", "VEHICLE_ID_EXIST")
 
@@ -175,7 +212,7 @@ async def edit_user_info(
 		if birthday: driver_role.birthday = birthday
 		if vehicle_id: driver_role.vehicle_id = vehicle_id
 		if vehicle_type: driver_role.vehicle_type = vehicle_type
-		session.commit()
+		await session.commit()
 
 	else:
 		return failed_redirection(f"users/{uid}", "NEITHER_SENDER_NOR_DRIVER")
@@ -184,44 +221,43 @@ async def edit_user_info(
 
 @router.post("/users/{uid}/password", dependencies=[Depends(check_admin)])
 async def change_driver_password(
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
 	uid: int, password: Annotated[str, Form()]
 ) -> Response:
-	user = model.User.get_or_none(session, uid)
+	user = await model.User.aget_or_none(session, uid)
 	if user is None: raise HTTPException(404)
 	user.auth.set_password(password)
-	session.commit()
+	await session.commit()
 	return RedirectResponse(f"/ADMIN/users/{user.id}", status_code=302)
 
 # Company management pages
 
-@router.get("/companies", dependencies=[Depends(check_admin)])
+@router.get("/companies", dependencies=[Depends(check_admin), Depends(dependency.use_replica)])
 async def company_list(
 	request: Request,
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
-	page: int = 1, page_size: int = 50, failed_reason: Optional[str] = None
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
+	page: Optional[int] = None, page_size: int = 50, cursor: Optional[str] = None,
+	failed_reason: Optional[str] = None
 ) -> Response:
 	board = model.PageBoard(model.Company, sa.true(), session)
-	max_page = utils.num_pages(board.count, page_size)
-	companies = board.pages(page, page_size, model.Company.id)
+	companies, pagination = await board_page(board, model.Company.id, page, page_size, cursor)
 
 	return templates.TemplateResponse(request, "admin/companies.jinja", {
-		"admin": True, "companies": companies, "failed_reason": failed_reason,
-		"page": page, "is_last_page": page >= max_page,
+		"admin": True, "companies": companies, "failed_reason": failed_reason, **pagination
 	})
 
 @router.post("/companies", dependencies=[Depends(check_admin)])
 async def post_company(
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
 	name: Annotated[str, Form()],
 	owner_id: Annotated[int, Form()],
 ) -> Response:
 	# Check constraints
 
-	if model.Company.get_company_or_none(session, name=name):
+	if await model.Company.aget_company_or_none(session, name=name):
 		return RedirectResponse("/ADMIN/companies?failed_reason=NAME_EXIST", status_code=302)
 
-	owner = model.User.get_or_none(session, owner_id)
+	owner = await model.User.aget_or_none(session, owner_id)
 	if owner is None or owner.sender_role is None:
 		return RedirectResponse("/ADMIN/companies?failed_reason=USER_NOT_EXIST", status_code=302)
 	if owner.company is not None:
@@ -231,34 +267,36 @@ async def post_company(
 
 	sender_role = model.SenderRole(company_name=owner.company_name, company_address=owner.company_address)
 	session.add(sender_role)
-	session.flush([sender_role])
+	await session.flush([sender_role])
 	company = model.Company(name=name, owner_id=owner_id, sender_role_id=sender_role.id)
 	session.add(company)
-	session.flush([company])
+	await session.flush([company])
 
 	membership = model.CompanyMembership(company_id=company.id, member_id=owner_id)
 	session.add(membership)
-	session.commit()
+	await session.commit()
 
 	return RedirectResponse(f"/ADMIN/companies/{company.id}", status_code=302)
 
-@router.get("/companies/{company_id}", dependencies=[Depends(check_admin)])
+@router.get("/companies/{company_id}", dependencies=[Depends(check_admin), Depends(dependency.use_replica)])
 async def company_page(
 	request: Request,
 	company: Annotated[model.Company, Depends(get_company)],
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
-	page: int = 1, page_size: int = 50
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
+	page: Optional[int] = None, page_size: int = 50, cursor: Optional[str] = None
 ) -> Response:
 	sub_stmt = sa.select(model.CompanyMembership)
 	sub_stmt = sub_stmt.where(model.CompanyMembership.member_id == model.User.id)
 	condition = sa.not_(sa.exists(sub_stmt)) & (model.User.sender_role_id != None)
 
 	board = model.PageBoard(model.User, condition, session)
-	max_page = utils.num_pages(board.count, page_size)
-	others = board.pages(page, page_size, model.User.register_time)
+	others, pagination = await board_page(
+		board, model.User.register_time, page, page_size, cursor,
+		options=[orm.selectinload(model.User.auth)]
+	)
 
 	return templates.TemplateResponse(request, "admin/company.jinja", {
-		"admin": True, "company": company, "others": others, "page": page, "is_last_page": True
+		"admin": True, "company": company, "others": others, **pagination
 	})
 
 
@@ -266,9 +304,9 @@ async def company_page(
 async def add_member(
 	uid: Annotated[int, Form()],
 	company: Annotated[model.Company, Depends(get_company)],
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
 ) -> Response:
-	user = model.User.get_or_none(session, uid)
+	user = await model.User.aget_or_none(session, uid)
 
 	if user is None:
 		return failed_redirection(f"companies/{company.id}", "USER_NOT_EXIST")
@@ -277,7 +315,7 @@ async def add_member(
 
 	membership = model.CompanyMembership(company_id=company.id, member_id=user.id)
 	session.add(membership)
-	session.commit()
+	await session.commit()
 
 	return RedirectResponse(f"/ADMIN/companies/{company.id}", status_code=302)
 
@@ -285,9 +323,9 @@ async def add_member(
 async def delete_member(
 	uid: Annotated[int, Form()],
 	company: Annotated[model.Company, Depends(get_company)],
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
 ) -> Response:
-	user = model.User.get_or_none(session, uid)
+	user = await model.User.aget_or_none(session, uid)
 
 	if user is None:
 		return failed_redirection(f"companies/{company.id}", "USER_NOT_EXIST")
@@ -296,8 +334,8 @@ async def delete_member(
 	if user.company.owner == user:
 		return failed_redirection(f"companies/{company.id}", "USER_IS_OWNER")
 
-	session.delete(user.membership)
-	session.commit()
+	await session.delete(user.membership)
+	await session.commit()
 
 	return RedirectResponse(f"/ADMIN/companies/{company.id}", status_code=302)
 
@@ -305,9 +343,9 @@ async def delete_member(
 async def set_owner(
 	uid: Annotated[int, Form()],
 	company: Annotated[model.Company, Depends(get_company)],
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
 ) -> Response:
-	user = model.User.get_or_none(session, uid)
+	user = await model.User.aget_or_none(session, uid)
 
 	if user is None or user.sender_role is None:
 		return failed_redirection(f"companies/{company.id}", "USER_NOT_EXIST")
@@ -318,6 +356,6 @@ async def set_owner(
 
 	company.owner_id = user.id
 
-	session.commit()
+	await session.commit()
 
 	return RedirectResponse(f"/ADMIN/companies/{company.id}", status_code=302)
@@ -1,19 +1,19 @@
-from typing import Annotated, Optional
-import base64, datetime, io, pypdf, structlog
+from typing import Annotated, AsyncIterator, Optional
+import asyncio, base64, datetime, structlog, tempfile
 
 from fastapi import (
-	APIRouter, BackgroundTasks, Body, Depends, Form,
-	HTTPException, Request, Response, UploadFile
+	APIRouter, Body, Depends, Form,
+	HTTPException, Query, Request, Response, UploadFile
 )
-from fastapi.responses import StreamingResponse
 from fastapi.security.utils import get_authorization_scheme_param
 
 from pydantic import BaseModel
 
 import sqlalchemy as sa
 from sqlalchemy import orm
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from jhsolution import model, utils
+from jhsolution import model, order_csv, order_json, pdf, utils
 from jhsolution.model import UserInfo, OrderInfo, OrderContactInfo
 
 from . import background, dependency
@@ -25,6 +25,12 @@ class JsonOrderData(BaseModel):
 	columns: list[str]
 	data: list[list[str]]
 
+class OrderRows(BaseModel):
+	columns: list[str]
+	rows: list[list[str]]
+	offset: int
+	total: int
+
 ################################################################################
 # Auth
 ################################################################################
@@ -32,7 +38,7 @@ class JsonOrderData(BaseModel):
 @router.get('/token')
 async def issue_token(
 	request: Request,
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
 ) -> str:
 	authorization = request.headers.get("Authorization")
 	scheme, param = get_authorization_scheme_param(authorization)
@@ -45,11 +51,11 @@ async def issue_token(
 			raise HTTPException(401)
 
 		user: Optional[model.User] = None
-		get_user = model.User.get_user_or_none
+		get_user = model.User.aget_user_or_none
 
-		if not user: user = get_user(session, HP=email_or_HP)
+		if not user: user = await get_user(session, HP=email_or_HP)
 		if user and not user.has_verified: user = None
-		if not user: user = get_user(session, email=email_or_HP)
+		if not user: user = await get_user(session, email=email_or_HP)
 		if user and not user.has_verified: user = None
 
 		if user and user.has_valid_password(password):
@@ -65,16 +71,15 @@ async def renew_token(user: Annotated[model.User, Depends(dependency.get_user)])
 # User Information
 ################################################################################
 
-@router.get('/account')
+@router.get('/account', dependencies=[Depends(dependency.use_replica)])
 async def user_info(
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
 	user: Annotated[model.User, Depends(dependency.get_user)],
 ) -> UserInfo:
-	return UserInfo.model_validate(user.get(session, user.id))
+	return UserInfo.model_validate(user)
 
 @router.post('/account')
 async def modify_user_info(
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
 	user: Annotated[model.User, Depends(dependency.get_user)],
 	user_info: UserInfo,
 ) -> Response:
@@ -87,70 +92,192 @@ async def modify_user_info(
 			sender_role.company_address = user_info.company_address
 
 	if user_info.company_name or user_info.company_address:
-		session.commit()
+		await session.commit()
 
 	return Response(status_code=204)
 
 @router.patch('/account/password')
 async def change_password(
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
 	user: Annotated[model.User, Depends(dependency.get_user)],
 	password: Annotated[str, Body(embed=True)],
 ) -> Response:
 	user.auth.set_password(password)
-	session.commit()
+	await session.commit()
 	return Response(status_code=204)
 
 ################################################################################
 # Order List
 ################################################################################
 
-@router.post('/orders/json')
+MAX_BULK_ORDERS = 1000
+MAX_ORDER_JSON_SIZE = 100_000_000
+MAX_ORDER_CSV_SIZE = 100_000_000
+
+def check_order_data(order_data: JsonOrderData) -> Optional[str]:
+	"""Reason why the order data is broken, or None if it is valid"""
+	if len(order_data.columns) == 0:
+		return "Empty column"
+
+	for row in order_data.data:
+		if len(row) != len(order_data.columns):
+			return "Broken row data"
+
+	return None
+
+async def insert_orders(
+	session: AsyncSession, user: model.User, documents: list[model.Document]
+) -> list[int]:
+	"""Insert the documents and orders by one multi-row INSERT each, and return the order ids"""
+	stmt = sa.insert(model.Document).returning(model.Document.id, sort_by_parameter_order=True)
+	dids = (await session.scalars(stmt, [{
+		"doc_type": document.doc_type, "sha256": document.sha256,
+		"sha512": document.sha512, "size": document.size,
+		"codec": document.codec, "stored_sha256": document.stored_sha256,
+		"stored_size": document.stored_size, "row_index_sha256": document.row_index_sha256,
+	} for document in documents])).all()
+
+	sender_role_id = user.company.sender_role_id if user.company else user.sender_role_id
+	stmt = sa.insert(model.Order).returning(model.Order.id, sort_by_parameter_order=True)
+	oids = (await session.scalars(stmt, [
+		{"did": did, "sender_role_id": sender_role_id} for did in dids
+	])).all()
+
+	await session.commit()
+	return list(oids)
+
+@router.post('/orders/json', openapi_extra={"requestBody": {
+	"required": True, "content": {"application/json": {"schema": JsonOrderData.model_json_schema()}}
+}})
 async def post_json(
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
+	request: Request,
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
 	user: Annotated[model.User, Depends(dependency.get_user)],
-	order_data: JsonOrderData,
 ) -> dict[str, int]:
-	# Check input and permission
+	# Check permission
 
 	if user.sender_role is None:
 		logger.warning("Only sender can post the order")
 		raise HTTPException(403)
 
-	if len(order_data.columns) == 0:
-		logger.warning("Empty column")
+	# Store the body as it is while validating it
+
+	parser = order_json.OrderDataParser()
+
+	async def validated_chunks() -> AsyncIterator[bytes]:
+		size = 0
+		async for chunk in request.stream():
+			size += len(chunk)
+			if size > MAX_ORDER_JSON_SIZE:
+				logger.warning("JSON order is too large")
+				raise HTTPException(413)
+			await asyncio.to_thread(parser.feed, chunk)
+			yield chunk
+		parser.close()
+
+	try:
+		document = await model.Document.aingest(model.DocumentType.JSON, validated_chunks())
+	except order_json.OrderDataError as e:
+		logger.warning(str(e))
 		raise HTTPException(403)
 
-	for row in order_data.data:
-		if len(row) != len(order_data.columns):
-			logger.warning("Broken row data")
-			raise HTTPException(403)
+	await asyncio.to_thread(document.set_row_index, parser.row_index())
 
 	# Post the order
 
-	json_data = order_data.model_dump_json().encode()
+	oid, = await insert_orders(session, user, [document])
+	logger.info('Order has posted', oid=oid, num_rows=parser.num_rows)
 
-	document = model.Document(
-		doc_type=model.DocumentType.JSON,
-		content=json_data
-	)
+	return {"oid": oid}
 
-	session.add(document)
-	session.flush([document])
+@router.post('/orders/csv', openapi_extra={"requestBody": {
+	"required": True, "content": {"text/csv": {"schema": {"type": "string"}}}
+}})
+async def post_csv(
+	request: Request,
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
+	user: Annotated[model.User, Depends(dependency.get_user)],
+	encoding: str = "utf-8",
+) -> dict[str, int]:
+	# Check permission
 
-	sender_role_id = user.company.sender_role_id if user.company else user.sender_role_id
-	order = model.Order(did=document.id, sender_role_id=sender_role_id)
-	session.add(order)
-	session.commit()
+	if user.sender_role is None:
+		logger.warning("Only sender can post the order")
+		raise HTTPException(403)
 
-	logger.info('Order has posted', order=order)
+	if encoding not in order_csv.ENCODINGS:
+		raise HTTPException(403)
 
-	return {"oid": order.id}
+	# Store the body as a JSON order while converting it
+
+	converter = order_csv.OrderCsvConverter(encoding)
+
+	async def converted_chunks() -> AsyncIterator[bytes]:
+		size = 0
+		async for chunk in request.stream():
+			size += len(chunk)
+			if size > MAX_ORDER_CSV_SIZE:
+				logger.warning("CSV order is too large")
+				raise HTTPException(413)
+			yield await asyncio.to_thread(converter.feed, chunk)
+		yield await asyncio.to_thread(converter.close)
+
+	try:
+		document = await model.Document.aingest(model.DocumentType.JSON, converted_chunks())
+	except order_json.OrderDataError as e:
+		logger.warning(str(e), errors=converter.errors)
+		raise HTTPException(403, detail=[str(e), *converter.errors])
+
+	await asyncio.to_thread(document.set_row_index, converter.row_index())
+
+	# Post the order
+
+	oid, = await insert_orders(session, user, [document])
+	logger.info('Order has posted', oid=oid, num_rows=converter.num_rows)
+
+	return {"oid": oid}
+
+@router.post('/orders/json/bulk')
+async def post_json_bulk(
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
+	user: Annotated[model.User, Depends(dependency.get_user)],
+	orders_data: list[JsonOrderData],
+) -> dict[str, list[int]]:
+	# Check every input before posting any of them
+
+	if user.sender_role is None:
+		logger.warning("Only sender can post the order")
+		raise HTTPException(403)
+
+	if not 0 < len(orders_data) <= MAX_BULK_ORDERS:
+		logger.warning("Bulk orders are empty or too many", num_orders=len(orders_data))
+		raise HTTPException(413 if orders_data else 403)
+
+	for index, order_data in enumerate(orders_data):
+		if reason := check_order_data(order_data):
+			logger.warning(reason, index=index)
+			raise HTTPException(403, detail=f"{reason} at index {index}")
+
+	# Post the orders in one transaction
+
+	def ingest() -> list[model.Document]:
+		documents = []
+		for order_data in orders_data:
+			content = order_data.model_dump_json().encode()
+			document = model.Document.ingest(model.DocumentType.JSON, [content])
+			document.set_row_index(order_json.build_row_index([content]))
+			documents.append(document)
+		return documents
+
+	oids = await insert_orders(session, user, await asyncio.to_thread(ingest))
+	logger.info('Orders have posted', oids=oids)
+
+	return {"oids": oids}
 
 # Deprecated
 @router.post('/orders/pdf')
 async def post_pdf(
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
 	user: Annotated[model.User, Depends(dependency.get_user)],
 	order_files: list[UploadFile],
 ) -> dict[str, int]:
@@ -172,54 +299,80 @@ async def post_pdf(
 
 	# Merge pdf files
 
-	order_pdf = pypdf.PdfWriter()
-	for pdf_data in order_files:
-		sub_pdf = pypdf.PdfReader(pdf_data.file)
-		for page in sub_pdf.pages:
-			order_pdf.add_page(page)
+	with tempfile.TemporaryDirectory() as directory:
+		paths = await asyncio.to_thread(pdf.spool, [file.file for file in order_files], directory)
+		try:
+			merged_path = await pdf.merger.merge(paths, directory)
+		except pdf.MergeQueueFull:
+			logger.warning("Too many pdf merges are pending")
+			raise HTTPException(503)
 
-	buffer = io.BytesIO()
-	order_pdf.write(buffer)
-	buffer.seek(0)
-	content = buffer.read()
+		document = await model.Document.aingest(model.DocumentType.PDF, pdf.iter_file(merged_path))
+		document.original_size = total_size
 
 	# Post the order
 
-	document = model.Document(
-		doc_type=model.DocumentType.PDF,
-		content=content
-	)
-
 	session.add(document)
-	session.flush([document])
+	await session.flush([document])
 
 	sender_role_id = user.company.sender_role_id if user.company else user.sender_role_id
 	order = model.Order(did=document.id, sender_role_id=sender_role_id)
 	session.add(order)
-	session.commit()
+	await session.commit()
 
-	logger.info('Order has posted', order=order)
+	logger.info(
+		'Order has posted', order=order,
+		original_size=document.original_size, size=document.size
+	)
 
 	return {"oid": order.id}
 
-@router.get('/orders/requested')
+async def order_board_page(
+	board: model.PageBoard[model.Order],
+	response: Response,
+	page: Optional[int], page_size: int, cursor: Optional[str],
+) -> list[model.Order]:
+	"""Keyset page with the neighbor cursors in the X-Next-Cursor and X-Prev-Cursor headers
+
+	Offset paging is kept as a fallback when a page number is given.
+	"""
+	if page_size > 50: page_size = 50
+	options = model.Order.page_loader_options()
+
+	if page is not None:
+		return await board.apages(page, page_size, model.Order.ordered_time, options=options)
+
+	try:
+		cursor_page = await board.acursor_pages(
+			page_size, model.Order.ordered_time, cursor, options=options
+		)
+	except ValueError:
+		logger.warning("Invalid page cursor", cursor=cursor)
+		raise HTTPException(403)
+
+	if cursor_page.next_cursor:
+		response.headers["X-Next-Cursor"] = cursor_page.next_cursor
+	if cursor_page.prev_cursor:
+		response.headers["X-Prev-Cursor"] = cursor_page.prev_cursor
+	return cursor_page.rows
+
+@router.get('/orders/requested', dependencies=[Depends(dependency.use_replica)])
 async def requested_orders(
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
 	user: Annotated[model.User, Depends(dependency.get_user)],
-	page: int = 1, page_size: int = 10,
+	response: Response, page: Optional[int] = None, page_size: int = 10,
+	cursor: Optional[str] = None,
 ) -> list[OrderInfo]:
-	if page_size > 50: page_size = 50
-
 	condition = model.Order.state == model.OrderStatusEnum.REQUESTED
 	condition &= model.Order.can_user_access(user)
 	board = model.PageBoard(model.Order, condition, session)
 
-	orders = board.pages(page, page_size, model.Order.ordered_time)
+	orders = await order_board_page(board, response, page, page_size, cursor)
 	return [OrderInfo.model_validate(order) for order in orders]
 
-@router.get('/orders/ongoing')
+@router.get('/orders/ongoing', dependencies=[Depends(dependency.use_replica)])
 async def ongoing_orders(
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
 	user: Annotated[model.User, Depends(dependency.get_user)],
 ) -> list[OrderInfo]:
 	condition = model.Order.state == model.OrderStatusEnum.ALLOCATED
@@ -227,77 +380,126 @@ async def ongoing_orders(
 	condition &= model.Order.can_user_access(user)
 	board = model.PageBoard(model.Order, condition, session)
 
-	orders = board.pages(1, board.count, model.Order.ordered_time)
+	orders = await board.arows(
+		model.Order.ordered_time, options=model.Order.page_loader_options()
+	)
 	return [OrderInfo.model_validate(order) for order in orders]
 
-@router.get('/orders/completed')
+@router.get('/orders/completed', dependencies=[Depends(dependency.use_replica)])
 async def completed_orders(
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
 	user: Annotated[model.User, Depends(dependency.get_user)],
-	request: Request, page: int = 1, page_size: int = 10,
+	response: Response, page: Optional[int] = None, page_size: int = 10,
+	cursor: Optional[str] = None,
 ) -> list[OrderInfo]:
-	if page_size > 50: page_size = 50
-
 	condition = model.Order.state == model.OrderStatusEnum.COMPLETED
 	condition &= model.Order.can_user_access(user)
 	board = model.PageBoard(model.Order, condition, session)
 
-	orders = board.pages(1, board.count, model.Order.ordered_time)
+	orders = await order_board_page(board, response, page, page_size, cursor)
+	return [OrderInfo.model_validate(order) for order in orders]
+
+@router.get('/orders/failable', dependencies=[Depends(dependency.use_replica)])
+async def failable_orders(
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
+	user: Annotated[model.User, Depends(dependency.get_user)],
+	response: Response, page: Optional[int] = None, page_size: int = 10,
+	cursor: Optional[str] = None,
+) -> list[OrderInfo]:
+	now = datetime.datetime.now(datetime.timezone.utc)
+	condition = model.Order.failable_condition(now)
+	condition &= model.Order.can_user_access(user)
+	board = model.PageBoard(model.Order, condition, session)
+
+	orders = await order_board_page(board, response, page, page_size, cursor)
 	return [OrderInfo.model_validate(order) for order in orders]
 
 ################################################################################
 # Order Infos
 ################################################################################
 
-@router.get('/orders/by-token/{order_token}')
+@router.get('/orders/by-token/{order_token}', dependencies=[Depends(dependency.use_replica)])
 async def order_item_by_token(
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
 	order_token: str
 ) -> OrderInfo:
 	signer = dependency.order_access_token_signer
 	oid = signer.unsign(order_token.encode())
 	if not oid: raise HTTPException(403)
 
-	order = model.Order.get_or_none(session, oid)
+	order = await model.Order.aget_or_none(session, oid)
 	if not order: raise HTTPException(403)
 	return OrderInfo.model_validate(order)
 
-@router.get("/orders/by-token/{order_token}/document")
+@router.api_route(
+	"/orders/by-token/{order_token}/document", methods=["GET", "HEAD"],
+	dependencies=[Depends(dependency.use_replica)]
+)
 async def document_token_access(
 	request: Request,
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
 	order_token: str
 ) -> Response:
 	signer = dependency.order_access_token_signer
 	oid = signer.unsign(order_token.encode())
 	if not oid: raise HTTPException(403)
 
-	order = model.Order.get_or_none(session, oid)
+	order = await model.Order.aget_or_none(session, oid)
 	if not order: raise HTTPException(403)
 
 	file_format = order.document.doc_type.name.lower()
-	return StreamingResponse(
-		iter([order.document.content]),
-		headers={"content-disposition": f'filename="{oid}.{file_format}"'}
-	)
+	return await utils.document_response(request, session, order.document, f"{oid}.{file_format}")
 
-@router.get('/orders/{oid}')
+@router.get('/orders/{oid}', dependencies=[Depends(dependency.use_replica)])
 async def order_item(
 	order: Annotated[model.Order, Depends(dependency.get_order)],
 ) -> OrderInfo:
 	return OrderInfo.model_validate(order)
 
-@router.get("/orders/{oid}/document")
+@router.api_route(
+	"/orders/{oid}/document", methods=["GET", "HEAD"], dependencies=[Depends(dependency.use_replica)]
+)
 async def document(
-	oid: int, order: Annotated[model.Order, Depends(dependency.get_order)]
+	request: Request,
+	oid: int,
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
+	order: Annotated[model.Order, Depends(dependency.get_order)],
 ) -> Response:
 	file_format = order.document.doc_type.name.lower()
-	return StreamingResponse(
-		iter([order.document.content]),
-		headers={"content-disposition": f'filename="{oid}.{file_format}"'}
-	)
+	return await utils.document_response(request, session, order.document, f"{oid}.{file_format}")
+
+MAX_ROWS_PAGE_SIZE = 1000
 
-@router.get("/orders/{oid}/token")
+@router.get("/orders/{oid}/rows", dependencies=[Depends(dependency.use_replica)])
+async def order_rows(
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
+	order: Annotated[model.Order, Depends(dependency.get_order)],
+	offset: Annotated[int, Query(ge=0)] = 0,
+	limit: Annotated[int, Query(ge=1, le=MAX_ROWS_PAGE_SIZE)] = 100,
+	columns: Annotated[Optional[list[str]], Query()] = None,
+) -> OrderRows:
+	"""A page of the rows of a JSON order, read by the row index instead of the whole document"""
+	document = order.document
+	if document.doc_type != model.DocumentType.JSON:
+		logger.warning("Only JSON order has rows", oid=order.id)
+		raise HTTPException(403)
+
+	size, inline = await document.aget_size(session)
+	content = await document.aread_inline(session, 0, size) if inline else None
+	all_columns, rows, total = await asyncio.to_thread(document.read_rows, offset, limit, size, content)
+
+	if columns:
+		if unknown := [column for column in columns if column not in all_columns]:
+			logger.warning("Unknown columns", oid=order.id, columns=unknown)
+			raise HTTPException(403)
+		indexes = [all_columns.index(column) for column in columns]
+		rows = [[row[index] for index in indexes] for row in rows]
+	else:
+		columns = all_columns
+
+	return OrderRows(columns=columns, rows=rows, offset=offset, total=total)
+
+@router.get("/orders/{oid}/token", dependencies=[Depends(dependency.use_replica)])
 async def get_order_token(
 	request: Request,
 	user: Annotated[model.User, Depends(dependency.get_user)],
@@ -309,7 +511,7 @@ async def get_order_token(
 	else:
 		raise HTTPException(403)
 
-@router.get("/orders/{oid}/contacts")
+@router.get("/orders/{oid}/contacts", dependencies=[Depends(dependency.use_replica)])
 async def get_order_contacts(
 	user: Annotated[model.User, Depends(dependency.get_user)],
 	order: Annotated[model.Order, Depends(dependency.get_order)],
@@ -322,7 +524,7 @@ async def get_order_contacts(
 
 @router.post('/orders/{oid}/contacts')
 async def append_order_contact(
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
 	user: Annotated[model.User, Depends(dependency.get_user)],
 	order: Annotated[model.Order, Depends(dependency.get_order)],
 	contacts: Annotated[list[OrderContactInfo], Body()]
@@ -348,14 +550,14 @@ async def append_order_contact(
 
 	for contact_model in contact_models:
 		session.add(contact_model)
-	session.commit()
+	await session.commit()
 
 	validate = OrderContactInfo.model_validate
 	return [validate(contact_model) for contact_model in contact_models]
 
 @router.patch("/orders/{oid}/contacts/{cid}")
 async def alter_order_contact(
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
 	order: Annotated[model.Order, Depends(dependency.get_order)],
 	order_contact: Annotated[model.OrderContact, Depends(dependency.get_order_contact)],
 	name: Annotated[str, Body()] = "",
@@ -371,13 +573,13 @@ async def alter_order_contact(
 
 	order_contact.name = name
 	order_contact.HP = HP
-	session.commit()
+	await session.commit()
 
 	return Response(status_code=204)
 
 @router.delete("/orders/{oid}/contacts/{cid}")
 async def delete_order_contact(
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
 	order: Annotated[model.Order, Depends(dependency.get_order)],
 	order_contact: Annotated[model.OrderContact, Depends(dependency.get_order_contact)],
 ) -> Response:
@@ -385,8 +587,8 @@ async def delete_order_contact(
 		logger.warning("Cannot change contact for finished order")
 		raise HTTPException(403)
 	
-	session.delete(order_contact)
-	session.commit()
+	await session.delete(order_contact)
+	await session.commit()
 	return Response(status_code=204)
 
 ################################################################################
@@ -395,16 +597,11 @@ async def delete_order_contact(
 
 @router.post('/orders/{oid}/allocate')
 async def allocate_order(
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
 	user: Annotated[model.User, Depends(dependency.get_user)],
-	order: Annotated[model.Order, Depends(dependency.get_order)],
+	order: Annotated[model.Order, Depends(dependency.get_transition_order)],
 	vehicle_id: Annotated[str, Body(embed=True)],
 ) -> Response:
-	# Lock objects
-	
-	user = model.User.get(session, user.id, lock=True)
-	order = model.Order.get(session, order.id, lock=True)
-
 	# Check permission
 
 	if not user.can_modify(order):
@@ -417,51 +614,46 @@ async def allocate_order(
 		logger.warning("Replacing driver is not allowed")
 		raise HTTPException(403)
 
-	get_driver_role = model.DriverRole.get_driver_role_or_none
-	if driver_role := get_driver_role(session, vehicle_id=vehicle_id):
+	get_driver_role = model.DriverRole.aget_driver_role_or_none
+	if driver_role := await get_driver_role(session, vehicle_id=vehicle_id):
 		driver = driver_role.user
 	else:
 		logger.warning("No driver with given vehicle id")
 		raise HTTPException(403)
 
-	if driver.has_deallocated(order):
+	if await driver.ahas_deallocated(session, order):
 		logger.warning("Reallocation is not allowed")
 		raise HTTPException(403)
 
-	# Execute action
-
-	order_action = model.OrderAction(
-		oid=order.id, uid=user.id, action=model.OrderActionEnum.ALLOCATE,
-		description=f"Driver: {driver.id}"
-	)
-	session.add(order_action)
-
-	order.state = model.OrderStatusEnum.ALLOCATED
-	order.driver_role_id = driver_role.id
-
-	session.commit()
-	session.refresh(order)
+	# Execute action, the conditions are checked again against the concurrent transitions
+
+	if not await order.atransition(
+		session, user.id, model.OrderActionEnum.ALLOCATE,
+		[model.OrderStatusEnum.REQUESTED], model.OrderStatusEnum.ALLOCATED,
+		values={"driver_role_id": driver_role.id},
+		conditions=[
+			model.Order.driver_role_id.is_(None), ~driver.has_deallocated_condition(order.id)
+		],
+		description=f"Driver: {driver.id}",
+	):
+		logger.warning("Order has changed by another request")
+		raise HTTPException(403)
 
 	logger.info("Driver has allocated to the order", order=order)
 	return Response(status_code=204)
 
 @router.post('/orders/{oid}/deallocate')
 async def deallocate_order(
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
 	user: Annotated[model.User, Depends(dependency.get_user)],
-	order: Annotated[model.Order, Depends(dependency.get_order)],
+	order: Annotated[model.Order, Depends(dependency.get_transition_order)],
 ) -> Response:
-	# Lock objects
-	
-	user = model.User.get(session, user.id, lock=True)
-	order = model.Order.get(session, order.id, lock=True)
-
 	# Check permission
 
 	if order.state != model.OrderStatusEnum.ALLOCATED:
 		logger.warning("Only Allocated order can be deallocated")
 		raise HTTPException(403)
-	if not user.is_driver:
+	if not user.is_driver or user.driver_role is None:
 		logger.warning("Only driver can deallocate")
 		raise HTTPException(403)
 	if user != order.driver:
@@ -470,26 +662,23 @@ async def deallocate_order(
 
 	# Execute action
 
-	order_action = model.OrderAction(
-		oid=order.id, uid=user.id, action=model.OrderActionEnum.DEALLOCATE
-	)
-	session.add(order_action)
-
-	order.state = model.OrderStatusEnum.REQUESTED
-	order.driver_role_id = None
-
-	session.commit()
-	session.refresh(order)
+	if not await order.atransition(
+		session, user.id, model.OrderActionEnum.DEALLOCATE,
+		[model.OrderStatusEnum.ALLOCATED], model.OrderStatusEnum.REQUESTED,
+		values={"driver_role_id": None},
+		conditions=[model.Order.driver_role_id == user.driver_role.id],
+	):
+		logger.warning("Order has changed by another request")
+		raise HTTPException(403)
 
 	logger.info("Driver has deallocated to the order", order=order)
 	return Response(status_code=204)
 
 @router.post('/orders/{oid}/onboard')
 async def onboard_order(
-	background_tasks: BackgroundTasks,
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
 	user: Annotated[model.User, Depends(dependency.get_user)],
-	order: Annotated[model.Order, Depends(dependency.get_order)],
+	order: Annotated[model.Order, Depends(dependency.get_transition_order)],
 	vender: str
 ) -> Response:
 	# TODO: make permission checking logic into the method
@@ -514,16 +703,16 @@ async def onboard_order(
 
 	vender_enum = model.CertVenderEnum[vender.upper()]
 
-	background_tasks.add_task(background.sign_order,
-		name, HP, birthday, order, purpose, vender_enum
+	await background.request_sign_order(
+		session, name, HP, birthday, order, purpose, vender_enum, original_url
 	)
+	await session.commit()
 	return Response(status_code=204)
 
 
 @router.post('/orders/by-token/{order_token}/outboard')
 async def outboard_order(
-	background_tasks: BackgroundTasks,
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
 	name: Annotated[str, Body()],
 	HP: Annotated[str, Body()],
 	birthday: Annotated[datetime.date, Body()],
@@ -533,7 +722,7 @@ async def outboard_order(
 
 	signer = dependency.order_access_token_signer
 	if oid := signer.unsign(order_token.encode()):
-		order = model.Order.get(session, oid)
+		order = await model.Order.aget(session, oid, options=model.Order.transition_loader_options())
 	else:
 		logger.info("Invalid token")
 		raise HTTPException(403)
@@ -547,7 +736,7 @@ async def outboard_order(
 		logger.error("The order is shipping but sender or driver is not exist", order=order)
 		raise HTTPException(403)
 
-	if not order.get_contact(name, HP, model.OrderContactRole.RECEIVER):
+	if not await order.aget_contact(session, name, HP, model.OrderContactRole.RECEIVER):
 		logger.warning("Invalid order contact", contact_name=name, contact_HP=HP)
 		raise HTTPException(403)
 
@@ -560,22 +749,18 @@ async def outboard_order(
 
 	vender_enum = model.CertVenderEnum[vender.upper()]
 
-	background_tasks.add_task(background.sign_order,
-		name, HP, birthday, order, purpose, vender_enum
+	await background.request_sign_order(
+		session, name, HP, birthday, order, purpose, vender_enum, original_url
 	)
+	await session.commit()
 	return Response(status_code=204)
 
 @router.post('/orders/{oid}/cancel')
 async def cancel_order(
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
 	user: Annotated[model.User, Depends(dependency.get_user)],
-	order: Annotated[model.Order, Depends(dependency.get_order)],
+	order: Annotated[model.Order, Depends(dependency.get_transition_order)],
 ) -> Response:
-	# Lock objects
-
-	user = model.User.get(session, user.id, lock=True)
-	order = model.Order.get(session, order.id, lock=True)
-
 	# Check permission
 
 	Status = model.OrderStatusEnum
@@ -588,31 +773,23 @@ async def cancel_order(
 
 	# Execute action
 
-	order_action = model.OrderAction(
-		oid=order.id, uid=user.id, action=model.OrderActionEnum.CANCEL
-	)
-	session.add(order_action)
-
-	order.state = Status.CANCELED
-	order.driver_role_id = None
-
-	session.commit()
-	session.refresh(order)
+	if not await order.atransition(
+		session, user.id, model.OrderActionEnum.CANCEL,
+		[Status.REQUESTED, Status.ALLOCATED], Status.CANCELED,
+		values={"driver_role_id": None},
+	):
+		logger.warning("Order has changed by another request")
+		raise HTTPException(403)
 
 	logger.info("Order has canceled", order=order)
 	return Response(status_code=204)
 
 @router.post('/orders/{oid}/set-failed')
 async def set_order_failed(
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
 	user: Annotated[model.User, Depends(dependency.get_user)],
-	order: Annotated[model.Order, Depends(dependency.get_order)],
+	order: Annotated[model.Order, Depends(dependency.get_transition_order)],
 ) -> Response:
-	# Lock objects
-
-	user = model.User.get(session, user.id, lock=True)
-	order = model.Order.get(session, order.id, lock=True)
-
 	# Check permission
 
 	if order.state != model.OrderStatusEnum.SHIPPING:
@@ -627,15 +804,14 @@ async def set_order_failed(
 
 	# Execute action
 
-	order_action = model.OrderAction(
-		oid=order.id, uid=user.id, action=model.OrderActionEnum.SET_FAILED
-	)
-	session.add(order_action)
-
-	order.state = model.OrderStatusEnum.FAILED
-
-	session.commit()
-	session.refresh(order)
+	now = datetime.datetime.now(datetime.timezone.utc)
+	if not await order.atransition(
+		session, user.id, model.OrderActionEnum.SET_FAILED,
+		[model.OrderStatusEnum.SHIPPING], model.OrderStatusEnum.FAILED,
+		conditions=[model.Order.failable_condition(now)],
+	):
+		logger.warning("Order has changed by another request")
+		raise HTTPException(403)
 
 	logger.warning("Order has failed", order=order)
 	return Response(status_code=204)
@@ -1,40 +1,50 @@
-from typing import Literal, Optional
-import base64, datetime, enum, structlog, time
+from typing import Any, Awaitable, Callable, Literal, Optional, Sequence
+import asyncio, base64, datetime, functools, structlog
 
 #from asn1crypto import cms
 #from oscrypto import asymmetric
 
-from fastapi import HTTPException
 import sqlalchemy as sa
-from sqlalchemy import orm
+from sqlalchemy.ext.asyncio import AsyncSession
 import barocert
 
 from jhsolution import env, model
-from jhsolution.utils import BarocertService, CertResult
+from jhsolution.utils import BarocertBreaker, BarocertPoller, BarocertService, BarocertUnavailable
 from . import dependency
 
 logger = structlog.get_logger("JHsolution")
 
+barocert_poller = BarocertPoller()
+
 ################################################################################
 # Cert logic
 ################################################################################
 
-def sign_document_hash(
+@functools.cache # once per process, the service keeps its clients, auth token and breaker
+def barocert_service(vender: model.CertVenderEnum) -> BarocertService:
+	vender_name: Literal["kakao", "naver", "pass"]
+	if vender.name == "KAKAO":
+		vender_name, client_code = "kakao", env.BAROCERT_KAKAO_CLIENTCODE
+	elif vender.name == "NAVER":
+		vender_name, client_code = "naver", env.BAROCERT_NAVER_CLIENTCODE
+	elif vender.name == "PASS":
+		vender_name, client_code = "pass", env.BAROCERT_PASS_CLIENTCODE
+
+	expire_in = dependency.pass_access_signer.max_age
+	breaker = BarocertBreaker(
+		env.SIGN_CONCURRENCY, env.SIGN_BREAKER_THRESHOLD, env.SIGN_BREAKER_TIMEOUT, env.SIGN_SLOW_CALL
+	)
+	return BarocertService(
+		vender_name, "Sign", client_code, env.BAROCERT_LINKID,
+		env.BAROCERT_SECRETKEY, env.CALL_CENTER_NUM, expire_in, breaker
+	)
+
+def sign_request_kwargs(
 	name: str, HP: str, birthday: datetime.date,
 	title: str, message: str, sha256token: str,
 	vender: model.CertVenderEnum,
 	original_url: Optional[str] = None
-) -> CertResult:
-	logger = structlog.get_logger("JHsolution")
-	logger = logger.bind(
-		name=name, HP=HP, birthday=birthday,
-		title=title, message=message,
-		sha256token=sha256token,
-	)
-	logger.debug("Sign task has started")
-
-	# Prepare api kwargs
-
+) -> dict[str, Any]:
 	kwargs = {
 		'receiverName':     name,
 		'receiverHP':       HP,
@@ -65,125 +75,278 @@ def sign_document_hash(
 			'originalFormatCode': 'DOWNLOAD_DOCUMENT',
 		}
 
-	# Execute cert request
-
-	vender_name: Literal["kakao", "naver", "pass"]
-	if vender.name == "KAKAO":
-		vender_name, client_code = "kakao", env.BAROCERT_KAKAO_CLIENTCODE
-	elif vender.name == "NAVER":
-		vender_name, client_code = "naver", env.BAROCERT_NAVER_CLIENTCODE
-	elif vender.name == "PASS":
-		vender_name, client_code = "pass", env.BAROCERT_PASS_CLIENTCODE
-
-	expire_in = dependency.pass_access_signer.max_age
-	cert_service = BarocertService(
-		vender_name, "Sign", client_code, env.BAROCERT_LINKID,
-		env.BAROCERT_SECRETKEY, env.CALL_CENTER_NUM, expire_in
-	)
-
-	return cert_service.try_request(**kwargs)
-
-def sign_order(
-	name: str, HP: str, birthday: datetime.date,
-	order: model.Order, purpose: model.SignPurposeEnum,
-	vender: model.CertVenderEnum,
-	original_url: Optional[str] = None,
-) -> None:
-	# TODO: make permission check logic into method
-	# TODO: Lock object on the session block
-
-	# Check permission
-
-	if purpose == model.SignPurposeEnum.CONFIRM_ONBOARD:
-		if order.state != model.OrderStatusEnum.ALLOCATED:
-			logger.warning("Only allocated order can be onboarded")
-			raise HTTPException(403)
-	elif purpose == model.SignPurposeEnum.CONFIRM_OUTBOARD:
-		if order.state != model.OrderStatusEnum.SHIPPING:
-			logger.warning("Only shipping order can be outboarded")
-			raise HTTPException(403)
-
-	# Try to sign the order
+	return kwargs
 
+def sign_request_message(purpose: model.SignPurposeEnum) -> tuple[str, str]:
 	request_title = 'JH솔루션 전자서명 요청'
 	if purpose == model.SignPurposeEnum.CONFIRM_ONBOARD:
 		request_message = "화주의 화물을 상차했음을 확인합니다."
 	elif purpose == model.SignPurposeEnum.CONFIRM_OUTBOARD:
 		request_message = "기사님이 하차를 완료했음을 확인합니다."
-	else:
-		raise HTTPException(403)
 
 	if not env.IS_PRODUCTION:
 		request_title = f"[테스트] {request_title}"
 		request_message= f"[테스트] {request_message}"
 
-	with orm.Session(model.engine) as session:
-		order = model.Order.get(session, order.id)
-		sha256token = base64.urlsafe_b64encode(order.document.sha256).decode('utf-8')
+	return request_title, request_message
 
-	try:
-		cert_result_response = sign_document_hash(
-			name, HP, birthday,
-			request_title, request_message,
-			sha256token, vender, original_url
+# Order state before and after the sign of each purpose
+SIGN_TRANSITIONS = {
+	model.SignPurposeEnum.CONFIRM_ONBOARD: (
+		model.OrderStatusEnum.ALLOCATED, model.OrderStatusEnum.SHIPPING, model.OrderActionEnum.ONBOARD
+	),
+	model.SignPurposeEnum.CONFIRM_OUTBOARD: (
+		model.OrderStatusEnum.SHIPPING, model.OrderStatusEnum.COMPLETED, model.OrderActionEnum.OUTBOARD
+	),
+}
 
+SIGN_ORDER_JOB = "sign_order"
+
+async def request_sign_order(
+	session: AsyncSession,
+	name: str, HP: str, birthday: datetime.date,
+	order: model.Order, purpose: model.SignPurposeEnum,
+	vender: model.CertVenderEnum,
+	original_url: Optional[str] = None,
+) -> model.CertResult:
+	"""Record the cert result on standby and queue the job signing the order, the caller commits"""
+	cert_result = model.CertResult(state=model.CertStateEnum.STANDBY, vender=vender)
+	session.add(cert_result)
+	await session.flush([cert_result])
+
+	session.add(model.Job(kind=SIGN_ORDER_JOB, payload={
+		"cert_result_id": cert_result.id, "oid": order.id, "purpose": purpose.name,
+		"name": name, "HP": HP, "birthday": birthday.isoformat(), "original_url": original_url,
+	}))
+	return cert_result
+
+async def sign_order(payload: dict[str, Any]) -> None:
+	"""Job of SIGN_ORDER_JOB
+
+	The receipt is saved once requested, so the job retried after a stopped worker waits
+	for the same receipt instead of requesting the receiver to sign again. Barocert errors
+	fail the cert result, other errors are retried with the job.
+
+	Each call to the vender is admitted by the breaker of the vender, so a vender being
+	slow or down holds no more than its share of the calls, while the receivers signing
+	hold none. While its circuit is open the new requests fail at once at the ADMISSION
+	stage and the jobs whose receipt is requested are deferred.
+	"""
+	purpose = model.SignPurposeEnum[payload["purpose"]]
+	state, next_state, action = SIGN_TRANSITIONS[purpose]
+
+	async with AsyncSession(model.async_engine, expire_on_commit=False) as session:
+		cert_result = await model.CertResult.aget(session, payload["cert_result_id"])
+		options = model.Order.transition_loader_options()
+		order = await model.Order.aget(session, payload["oid"], options=options)
+		if cert_result.state != model.CertStateEnum.STANDBY: return
+
+		logger = structlog.get_logger("JHsolution").bind(
+			oid=order.id, cert_result_id=cert_result.id, purpose=purpose.name
 		)
 
-		StateEnum = model.CertStateEnum
-		state_code_to_state = [
-			StateEnum.STANDBY,
-			StateEnum.COMPLETED,
-			StateEnum.EXPIRED,
-			StateEnum.FAILED,
-			StateEnum.FAILED,
-			StateEnum.FAILED,
-		]
+		# Check permission
 
-		try:
-			state = state_code_to_state[cert_result_response.state]
-		except:
-			state = StateEnum.FAILED
-
-		cert_result = model.CertResult(
-			state=state,
-			vender=vender,
-			receipt_id=cert_result_response.receiptID,
-			signed_data=cert_result_response.signedData
-		)
-	except barocert.BarocertException as be:
-		logger.warning(
-			"Failed to sign the order",
-			error_code=be.code, error_message=be.message
-		)
-		cert_result = model.CertResult(
-			state=model.CertStateEnum.FAILED,
-			error_code=be.code, error_message=be.message
+		if order.state != state:
+			logger.warning("Order has changed before signing")
+			cert_result.state = model.CertStateEnum.FAILED
+			cert_result.error_message = "Order has changed"
+			await session.commit()
+			return
+
+		# Try to sign the order
+
+		sha256 = await session.scalar(
+			sa.select(model.Document.sha256).where(model.Document.id == order.did)
 		)
+		assert sha256 is not None
+		sha256token = base64.urlsafe_b64encode(sha256).decode('utf-8')
 
-	# Save results into the database
+		request_title, request_message = sign_request_message(purpose)
+		kwargs = sign_request_kwargs(
+			payload["name"], payload["HP"], datetime.date.fromisoformat(payload["birthday"]),
+			request_title, request_message, sha256token, cert_result.vender, payload["original_url"]
+		)
+		# The reads above leave a transaction open, which must not hold the connection for minutes
+		await session.commit()
 
-	with orm.Session(model.engine) as session:
-		session.add(cert_result)
+		cert_service = barocert_service(cert_result.vender)
+		stage = model.CertErrorStageEnum.REQUEST
+		try:
+			# Only the requests run on threads, waiting for the receiver holds none
+
+			if cert_result.receipt_id is None:
+				logger.debug("Sign task has started")
+				response = await asyncio.to_thread(cert_service.request, **kwargs)
+				cert_result.receipt_id = response.receiptID
+				await session.commit()
+
+			stage = model.CertErrorStageEnum.GET_STATUS
+			status = await barocert_poller.wait(cert_service, cert_result.receipt_id)
+			stage = model.CertErrorStageEnum.VERIFY
+			cert_result_response = await asyncio.to_thread(
+				cert_service.result, cert_result.receipt_id, status, **kwargs
+			)
+
+			StateEnum = model.CertStateEnum
+			state_code_to_state = [
+				StateEnum.STANDBY,
+				StateEnum.COMPLETED,
+				StateEnum.EXPIRED,
+				StateEnum.FAILED,
+				StateEnum.FAILED,
+				StateEnum.FAILED,
+			]
+
+			try:
+				cert_result.state = state_code_to_state[cert_result_response.state]
+			except:
+				cert_result.state = StateEnum.FAILED
+			cert_result.signed_data = cert_result_response.signedData
+		except BarocertUnavailable as e:
+			if e.admission == "open" and cert_result.receipt_id is None:
+				logger.warning("Vender is unavailable")
+				cert_result.state = model.CertStateEnum.FAILED
+				cert_result.error_stage = model.CertErrorStageEnum.ADMISSION
+				cert_result.error_message = "Vender is unavailable"
+				await session.commit()
+				return
+
+			# Leave the job slot to the other venders, the requested receipt is waited for later
+			delay = cert_service.breaker.reset_timeout if e.admission == "open" else 1
+			raise JobDeferred(datetime.timedelta(seconds=delay))
+		except barocert.BarocertException as be:
+			logger.warning(
+				"Failed to sign the order",
+				error_code=be.code, error_message=be.message
+			)
+			cert_result.state = model.CertStateEnum.FAILED
+			cert_result.error_stage = stage
+			cert_result.error_code, cert_result.error_message = be.code, be.message
+
+		# Save results into the database
 
 		if cert_result.state == model.CertStateEnum.COMPLETED:
-			logger.info("Sign has completed")
-			session.flush([cert_result])
-			signature = model.Signature(did=order.did, cert_result_id=cert_result.id)
-			session.add(signature)
-
-			order = model.Order.get(session, order.id)
-			action = model.OrderAction(oid=order.id)
-			session.add(action)
-
-			if purpose == model.SignPurposeEnum.CONFIRM_ONBOARD:
-				action.action = model.OrderActionEnum.ONBOARD
-				order.state = model.OrderStatusEnum.SHIPPING
-			elif purpose == model.SignPurposeEnum.CONFIRM_OUTBOARD:
-				action.action = model.OrderActionEnum.OUTBOARD
-				order.state = model.OrderStatusEnum.COMPLETED
-
+			# The order is moved only if it has not changed while the receiver was signing
+			values: dict[str, Any] = {"state": next_state}
+			if next_state == model.OrderStatusEnum.SHIPPING:
+				values["shipped_time"] = sa.func.now() # as the timestamp of the action
+			moved = (await session.execute(
+				sa.update(model.Order).where(model.Order.id == order.id, model.Order.state == state)
+				.values(**values).returning(model.Order.id)
+				.execution_options(synchronize_session=False)
+			)).first() is not None
+
+			if moved:
+				logger.info("Sign has completed")
+				session.add(model.Signature(did=order.did, cert_result_id=cert_result.id))
+				session.add(model.OrderAction(oid=order.id, action=action))
+			else:
+				logger.warning("Order has changed while signing")
+				cert_result.state = model.CertStateEnum.FAILED
+				cert_result.error_message = "Order has changed"
 		else:
 			logger.warning("Sign has failed")
-			signature = None
 
-		session.commit()
+		await session.commit()
+
+async def fail_sign_order(session: AsyncSession, payload: dict[str, Any], error: str) -> None:
+	"""Fail the cert result of a SIGN_ORDER_JOB which has failed its last attempt"""
+	cert_result = await model.CertResult.aget(session, payload["cert_result_id"])
+	if cert_result.state != model.CertStateEnum.STANDBY: return
+
+	logger.warning("Sign has failed with its job", cert_result_id=cert_result.id)
+	cert_result.state = model.CertStateEnum.FAILED
+	cert_result.error_stage = (
+		model.CertErrorStageEnum.REQUEST if cert_result.receipt_id is None
+		else model.CertErrorStageEnum.GET_STATUS
+	)
+	cert_result.error_message = f"Job has failed: {error}"
+
+################################################################################
+# Job worker
+################################################################################
+
+class JobDeferred(Exception):
+	"""Raised by a job handler to run the job again after the delay"""
+	def __init__(self, delay: datetime.timedelta):
+		self.delay = delay
+
+JobHandler = Callable[[dict[str, Any]], Awaitable[None]]
+job_handlers: dict[str, JobHandler] = {SIGN_ORDER_JOB: sign_order}
+
+# Run in the transaction failing a job after its last attempt, with the payload and the error
+JobFailureHandler = Callable[[AsyncSession, dict[str, Any], str], Awaitable[None]]
+job_failure_handlers: dict[str, JobFailureHandler] = {SIGN_ORDER_JOB: fail_sign_order}
+
+async def run_job(job: model.Job) -> None:
+	error, delay = None, None
+	try:
+		await job_handlers[job.kind](job.payload)
+	except JobDeferred as e:
+		delay = e.delay
+	except Exception as e:
+		logger.error("Job has failed", job=job, exc_info=e)
+		error = repr(e)
+
+	async with AsyncSession(model.async_engine, expire_on_commit=False) as session:
+		job = await model.Job.aget(session, job.id)
+		now = datetime.datetime.now(datetime.timezone.utc)
+		if delay is not None:
+			job.defer(delay, now)
+		elif error is not None:
+			job.retry(error, now)
+			if job.state == model.JobStateEnum.FAILED and job.kind in job_failure_handlers:
+				await job_failure_handlers[job.kind](session, job.payload, error)
+		else:
+			job.finish()
+		await session.commit()
+
+async def run_jobs(concurrency: int, poll_interval: float = 1, until_idle: bool = False) -> None:
+	"""Claim the due jobs and run them, at most concurrency of them at once
+
+	Runs forever unless until_idle, then it returns once no job is due or running.
+	"""
+	running: set[asyncio.Task[None]] = set()
+	while True:
+		jobs: Sequence[model.Job] = []
+		if len(running) < concurrency:
+			try:
+				async with AsyncSession(model.async_engine, expire_on_commit=False) as session:
+					now = datetime.datetime.now(datetime.timezone.utc)
+					jobs = await model.Job.aclaim(session, list(job_handlers), concurrency - len(running), now)
+			except Exception as e:
+				logger.error("Failed to claim the jobs", exc_info=e)
+
+		for job in jobs:
+			task = asyncio.create_task(run_job(job))
+			running.add(task)
+			task.add_done_callback(running.discard)
+
+		if until_idle and not jobs and not running: return
+		if jobs and len(running) < concurrency: continue
+
+		# Claim again when a job finishes or after the poll interval
+		if running:
+			await asyncio.wait(running, timeout=poll_interval, return_when=asyncio.FIRST_COMPLETED)
+		else:
+			await asyncio.sleep(poll_interval)
+
+################################################################################
+# Failable order sweeper
+################################################################################
+
+async def sweep_failable_orders(interval: float, batch_size: int = 100) -> None:
+	"""Fail the orders shipping for model.FAILABLE_AFTER or longer every interval seconds"""
+	while True:
+		try:
+			async with AsyncSession(model.async_engine, expire_on_commit=False) as session:
+				now = datetime.datetime.now(datetime.timezone.utc)
+				count = await model.Order.afail_failable(
+					session, now, batch_size, description="Failed by the sweeper"
+				)
+			if count: logger.warning(f"{count} failable orders have failed")
+		except Exception as e:
+			# The next sweep retries the orders left shipping
+			logger.error("Failed to sweep the failable orders", exc_info=e)
+		await asyncio.sleep(interval)
@@ -1,5 +1,5 @@
 from __future__ import annotations
-from typing import Annotated, Any, Optional, Type
+from typing import Annotated, Any, AsyncIterator, Optional, Type
 import base64, datetime, requests, structlog, urllib.parse
 
 from fastapi import BackgroundTasks, Depends, HTTPException, Request, UploadFile, WebSocket
@@ -7,6 +7,7 @@ from fastapi.security.utils import get_authorization_scheme_param
 
 import sqlalchemy as sa
 from sqlalchemy import orm
+from sqlalchemy.ext.asyncio import AsyncSession
 from jhsolution import model, utils
 
 MINUTES = 60
@@ -26,35 +27,69 @@ car365_api_signer = utils.TokenSigner('car365', 5 * MINUTES)
 # ORM Dependencies
 ################################################################################
 
-async def get_db_session(request: Request) -> orm.Session:
-	session: orm.Session = request.scope["database_session"]
-	return session
+async def get_db_session() -> AsyncIterator[AsyncSession]:
+	# The session exists only for the handlers using the database, and it is declared with
+	# scope="function" so its connection goes back to the pool when the handler returns,
+	# before the response is sent
+	async with AsyncSession(
+		model.async_engine, expire_on_commit=False, sync_session_class=model.RoutingSession
+	) as session:
+		yield session
 
-async def get_user(
+async def use_replica(
 	request: Request,
-	session: Annotated[orm.Session, Depends(get_db_session)]
-) -> model.User:
+	session: Annotated[AsyncSession, Depends(get_db_session, scope="function")],
+) -> None:
+	"""Route the reads of a read-only handler to a replica, declared in its route dependencies
+
+	The user stays on the primary for a while after writing to see the own writes.
+	"""
+	if not model.replicas.engines: return
+
+	uid = get_uid(request)
+	lag_tolerance = model.replicas.lag_tolerance
+	if uid is not None and await model.UserWrite.ahas_recent_write(session, uid, lag_tolerance):
+		return
+	# Give the primary connection back, the reads of the handler go to the replica
+	await session.rollback()
+
+	for replica in model.replicas.candidates():
+		try:
+			await session.connection(bind_arguments={"bind": replica.sync_engine})
+		except (sa.exc.DBAPIError, OSError):
+			logger.warning("Replica is not available", replica=replica.url.render_as_string())
+			model.replicas.mark_failed(replica)
+			await session.rollback()
+			continue
+
+		session.info["replica"] = replica.sync_engine
+		return
+
+def get_uid(request: Request) -> Optional[int]:
 	authorization = request.headers.get("Authorization")
 	scheme, param = get_authorization_scheme_param(authorization)
 
 	if authorization and scheme.lower() == 'bearer':
-		uid = api_access_token_signer.unsign(param.encode()) # Header token
+		uid: Optional[int] = api_access_token_signer.unsign(param.encode()) # Header token
 	else:
 		uid = request.session.get('uid', None) # Cookie token
+	return uid
+
+async def get_user(
+	request: Request,
+	session: Annotated[AsyncSession, Depends(get_db_session, scope="function")]
+) -> model.User:
+	uid = get_uid(request)
 
-	if user := model.User.get_or_none(session, uid):
+	if uid is not None and (user := await model.User.aget_or_none(session, uid)):
 		structlog.contextvars.bind_contextvars(user=user)
+		session.info["uid"] = user.id
 		return user
 	else:
 		logger.warning("Failed to unsign the token")
 		raise HTTPException(401)
 
-async def get_order(
-	session: Annotated[orm.Session, Depends(get_db_session)],
-	user: Annotated[model.User, Depends(get_user)],
-	oid: int,
-) -> model.Order:
-	order = model.Order.get_or_none(session, oid)
+def check_order_access(user: model.User, order: Optional[model.Order], oid: int) -> model.Order:
 	if order and user.can_access(order):
 		structlog.contextvars.bind_contextvars(order=order)
 		return order
@@ -62,8 +97,26 @@ async def get_order(
 	logger.warning("Given order is not exist or user have no permission", oid=oid)
 	raise HTTPException(403)
 
+async def get_order(
+	session: Annotated[AsyncSession, Depends(get_db_session, scope="function")],
+	user: Annotated[model.User, Depends(get_user)],
+	oid: int,
+) -> model.Order:
+	order = await model.Order.aget_or_none(session, oid)
+	return check_order_access(user, order, oid)
+
+async def get_transition_order(
+	session: Annotated[AsyncSession, Depends(get_db_session, scope="function")],
+	user: Annotated[model.User, Depends(get_user)],
+	oid: int,
+) -> model.Order:
+	"""Same as get_order without the actions and the contacts of the order"""
+	options = model.Order.transition_loader_options()
+	order = await model.Order.aget_or_none(session, oid, options=options)
+	return check_order_access(user, order, oid)
+
 async def get_order_contact(
-	session: Annotated[orm.Session, Depends(get_db_session)],
+	session: Annotated[AsyncSession, Depends(get_db_session, scope="function")],
 	user: Annotated[model.User, Depends(get_user)],
 	order: Annotated[model.Order, Depends(get_order)],
 	cid: int,
@@ -71,7 +124,7 @@ async def get_order_contact(
 	logger = structlog.get_logger("JHsolution")
 	logger = logger.bind(cid=cid)
 
-	order_contact = model.OrderContact.get_or_none(session, cid)
+	order_contact = await model.OrderContact.aget_or_none(session, cid)
 
 	if not user.can_modify(order):
 		logger.warning("Access on order contact is allowed only for sender")
@@ -92,7 +145,7 @@ async def get_order_contact(
 
 async def google_redirect_token_to_user( # pragma: no cover
 	request: Request,
-	session: Annotated[orm.Session, Depends(get_db_session)],
+	session: Annotated[AsyncSession, Depends(get_db_session, scope="function")],
 ) -> model.User:
 	try:
 		google_token = await google_authenticator.auth_token(request)
@@ -101,7 +154,9 @@ async def google_redirect_token_to_user( # pragma: no cover
 		raise HTTPException(401)
 
 	try:
-		return utils.google_userinfo_to_user(session, google_token['userinfo'])
+		return await session.run_sync(
+			utils.google_userinfo_to_user, google_token['userinfo']
+		)
 	except:
 		logger.error(
 			"Failed to parse information from the google",
@@ -110,7 +165,7 @@ async def google_redirect_token_to_user( # pragma: no cover
 		raise HTTPException(500)
 
 async def google_access_token_to_user( # pragma: no cover
-	session: Annotated[orm.Session, Depends(get_db_session)],
+	session: Annotated[AsyncSession, Depends(get_db_session, scope="function")],
 	token: str,
 ) -> model.User:
 	response = google_authenticator.request_auth_token(token)
@@ -120,6 +175,6 @@ async def google_access_token_to_user( # pragma: no cover
 		raise HTTPException(response.status_code)
 
 	try:
-		return utils.google_userinfo_to_user(session, response.json() )
+		return await session.run_sync(utils.google_userinfo_to_user, response.json())
 	except:
 		raise HTTPException(500)
@@ -3,11 +3,11 @@ import base64, structlog
 
 from fastapi import APIRouter, Depends, HTTPException, Request, Response
 
-from fastapi.responses import StreamingResponse
 from fastapi.templating import Jinja2Templates
 
 import sqlalchemy as sa
 from sqlalchemy import orm
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from jhsolution import model, utils
 from . import dependency
@@ -19,7 +19,7 @@ logger = structlog.get_logger("JHsolution")
 @router.get("/verify_email/{token_str}")
 async def verify_email(
 	token_str: str, request: Request,
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
 ) -> Response:
 	try:
 		token = base64.urlsafe_b64decode(token_str)
@@ -28,10 +28,10 @@ async def verify_email(
 		logger.warning("Failed to verify email")
 		raise HTTPException(401)
 
-	if user := model.User.get_user_or_none(session, email=email_address):
+	if user := await model.User.aget_user_or_none(session, email=email_address):
 		logger.info("Create a new user", user=user, login_method="email")
 		user.auth.has_email_verified = True
-		session.commit()
+		await session.commit()
 	else:
 		logger.fatal(
 			"Email has verified, but the user with given email does not exist!!! "
@@ -42,16 +42,18 @@ async def verify_email(
 
 	return templates.TemplateResponse(request, "auth/verified.jinja")
 
-@router.get("/doc/{token}")
+@router.api_route(
+	"/doc/{token}", methods=["GET", "HEAD"], dependencies=[Depends(dependency.use_replica)]
+)
 async def pass_document_view(
 	request: Request,
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
 	user: Annotated[model.User, Depends(dependency.get_user)],
 	token: str,
 ) -> Response:
 	did = dependency.pass_access_signer.unsign(token.encode())
 
-	if document := model.Document.get_or_none(session, did):
-		return StreamingResponse(iter([document.content]))
+	if document := await model.Document.aget_or_none(session, did):
+		return await utils.document_response(request, session, document)
 	else:
 		raise HTTPException(403)
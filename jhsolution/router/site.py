@@ -7,6 +7,7 @@ from fastapi.templating import Jinja2Templates
 
 import sqlalchemy as sa
 from sqlalchemy import orm
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from jhsolution import env, model, utils
 from . import dependency
@@ -26,18 +27,19 @@ def favicon() -> Response:
 @router.get('/')
 async def index(
 	request: Request,
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
 ) -> Response:
-	user = model.User.get_or_none(session, request.session.get('uid', None))
+	user = await model.User.aget_or_none(session, request.session.get('uid', None))
 	return templates.TemplateResponse(request, "index.jinja", {
 		'user': user, "test_mode": not env.IS_PRODUCTION
 	})
 
 @router.get('/terms')
 async def term(
-	request: Request, session: Annotated[orm.Session, Depends(dependency.get_db_session)]
+	request: Request,
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")]
 ) -> Response:
-	user = model.User.get_or_none(session, request.session.get('uid', None))
+	user = await model.User.aget_or_none(session, request.session.get('uid', None))
 	return templates.TemplateResponse(request, "terms/term.jinja", {'user': user})
 
 ################################################################################
@@ -47,10 +49,10 @@ async def term(
 @router.get("/login")
 async def login(
 	request: Request,
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
 	status: Optional[str] = None
 ) -> Response:
-	if model.User.get_or_none(session, request.session.get('uid', None)):
+	if await model.User.aget_or_none(session, request.session.get('uid', None)):
 		return RedirectResponse("/")
 	return templates.TemplateResponse(request, "auth/login.jinja", {'status': status})
 
@@ -62,9 +64,9 @@ async def logout(request: Request) -> Response:
 @router.get("/register")
 async def register(
 	request: Request,
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
 ) -> Response:
-	if model.User.get_or_none(session, request.session.get('uid', None)):
+	if await model.User.aget_or_none(session, request.session.get('uid', None)):
 		return RedirectResponse("/")
 	return templates.TemplateResponse(request, "auth/register.jinja")
 
@@ -88,16 +90,16 @@ async def post_register(
 @router.post('/login/password')
 async def password_login(
 	request: Request,
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
 	email_or_HP: Annotated[str, Form()],
 	password: Annotated[str, Form()],
 ) -> Response:
 	user: Optional[model.User] = None
-	get_user = model.User.get_user_or_none
+	get_user = model.User.aget_user_or_none
 
-	if not user: user = get_user(session, HP=email_or_HP)
+	if not user: user = await get_user(session, HP=email_or_HP)
 	if user and not user.has_verified: user = None
-	if not user: user = get_user(session, email=email_or_HP)
+	if not user: user = await get_user(session, email=email_or_HP)
 	if user and not user.has_verified: user = None
 
 	if user and user.has_valid_password(password):
@@ -118,7 +120,7 @@ async def google_auth(request: Request,
 	request.session['uid'] = user.id
 	return RedirectResponse('/', status_code=302)
 
-@router.get('/account')
+@router.get('/account', dependencies=[Depends(dependency.use_replica)])
 async def get_change_userinfo(
 	request: Request,
 	user: Annotated[model.User, Depends(dependency.get_user)],
@@ -136,10 +138,10 @@ async def publish_order(
 ) -> Response:
 	return templates.TemplateResponse(request, "order/publish.jinja", {"user": user})
 
-@router.get('/orders/requested')
+@router.get('/orders/requested', dependencies=[Depends(dependency.use_replica)])
 async def requested_orders(
 	request: Request,
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
 	user: Annotated[model.User, Depends(dependency.get_user)],
 	page: int = 1, page_size: int = 10,
 ) -> Response:
@@ -149,8 +151,10 @@ async def requested_orders(
 	condition &= model.Order.can_user_access(user)
 	board = model.PageBoard(model.Order, condition, session)
 
-	orders = board.pages(page, page_size, model.Order.ordered_time)
-	num_pages = utils.num_pages(board.count, page_size)
+	orders, count = await board.apages_with_count(
+		page, page_size, model.Order.ordered_time, options=model.Order.page_loader_options()
+	)
+	num_pages = utils.num_pages(count, page_size)
 
 	return templates.TemplateResponse(request, "order/page.jinja", {
 		'user': user, 'orders': orders, 'page_type': 'requested',
@@ -158,28 +162,30 @@ async def requested_orders(
 		'timedelta': datetime.timedelta(hours=9),
 	})
 
-@router.get('/orders/ongoing')
+@router.get('/orders/ongoing', dependencies=[Depends(dependency.use_replica)])
 async def ongoing_orders(
 	request: Request,
 	user: Annotated[model.User, Depends(dependency.get_user)],
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
 ) -> Response:
 	condition = model.Order.state == model.OrderStatusEnum.ALLOCATED
 	condition |= model.Order.state == model.OrderStatusEnum.SHIPPING
 	condition &= model.Order.can_user_access(user)
 	board = model.PageBoard(model.Order, condition, session)
 
-	orders = board.pages(1, board.count, model.Order.ordered_time)
+	orders = await board.arows(
+		model.Order.ordered_time, options=model.Order.page_loader_options()
+	)
 
 	return templates.TemplateResponse(request, "order/page.jinja", {
 		'user': user, 'orders': orders, 'page_type': 'ongoing',
 		'timedelta': datetime.timedelta(hours=9),
 	})
 
-@router.get('/orders/completed')
+@router.get('/orders/completed', dependencies=[Depends(dependency.use_replica)])
 async def completed_orders(
 	request: Request,
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
 	user: Annotated[model.User, Depends(dependency.get_user)],
 	page: int = 1, page_size: int = 10,
 ) -> Response:
@@ -189,8 +195,10 @@ async def completed_orders(
 	condition &= model.Order.can_user_access(user)
 	board = model.PageBoard(model.Order, condition, session)
 
-	orders = board.pages(page, page_size, model.Order.ordered_time)
-	num_pages = utils.num_pages(board.count, page_size)
+	orders, count = await board.apages_with_count(
+		page, page_size, model.Order.ordered_time, options=model.Order.page_loader_options()
+	)
+	num_pages = utils.num_pages(count, page_size)
 
 	return templates.TemplateResponse(request, "order/page.jinja", {
 		'user': user, 'orders': orders, 'page_type': 'completed',
@@ -198,24 +206,24 @@ async def completed_orders(
 		'timedelta': datetime.timedelta(hours=9),
 	})
 
-@router.get("/orders/by-token/{order_token}")
+@router.get("/orders/by-token/{order_token}", dependencies=[Depends(dependency.use_replica)])
 async def external_order_view(
 	request: Request,
-	session: Annotated[orm.Session, Depends(dependency.get_db_session)],
+	session: Annotated[AsyncSession, Depends(dependency.get_db_session, scope="function")],
 	order_token: str
 ) -> Response:
 	signer = dependency.order_access_token_signer
 	oid = signer.unsign(order_token.encode())
 	if not oid: raise HTTPException(403)
 
-	order = model.Order.get_or_none(session, oid)
+	order = await model.Order.aget_or_none(session, oid)
 	if not order: raise HTTPException(403)
 
 	return templates.TemplateResponse(request, "order/viewer.jinja", {
 		'order': order, 'token': order_token
 	})
 
-@router.get('/orders/{oid}')
+@router.get('/orders/{oid}', dependencies=[Depends(dependency.use_replica)])
 async def order_view(
 	request: Request,
 	user: Annotated[model.User, Depends(dependency.get_user)],
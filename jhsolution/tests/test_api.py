@@ -1,18 +1,20 @@
-from typing import Any, Awaitable, Callable, Optional
+from typing import Annotated, Any, AsyncIterator, Awaitable, Callable, Iterator, Optional
 from types import SimpleNamespace
-import datetime, httpx, pathlib, pytest, structlog, time
+import asyncio, contextlib, datetime, functools, hashlib, httpx, io, json, pathlib, pypdf, pytest, structlog, time
 
-from fastapi import BackgroundTasks, FastAPI, HTTPException, Request, Response
+from fastapi import Depends, FastAPI, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
 from fastapi.testclient import TestClient
 
 import sqlalchemy as sa
 from sqlalchemy import orm
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 
 import barocert
 
-from jhsolution import model, router, utils
+from jhsolution import model, pdf, router, utils
 from jhsolution.main import logging_middleware
-from jhsolution.router import dependency
+from jhsolution.router import background, dependency
 
 logger = structlog.get_logger("JHsolution")
 
@@ -36,7 +38,10 @@ class TestAPI:
 
 	@pytest.mark.dependency(
 		scope="session", name="TestAPI",
-		depends=["test_user_auth", "test_document_posting", "test_order_flow"]
+		depends=[
+			"test_user_auth", "test_document_posting", "test_bulk_posting", "test_document_download", "test_order_rows", "test_order_flow",
+			"test_query_count", "test_session_release", "test_replica_routing", "test_order_transition"
+		]
 	)
 	def test_end_dummy(self) -> None: pass
 
@@ -78,6 +83,153 @@ class TestAPI:
 		response = client.get("/account", headers=headers)
 		assert response.status_code != 200
 
+	################################################################################
+	# Query count test
+	################################################################################
+
+	@contextlib.contextmanager
+	def count_queries(self) -> Iterator[list[str]]:
+		statements: list[str] = []
+
+		def before_cursor_execute(conn: Any, cursor: Any, statement: str, *args: Any) -> None:
+			statements.append(statement)
+
+		engine = model.async_engine.sync_engine
+		sa.event.listen(engine, "before_cursor_execute", before_cursor_execute)
+		try:
+			yield statements
+		finally:
+			sa.event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+	@pytest.mark.dependency(
+		scope="session", name="test_query_count", depends=["test_user_auth"]
+	)
+	def test_query_count(
+		self, driver: model.User, sender: model.User, member: model.User, order: model.Order
+	) -> None:
+		# The user graph is loaded by one query, pages by one more and an order
+		# by one joined query with a query for each of contacts and actions
+		expected = {
+			"/account": 1,
+			"/orders/requested": 2,
+			"/orders/ongoing": 2,
+			"/orders/completed": 2,
+			"/orders/failable": 2,
+			f"/orders/{order.id}": 4,
+			f"/orders/{order.id}/contacts": 4,
+			f"/orders/{order.id}/document": 5,
+		}
+
+		for user in [driver, sender, member]:
+			for url, num_queries in expected.items():
+				if user != sender and url.startswith(f"/orders/{order.id}"): continue
+
+				with self.count_queries() as statements:
+					response = client.get(url, headers=self.user_access_header(user))
+				assert response.status_code == 200, url
+				assert len(statements) == num_queries, (url, statements)
+
+	@pytest.mark.dependency(
+		scope="session", name="test_session_release", depends=["test_user_auth"]
+	)
+	def test_session_release(self, driver: model.User) -> None:
+		events: list[str] = []
+
+		def checkout(*args: Any) -> None: events.append("checkout")
+		def checkin(*args: Any) -> None: events.append("checkin")
+
+		pool = model.async_engine.sync_engine.pool
+		sa.event.listen(pool, "checkout", checkout)
+		sa.event.listen(pool, "checkin", checkin)
+
+		@app.get("/test-session-release")
+		async def handler(
+			user: Annotated[model.User, Depends(dependency.get_user)]
+		) -> Response:
+			async def body() -> AsyncIterator[bytes]:
+				events.append("body")
+				yield b""
+			return StreamingResponse(body())
+
+		try:
+			# Requests without the database never open a session
+			assert client.get("/not-found").status_code == 404
+			assert events == []
+
+			# The connection goes back before the response body is sent
+			headers = self.user_access_header(driver)
+			assert client.get("/test-session-release", headers=headers).status_code == 200
+			assert events == ["checkout", "checkin", "body"]
+		finally:
+			sa.event.remove(pool, "checkout", checkout)
+			sa.event.remove(pool, "checkin", checkin)
+
+	@pytest.mark.dependency(
+		scope="session", name="test_replica_routing", depends=["test_user_auth"]
+	)
+	def test_replica_routing(
+		self, session: orm.Session, sender: model.User, monkeypatch: pytest.MonkeyPatch
+	) -> None:
+		headers = self.user_access_header(sender)
+		def last_write() -> Optional[model.UserWrite]:
+			session.expire_all()
+			stmt = sa.select(model.UserWrite).where(model.UserWrite.uid == sender.id)
+			return session.scalars(stmt).one_or_none()
+
+		# Without replicas the writes of a user are not recorded
+
+		response = client.post("/account", headers=headers, json={"company_name": "name"})
+		assert response.status_code // 100 == 2
+		assert last_write() is None
+
+		# The replica is the test database itself, the failed one cannot be opened
+		database_url = model.async_engine.url
+		replica = create_async_engine(database_url, poolclass=sa.pool.NullPool)
+		failed = create_async_engine(
+			database_url.set(database="/nonexistent/replica.sqlite3"), poolclass=sa.pool.NullPool
+		)
+		replicas = model.ReplicaSet([failed, replica], lag_tolerance=60)
+		monkeypatch.setattr(model, "replicas", replicas)
+
+		statements: dict[str, list[str]] = {"primary": [], "replica": []}
+		def listener(name: str) -> Callable[..., None]:
+			def before_cursor_execute(conn: Any, cursor: Any, statement: str, *args: Any) -> None:
+				statements[name].append(statement)
+			return before_cursor_execute
+
+		engines = {"primary": model.async_engine.sync_engine, "replica": replica.sync_engine}
+		listeners = {name: listener(name) for name in engines}
+		for name, engine in engines.items():
+			sa.event.listen(engine, "before_cursor_execute", listeners[name])
+
+		try:
+			# Read-only handlers read from a healthy replica
+
+			assert client.get("/orders/requested", headers=headers).status_code == 200
+			assert failed in replicas.failed_until
+			assert len(statements["primary"]) == 1 # The last write time of the user
+			assert len(statements["replica"]) == 2
+
+			# Writes go to the primary and the writer reads from the primary for a while
+
+			response = client.post("/account", headers=headers, json={"company_name": "name"})
+			assert response.status_code // 100 == 2
+			assert len(statements["primary"]) > 0
+			assert last_write() is not None
+
+			# The last write time is in the database, so another process sees it as well
+
+			replicas.failed_until.clear()
+			monkeypatch.setattr(model, "replicas", model.ReplicaSet([replica], lag_tolerance=60))
+
+			statements = {"primary": [], "replica": []}
+			assert client.get("/account", headers=headers).status_code == 200
+			assert len(statements["primary"]) == 2
+			assert len(statements["replica"]) == 0
+		finally:
+			for name, engine in engines.items():
+				sa.event.remove(engine, "before_cursor_execute", listeners[name])
+
 	################################################################################
 	# Document posting test
 	################################################################################
@@ -85,7 +237,9 @@ class TestAPI:
 	@pytest.mark.dependency(
 		scope="session", name="test_document_posting", depends=["TestAPIDummy"]
 	)
-	def test_document_posting(self, session: orm.Session, sender: model.User) -> None:
+	def test_document_posting(
+		self, session: orm.Session, sender: model.User, monkeypatch: pytest.MonkeyPatch
+	) -> None:
 		headers = self.user_access_header(sender)
 
 		# Test pdf posting
@@ -99,30 +253,254 @@ class TestAPI:
 		assert response.status_code == 200
 		pdf_oid = response.json()["oid"]
 
+		response = client.get(f"/orders/{pdf_oid}/document", headers=headers)
+		assert response.content.startswith(b"%PDF")
+		assert response.headers["etag"] == f'"{hashlib.sha256(response.content).hexdigest()}"'
+
+		# Fonts and images repeated across the files are stored once
+
+		files_list = [("order_files", open(f"{test_path}/test_file.pdf", "rb")) for _ in range(2)]
+		response = client.post("/orders/pdf", headers=headers, files=files_list)
+		assert response.status_code == 200
+		optimized_oid = response.json()["oid"]
+
+		optimized = model.Order.get(session, optimized_oid).document
+		file_size = pathlib.Path(f"{test_path}/test_file.pdf").stat().st_size
+		assert optimized.original_size == 2 * file_size
+		assert optimized.size is not None and optimized.size < 1.5 * file_size
+		assert len(pypdf.PdfReader(io.BytesIO(optimized.content)).pages) == 2
+
+		# Merges beyond the limit are rejected
+
+		monkeypatch.setattr(pdf.merger, "max_pending", 0)
+		files = {'order_files': open(f"{test_path}/test_file.pdf", "rb")}
+		response = client.post("/orders/pdf", headers=headers, files=files)
+		assert response.status_code == 503
+
 		# Test json posting
 
 		columns = ["1", "2", "3", "4"]
 		row = ["a", "b", "c", "d"]
 		data = [row] * 10
 
+		body = json.dumps({"columns": columns, "data": data}, indent=2).encode()
+		response = client.post("/orders/json", headers=headers, content=body)
+		assert response.status_code == 200
+		json_oid = response.json()["oid"]
+
+		response = client.get(f"/orders/{json_oid}/document", headers=headers)
+		assert response.content == body
+
+		for broken in [b'{"columns": ["1"], "data": [["a", "b"]]}', b'{"columns": ["1"], "data": [']:
+			response = client.post("/orders/json", headers=headers, content=broken)
+			assert response.status_code == 403
+
+		# Test csv posting
+
+		csv_body = '\ufeff이름,수량,메모\r\n상자,7,"a, ""b""\r\nc"\r\n,,\r\n봉투,3,\r\n'.encode()
+		response = client.post("/orders/csv", headers=headers, content=csv_body)
+		assert response.status_code == 200
+		csv_oid = response.json()["oid"]
+
+		response = client.get(f"/orders/{csv_oid}/document", headers=headers)
+		assert response.json() == {
+			"columns": ["이름", "수량", "메모"], "data": [["상자", "7", 'a, "b"\r\nc'], ["봉투", "3", ""]]
+		}
+		response = client.get(f"/orders/{csv_oid}/rows?offset=1", headers=headers)
+		assert response.json()["rows"] == [["봉투", "3", ""]]
+
 		response = client.post(
-			"/orders/json", headers=headers, json={"columns": columns, "data": data}
+			"/orders/csv?encoding=cp949", headers=headers, content="이름\n상자\n".encode("cp949")
 		)
 		assert response.status_code == 200
-		json_oid = response.json()["oid"]
+		cp949_oid = response.json()["oid"]
+
+		response = client.post("/orders/csv", headers=headers, content=b"a,b\n1\n1,2\n1,2,3\n")
+		assert response.status_code == 403
+		assert response.json()["detail"][1:] == [
+			"Line 2: expected 2 cells, got 1", "Line 4: expected 2 cells, got 3"
+		]
 
 		# Clean up
 
-		pdf_order = model.Order.get(session, pdf_oid)
-		pdf_document = pdf_order.document
-		session.delete(pdf_order)
-		session.delete(pdf_document)
+		for oid in [pdf_oid, optimized_oid]:
+			pdf_order = model.Order.get(session, oid)
+			pdf_document = pdf_order.document
+			session.delete(pdf_order)
+			session.delete(pdf_document)
+
+		for oid in [json_oid, csv_oid, cp949_oid]:
+			json_order = model.Order.get(session, oid)
+			json_document = json_order.document
+			session.delete(json_order)
+			session.delete(json_document)
+
+		session.commit()
+
+	@pytest.mark.dependency(
+		scope="session", name="test_bulk_posting", depends=["test_document_posting"]
+	)
+	def test_bulk_posting(self, session: orm.Session, sender: model.User) -> None:
+		headers = self.user_access_header(sender)
+		orders_data = [
+			{"columns": ["name", "index"], "data": [["order", str(index)]] * (index + 1)}
+			for index in range(3)
+		]
+
+		# Broken orders reject the whole request
+
+		num_orders = session.scalars(sa.select(sa.func.count(model.Order.id))).one()
+		broken = [*orders_data, {"columns": ["name"], "data": [["a", "b"]]}]
+		response = client.post("/orders/json/bulk", headers=headers, json=broken)
+		assert response.status_code == 403
+		assert "index 3" in response.json()["detail"]
+		assert client.post("/orders/json/bulk", headers=headers, json=[]).status_code == 403
+		assert session.scalars(sa.select(sa.func.count(model.Order.id))).one() == num_orders
+
+		# Created ids are in the order of the request
+
+		with self.count_queries() as statements:
+			response = client.post("/orders/json/bulk", headers=headers, json=orders_data)
+		assert response.status_code == 200
+
+		# SQLite cannot keep the order of a multi-row RETURNING, so it inserts row by row
+		inserts = [statement for statement in statements if statement.startswith("INSERT")]
+		num_rows = 1 if model.async_engine.dialect.name == "postgresql" else len(orders_data)
+		assert len(inserts) == 2 * num_rows
+
+		orders = [model.Order.get(session, oid) for oid in response.json()["oids"]]
+		for order, order_data in zip(orders, orders_data):
+			assert order.sender_role_id == sender.sender_role_id
+			assert json.loads(order.document.content) == order_data
+
+		for order in orders:
+			session.delete(order)
+			session.delete(order.document)
+		session.commit()
+
+	@pytest.mark.dependency(
+		scope="session", name="test_document_download", depends=["TestAPIDummy"]
+	)
+	def test_document_download(
+		self, session: orm.Session, sender: model.User, order: model.Order
+	) -> None:
+		headers = self.user_access_header(sender)
+		url = f"/orders/{order.id}/document"
+		etag = f'"{order.document.sha256.hex()}"'
+
+		response = client.get(url, headers=headers)
+		assert response.status_code == 200
+		assert response.content == b"doc"
+		assert response.headers["etag"] == etag
+		assert response.headers["content-length"] == "3"
+		assert response.headers["content-type"] == "application/pdf"
+
+		response = client.head(url, headers=headers)
+		assert response.status_code == 200
+		assert response.content == b""
+		assert response.headers["content-length"] == "3"
+
+		# Ranges
+
+		expected = {"bytes=1-": b"oc", "bytes=0-0": b"d", "bytes=-2": b"oc", "bytes=1-100": b"oc"}
+		for byte_range, content in expected.items():
+			response = client.get(url, headers={**headers, "Range": byte_range})
+			assert response.status_code == 206, byte_range
+			assert response.content == content, byte_range
+			assert response.headers["content-range"].endswith("/3"), byte_range
+
+		for byte_range in ["bytes=3-", "bytes=-0"]:
+			response = client.get(url, headers={**headers, "Range": byte_range})
+			assert response.status_code == 416, byte_range
+			assert response.headers["content-range"] == "bytes */3"
+
+		for byte_range in ["bytes=0-0,2-2", "bytes=2-1", "items=0-1", "bytes=a-"]:
+			response = client.get(url, headers={**headers, "Range": byte_range})
+			assert response.status_code == 200, byte_range
+			assert response.content == b"doc", byte_range
+
+		response = client.get(url, headers={**headers, "Range": "bytes=1-", "If-Range": '"stale"'})
+		assert response.status_code == 200
+		assert response.content == b"doc"
+
+		# Conditional requests
+
+		response = client.get(url, headers={**headers, "If-None-Match": f'"stale", W/{etag}'})
+		assert response.status_code == 304
+		assert response.content == b""
+
+		# Contents not exported yet are streamed from the table
+
+		legacy = model.Document(doc_type=model.DocumentType.JSON, content=b"legacy")
+		legacy.inline_content = b"legacy"
+		legacy.size = None
+		session.add(legacy)
+		session.flush([legacy])
+		legacy_order = model.Order(did=legacy.id, sender_role_id=sender.sender_role_id)
+		session.add(legacy_order)
+		session.commit()
+
+		response = client.get(f"/orders/{legacy_order.id}/document", headers=headers)
+		assert response.status_code == 200
+		assert response.content == b"legacy"
+		assert response.headers["content-length"] == "6"
+		assert response.headers["content-type"] == "application/json"
+		assert b"".join(legacy.iter_content(1, 5, b"legacy", chunk_size=3)) == b"egac"
+
+		response = client.get(
+			f"/orders/{legacy_order.id}/document", headers={**headers, "Range": "bytes=1-4"}
+		)
+		assert response.status_code == 206
+		assert response.content == b"egac"
+
+		session.delete(legacy_order)
+		session.delete(legacy)
+		session.commit()
+
+	@pytest.mark.dependency(
+		scope="session", name="test_order_rows", depends=["TestAPIDummy"]
+	)
+	def test_order_rows(self, session: orm.Session, sender: model.User) -> None:
+		headers = self.user_access_header(sender)
+		columns = ["name", "index", "memo"]
+		data = [[f"name{index}", str(index), "a,\"]\n"] for index in range(25)]
+		body = json.dumps({"columns": columns, "data": data}, indent=1).encode()
+
+		response = client.post("/orders/json", headers=headers, content=body)
+		assert response.status_code == 200
+		oid = response.json()["oid"]
+
+		response = client.get(f"/orders/{oid}/rows?offset=20&limit=10", headers=headers)
+		assert response.status_code == 200
+		assert response.json() == {"columns": columns, "rows": data[20:], "offset": 20, "total": 25}
+
+		response = client.get(
+			f"/orders/{oid}/rows?offset=3&limit=2&columns=memo&columns=name", headers=headers
+		)
+		assert response.json()["rows"] == [[row[2], row[0]] for row in data[3:5]]
+
+		response = client.get(f"/orders/{oid}/rows?offset=30", headers=headers)
+		assert response.json()["rows"] == []
+
+		for query in ["columns=unknown", "limit=0", "limit=1001", "offset=-1"]:
+			response = client.get(f"/orders/{oid}/rows?{query}", headers=headers)
+			assert response.status_code in (403, 422), query
 
-		json_order = model.Order.get(session, json_oid)
-		json_document = json_order.document
-		session.delete(json_order)
-		session.delete(json_document)
+		# Documents posted before the row index are indexed on the fly, then by the backfill
 
+		order = model.Order.get(session, oid)
+		order.document.row_index_sha256 = None
+		session.commit()
+
+		response = client.get(f"/orders/{oid}/rows?offset=1&limit=1", headers=headers)
+		assert response.json()["rows"] == data[1:2]
+		assert model.Document.index_rows(session) >= 1
+		stmt = sa.select(model.Document.row_index_sha256).where(model.Document.id == order.did)
+		assert session.scalars(stmt).one() is not None
+
+		document = order.document
+		session.delete(order)
+		session.delete(document)
 		session.commit()
 
 	################################################################################
@@ -172,6 +550,13 @@ class TestAPI:
 			response = self.send_action_request(method, role, sender, driver, order)
 			assert response.status_code == 204
 
+			# Signs are requested by the jobs, their results are on standby until the jobs run
+			if method in ["onboard", "outboard"]:
+				with orm.Session(model.engine) as session:
+					stmt = sa.select(model.CertResult).order_by(model.CertResult.id.desc()).limit(1)
+					assert session.scalars(stmt).one().state == model.CertStateEnum.STANDBY
+				asyncio.run(background.run_jobs(1, until_idle=True))
+
 	def reset_order(self, session: orm.Session, order: model.Order) -> None:
 		select_stmt = sa.select(model.Signature)
 		select_stmt = select_stmt.where(model.Signature.did == order.did)
@@ -191,6 +576,7 @@ class TestAPI:
 
 		order.state = model.OrderStatusEnum.REQUESTED
 		order.driver_role_id = None
+		order.shipped_time = None
 		session.commit()
 
 	# TODO: test scenario generator helps to write scenario easily, but need to improve readability
@@ -208,6 +594,41 @@ class TestAPI:
 		if reset:
 			self.reset_order(session, order)
 
+	@pytest.mark.dependency(
+		scope="session", name="test_order_transition", depends=["TestAPIDummy"]
+	)
+	def test_order_transition(
+		self, session: orm.Session, sender: model.User,
+		driver: model.User, other_driver: model.User, order: model.Order
+	) -> None:
+		async def allocate(driver: model.User) -> bool:
+			async with AsyncSession(model.async_engine, expire_on_commit=False) as async_session:
+				async_order = await model.Order.aget(async_session, order.id)
+				assert driver.driver_role is not None
+				return await async_order.atransition(
+					async_session, sender.id, model.OrderActionEnum.ALLOCATE,
+					[model.OrderStatusEnum.REQUESTED], model.OrderStatusEnum.ALLOCATED,
+					values={"driver_role_id": driver.driver_role.id},
+					conditions=[model.Order.driver_role_id.is_(None)],
+				)
+
+		async def allocate_concurrently() -> tuple[bool, bool]:
+			return await asyncio.gather(allocate(driver), allocate(other_driver))
+
+		# Only one of the concurrent allocations succeeds, by one UPDATE and one INSERT at most
+
+		with self.count_queries() as statements:
+			assert sorted(asyncio.run(allocate_concurrently())) == [False, True]
+		writes = [statement for statement in statements if not statement.startswith("SELECT")]
+		assert len(writes) == (2 if model.async_engine.dialect.name == "postgresql" else 3)
+
+		session.refresh(order)
+		assert order.state == model.OrderStatusEnum.ALLOCATED
+		stmt = sa.select(sa.func.count()).where(model.OrderAction.oid == order.id)
+		assert session.scalars(stmt).one() == 1
+
+		self.reset_order(session, order)
+
 	@pytest.mark.dependency(
 		scope="session",
 		name="test_order_flow",
@@ -221,6 +642,7 @@ class TestAPI:
 		other_driver: model.User,
 		order: model.Order,
 		monkeypatch: pytest.MonkeyPatch,
+		request: pytest.FixtureRequest,
 	) -> None:
 		# Monkey patch
 
@@ -251,11 +673,28 @@ class TestAPI:
 			monkeypatch.setattr(service, "requestSign", requestSign)
 			monkeypatch.setattr(service, "getSignStatus", getSignStatus)
 			monkeypatch.setattr(service, "verifySign", verifySign)
-		
-		def add_task(self: Any, function: Any, *args: Any, **kwargs: Any) -> None:
-			function(*args, **kwargs)
-	
-		monkeypatch.setattr(BackgroundTasks, "add_task", add_task)
+
+		# Sign jobs hold no transaction while waiting for the receivers
+
+		transactions = 0
+		def begin(connection: Any) -> None:
+			nonlocal transactions
+			transactions += 1
+		def end(connection: Any) -> None:
+			nonlocal transactions
+			transactions -= 1
+
+		wait = background.barocert_poller.wait
+		async def wait_without_transaction(*args: Any) -> Any:
+			assert transactions == 0
+			return await wait(*args)
+
+		monkeypatch.setattr(background.barocert_poller, "wait", wait_without_transaction)
+		for name, listener in [("begin", begin), ("commit", end), ("rollback", end)]:
+			sa.event.listen(model.async_engine.sync_engine, name, listener)
+			request.addfinalizer(
+				functools.partial(sa.event.remove, model.async_engine.sync_engine, name, listener)
+			)
 
 		# Initialization
 
@@ -371,11 +810,14 @@ class TestAPI:
 			),
 		], reset=False)
 
-		for action in order.actions:
-			if action.action == model.OrderActionEnum.ONBOARD:
-				action.timestamp -= datetime.timedelta(days=2)
+		session.refresh(order)
+		assert order.shipped_time is not None
+		order.shipped_time -= datetime.timedelta(days=2)
 		session.commit()
 
+		response = client.get("/orders/failable", headers=self.user_access_header(sender))
+		assert [info["id"] for info in response.json()] == [order.id]
+
 		self.run_test_set(session, sender, driver, order, test_set=[
 			*test_scenarios(
 				allowed_role="sender", allowed_method="set-failed",
@@ -384,6 +826,63 @@ class TestAPI:
 			*[(method, None) for method in all_methods]
 		])
 
+		# A retried job waits for the receipt it has requested, holding no transaction either
+
+		failures = [ConnectionError("lost while waiting")]
+		async def wait_failing_once(*args: Any) -> Any:
+			if failures: raise failures.pop()
+			return await wait_without_transaction(*args)
+
+		monkeypatch.setattr(background.barocert_poller, "wait", wait_failing_once)
+		self.run_test_set(session, sender, driver, order, test_set=[
+			("allocate", "sender"), ("onboard", "driver"),
+		], reset=False)
+		num_requests = getattr(requestSign, 'index')
+
+		past = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=1)
+		pending = sa.update(model.Job).where(model.Job.state == model.JobStateEnum.PENDING)
+		session.execute(pending.values(run_after=past))
+		session.commit()
+		asyncio.run(background.run_jobs(1, until_idle=True))
+		assert getattr(requestSign, 'index') == num_requests
+		session.refresh(order)
+		assert model.Order.get(session, order.id).state == model.OrderStatusEnum.SHIPPING
+		self.reset_order(session, order)
+
+		# A job failing its last attempt fails its cert result
+
+		failures = [ConnectionError("lost while waiting")] * 2
+		self.run_test_set(session, sender, driver, order, test_set=[
+			("allocate", "sender"), ("onboard", "driver"),
+		], reset=False)
+		session.execute(pending.values(run_after=past, max_attempts=2))
+		session.commit()
+		asyncio.run(background.run_jobs(1, until_idle=True))
+
+		stmt = sa.select(model.CertResult).order_by(model.CertResult.id.desc()).limit(1)
+		cert_result = session.scalars(stmt).one()
+		assert cert_result.state == model.CertStateEnum.FAILED
+		assert cert_result.error_stage == model.CertErrorStageEnum.GET_STATUS
+		self.reset_order(session, order)
+		monkeypatch.setattr(background.barocert_poller, "wait", wait_without_transaction)
+
+		# Sign requests fail fast while the circuit of the vender is open
+
+		breaker = background.barocert_service(model.CertVenderEnum.KAKAO).breaker
+		monkeypatch.setattr(breaker, "state", "open")
+		monkeypatch.setattr(breaker, "opened", time.monotonic())
+
+		self.run_test_set(session, sender, driver, order, test_set=[
+			("allocate", "sender"), ("onboard", "driver"),
+		], reset=False)
+
+		cert_result = session.scalars(stmt).one()
+		assert cert_result.state == model.CertStateEnum.FAILED
+		assert cert_result.error_stage == model.CertErrorStageEnum.ADMISSION
+		session.refresh(order)
+		assert order.state == model.OrderStatusEnum.ALLOCATED
+		self.reset_order(session, order)
+
 		# Clean up
 
 		session.delete(contact)
@@ -1,8 +1,11 @@
-import pytest, datetime, uuid
+from typing import Any, AsyncIterator, BinaryIO, Optional
+import asyncio, base64, hashlib, io, json, os, pytest, datetime, uuid
 
 import sqlalchemy as sa
 from sqlalchemy import orm
-from jhsolution import model
+from sqlalchemy.ext.asyncio import AsyncSession
+from jhsolution import blob, model
+from jhsolution.router.admin import board_page
 
 class TestModel:
 	@pytest.mark.dependency(
@@ -14,7 +17,9 @@ class TestModel:
 
 	@pytest.mark.dependency(
 		scope="session", name="TestModel",
-		depends=["test_membership", "test_order_page"]
+		depends=["test_membership", "test_order_page", "test_order_cursor_page", "test_index_usage",
+			"test_blob_store", "test_s3_blob_store", "test_document_ingest", "test_document_compression",
+			"test_failable_orders", "test_job_queue"]
 	)
 	def test_end_dummy(self) -> None: pass
 
@@ -156,14 +161,17 @@ class TestModel:
 				raise ValueError()
 
 			condition &= model.Order.can_user_access(user)
-			board = model.PageBoard(model.Order, condition, session)
-			return board.pages(1, 10, model.Order.ordered_time)
+			async def read_page() -> list[model.Order]:
+				async with AsyncSession(model.async_engine) as async_session:
+					board = model.PageBoard(model.Order, condition, async_session)
+					return await board.apages(1, 10, model.Order.ordered_time)
+			return asyncio.run(read_page())
 
 		def assert_expectation(expected: dict[tuple[str, str], list[model.Order]]) -> None:
 			for i, (k, v) in enumerate(expected.items()):
 				(method_type, user_type), expected_orders = k, v
 				orders = get_order(method_type, users[user_type])
-				assert orders == expected_orders
+				assert [order.id for order in orders] == [order.id for order in expected_orders]
 
 		# Test requested state
 		# Each expected state follows the format:
@@ -236,3 +244,473 @@ class TestModel:
 		session.delete(order)
 		session.delete(document)
 		session.commit()
+
+	@pytest.mark.dependency(
+		scope="session",
+		name="test_order_cursor_page",
+		depends=["test_order_page"]
+	)
+	def test_order_cursor_page(
+		self, session: orm.Session, sender: model.User, monkeypatch: pytest.MonkeyPatch
+	) -> None:
+		document = model.Document(
+			doc_type=model.DocumentType.PDF,
+			content=b"document"
+		)
+		session.add(document)
+		session.flush([document])
+
+		# Two orders share a timestamp to check the id tie-breaker
+		now = datetime.datetime.now()
+		times = [now, now, now - datetime.timedelta(1), now - datetime.timedelta(2), now - datetime.timedelta(3)]
+		orders = [
+			model.Order(sender_role_id=sender.sender_role_id, did=document.id, ordered_time=time)
+			for time in times
+		]
+		session.add_all(orders)
+		session.commit()
+
+		condition = model.Order.id.in_([order.id for order in orders])
+		expected = sorted(orders, key=lambda order: (order.ordered_time, order.id), reverse=True)
+		expected_ids = [order.id for order in expected]
+		sort_key = model.Order.ordered_time
+
+		def ids(rows: list[model.Order]) -> list[int]:
+			return [order.id for order in rows]
+
+		async def read_pages() -> None:
+			async with AsyncSession(model.async_engine) as async_session:
+				board = model.PageBoard(model.Order, condition, async_session)
+
+				# Walk forward
+
+				pages = [await board.acursor_pages(2, sort_key)]
+				while pages[-1].next_cursor:
+					pages.append(await board.acursor_pages(2, sort_key, pages[-1].next_cursor))
+
+				assert [len(page.rows) for page in pages] == [2, 2, 1]
+				assert [order.id for page in pages for order in page.rows] == expected_ids
+				assert pages[0].prev_cursor is None
+
+				# Walk backward from the last page
+
+				page = await board.acursor_pages(2, sort_key, pages[-1].prev_cursor)
+				assert ids(page.rows) == ids(pages[1].rows)
+				page = await board.acursor_pages(2, sort_key, page.prev_cursor)
+				assert ids(page.rows) == ids(pages[0].rows)
+				assert page.prev_cursor is None
+				assert page.next_cursor == pages[0].next_cursor
+
+				with pytest.raises(ValueError):
+					await board.acursor_pages(2, sort_key, "broken")
+
+				# Offset pages carry the total count
+
+				rows, count = await board.apages_with_count(2, 2, sort_key)
+				assert (ids(rows), count) == (expected_ids[2:4], 5)
+				assert await board.apages_with_count(4, 2, sort_key) == ([], 5)
+				assert await board.aestimated_count() == 5
+				assert ids(await board.arows(sort_key, desc=False)) == expected_ids[::-1]
+
+				# Admin pages read one row past the page rather than trust the estimated count
+
+				async def underestimated_count() -> int: return 1
+				monkeypatch.setattr(board, "aestimated_count", underestimated_count)
+
+				rows, pagination = await board_page(board, sort_key, 2, 2, None)
+				assert ids(rows) == expected_ids[2:4]
+				assert pagination == {"page": 2, "is_last_page": False, "num_pages": 3}
+
+				rows, pagination = await board_page(board, sort_key, 3, 2, None)
+				assert ids(rows) == expected_ids[4:]
+				assert pagination == {"page": 3, "is_last_page": True, "num_pages": 3}
+
+		asyncio.run(read_pages())
+
+		# Clean up
+
+		for order in orders: session.delete(order)
+		session.delete(document)
+		session.commit()
+
+	@pytest.mark.dependency(
+		scope="session",
+		name="test_index_usage",
+		depends=["test_user_creation"]
+	)
+	def test_index_usage(
+		self, session: orm.Session, sender: model.User, driver: model.User
+	) -> None:
+		dialect = session.get_bind().dialect
+
+		def explain(stmt: sa.Select[Any]) -> str:
+			query = stmt.compile(dialect=dialect, compile_kwargs={"literal_binds": True})
+			if dialect.name == "postgresql":
+				# Test tables are too small for the planner to prefer an index by itself
+				session.execute(sa.text("SET LOCAL enable_seqscan = off"))
+				plan = session.connection().exec_driver_sql(f"EXPLAIN {query}").all()
+			else:
+				plan = session.connection().exec_driver_sql(f"EXPLAIN QUERY PLAN {query}").all()
+			return "\n".join(str(row) for row in plan)
+
+		# Order pages are read and sorted by the index
+
+		for user, index in [(sender, "ix_order_sender_role_state"), (driver, "ix_order_driver_role_state")]:
+			condition = model.Order.state == model.OrderStatusEnum.REQUESTED
+			condition &= model.Order.can_user_access(user)
+			board = model.PageBoard(model.Order, condition, AsyncSession(model.async_engine))
+
+			for stmt in [
+				board.pages_stmt(1, 10, model.Order.ordered_time),
+				board.cursor_stmt(10, model.Order.ordered_time),
+			]:
+				plan = explain(stmt)
+				assert index in plan
+				assert "TEMP B-TREE" not in plan
+
+		# Lookups by foreign keys and user identifiers
+
+		user_stmt = model.User.select_user(email="email")
+		assert user_stmt is not None
+		assert "ix_user_auth_email" in explain(user_stmt)
+
+		stmt = sa.select(model.OrderContact).where(model.OrderContact.oid == 1)
+		assert "ix_order_contact_oid_role" in explain(stmt)
+
+		stmt = sa.select(model.OrderAction).where(model.OrderAction.oid == 1)
+		assert "ix_order_action_history_oid_uid_action" in explain(stmt)
+
+		# The transitions check the history and the contacts of an order by the keys
+
+		stmt = sa.select(driver.has_deallocated_condition(1))
+		assert "ix_order_action_history_oid_uid_action" in explain(stmt)
+
+		stmt = sa.select(model.OrderContact).where(
+			model.OrderContact.oid == 1, model.OrderContact.role == model.OrderContactRole.RECEIVER,
+			model.OrderContact.HP == "01012345678", model.OrderContact.name == "name",
+		)
+		assert "ix_order_contact_oid_role" in explain(stmt)
+
+		stmt = sa.select(model.CompanyMembership).where(model.CompanyMembership.company_id == 1)
+		assert "ix_company_membership_company_id" in explain(stmt)
+
+		# The sweeper reads the failable orders in the order of the index
+
+		now = datetime.datetime.now(datetime.timezone.utc)
+		stmt = sa.select(model.Order.id).where(model.Order.failable_condition(now))
+		plan = explain(stmt.order_by(model.Order.shipped_time, model.Order.id).limit(100))
+		assert "ix_order_state_shipped_time" in plan
+		assert "TEMP B-TREE" not in plan
+
+		# Admin user lists
+
+		condition = model.User.sender_role_id != None
+		user_board = model.PageBoard(model.User, condition, AsyncSession(model.async_engine))
+		assert "ix_user_register_time" in explain(user_board.cursor_stmt(50, model.User.register_time))
+
+		session.rollback()
+
+	@pytest.mark.dependency(
+		scope="session",
+		name="test_blob_store",
+		depends=["TestModelDummy"]
+	)
+	def test_blob_store(self, session: orm.Session) -> None:
+		assert isinstance(blob.store, blob.LocalBlobStore)
+		content = uuid.uuid4().bytes
+
+		def inline_content(document: model.Document) -> Optional[bytes]:
+			stmt = sa.select(model.Document.inline_content).where(model.Document.id == document.id)
+			return session.scalars(stmt).one()
+
+		# Identical contents share one blob
+
+		documents = [
+			model.Document(doc_type=model.DocumentType.PDF, content=content) for _ in range(2)
+		]
+		session.add_all(documents)
+		session.commit()
+
+		path = blob.store.path(documents[0].sha256)
+		assert path.read_bytes() == content
+		assert len(list(path.parent.iterdir())) == 1
+		assert documents[1].sha256 == documents[0].sha256
+		assert inline_content(documents[0]) is None
+		assert documents[1].content == content
+
+		# Contents left in the table are read from the table until they are exported
+
+		legacy_content = uuid.uuid4().bytes
+		legacy = model.Document(doc_type=model.DocumentType.JSON, content=legacy_content)
+		blob.store.delete(legacy.sha256)
+		legacy.inline_content = legacy_content
+		session.add(legacy)
+		session.commit()
+
+		assert not blob.store.exists(legacy.sha256)
+		assert legacy.content == legacy_content
+
+		assert model.Document.export_contents(session, batch_size=1) == 1
+		assert inline_content(legacy) is None
+		session.expire(legacy)
+		assert blob.store.get(legacy.sha256) == legacy_content
+		assert legacy.content == legacy_content
+
+		# Import fills the table again for a downgrade
+
+		assert model.Document.import_contents(session, batch_size=1) >= 3
+		assert inline_content(documents[0]) == content
+		assert inline_content(legacy) == legacy_content
+		assert model.Document.export_contents(session) >= 3
+
+		for document in [*documents, legacy]: session.delete(document)
+		session.commit()
+
+	@pytest.mark.dependency(
+		scope="session",
+		name="test_s3_blob_store",
+		depends=["TestModelDummy"]
+	)
+	def test_s3_blob_store(self) -> None:
+		class FakeS3Client:
+			"""Stand-in of the boto3 S3 client which keeps the objects in memory"""
+			def __init__(self) -> None:
+				self.objects: dict[tuple[str, str], bytes] = {}
+				self.num_puts = 0
+				self.num_copies = 0
+
+			def list_objects_v2(self, Bucket: str, Prefix: str, MaxKeys: int) -> dict[str, Any]:
+				keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+				return {"Contents": [{"Key": key} for key in keys[:MaxKeys]]}
+
+			def get_object(self, Bucket: str, Key: str) -> dict[str, Any]:
+				return {"Body": io.BytesIO(self.objects[Bucket, Key])}
+
+			def put_object(self, Bucket: str, Key: str, Body: BinaryIO, ChecksumSHA256: str) -> None:
+				data = Body.read()
+				assert base64.b64decode(ChecksumSHA256) == hashlib.sha256(data).digest()
+				self.objects[Bucket, Key] = data
+				self.num_puts += 1
+
+			def delete_object(self, Bucket: str, Key: str) -> None:
+				del self.objects[Bucket, Key]
+
+			def copy_object(self, Bucket: str, Key: str, CopySource: dict[str, str], MetadataDirective: str) -> None:
+				assert CopySource == {"Bucket": Bucket, "Key": Key}
+				self.num_copies += 1
+
+		client = FakeS3Client()
+		store = blob.S3BlobStore(client, "bucket", "documents/")
+
+		key = store.put(b"content")
+		assert store.put(b"content") == key
+		assert client.num_puts == 1 and client.num_copies == 1
+		assert list(client.objects) == [("bucket", f"documents/{key.hex()[:2]}/{key.hex()}")]
+		assert store.exists(key)
+		assert store.get(key) == b"content"
+
+		store.delete(key)
+		assert not store.exists(key)
+
+	@pytest.mark.dependency(
+		scope="session",
+		name="test_document_compression",
+		depends=["test_document_ingest"]
+	)
+	def test_document_compression(self, session: orm.Session, monkeypatch: pytest.MonkeyPatch) -> None:
+		order_data = {"columns": ["name", "address"], "data": [["상자", "서울시 중구"]] * 5000}
+		content = json.dumps(order_data, ensure_ascii=False).encode()
+
+		# Codecs are chosen by the type and the size, and kept only if they shrink the content
+
+		for doc_type, data, codec in [
+			(model.DocumentType.JSON, content, model.DocumentCodec.LZMA),
+			(model.DocumentType.PDF, content, model.DocumentCodec.ZLIB),
+			(model.DocumentType.PDF, os.urandom(100_000), model.DocumentCodec.NONE),
+			(model.DocumentType.JSON, b'{"columns": ["a"], "data": []}', model.DocumentCodec.NONE),
+		]:
+			document = model.Document.ingest(doc_type, [data])
+			assert document.codec == codec
+			assert document.sha256 == hashlib.sha256(data).digest()
+			assert document.size == len(data)
+			assert document.content == data
+			assert b"".join(document.iter_content(10, 30000, chunk_size=100)) == data[10:30000]
+
+		assert document.stored_sha256 is None
+		document = model.Document.ingest(model.DocumentType.JSON, [content])
+		assert document.stored_size is not None and document.stored_size * 10 < len(content)
+
+		# Blobs stored raw are compressed by the backfill
+
+		with monkeypatch.context() as patch:
+			patch.setattr(model.Document, "choose_codec", lambda *args: model.DocumentCodec.NONE)
+			raw_content = content + b" "
+			document = model.Document(doc_type=model.DocumentType.JSON, content=raw_content)
+		session.add(document)
+		session.commit()
+		assert blob.store.exists(document.sha256)
+
+		count, saved = model.Document.compress_contents(session, batch_size=2)
+		assert count >= 1 and saved > len(raw_content) // 2
+		session.refresh(document)
+		assert document.codec == model.DocumentCodec.LZMA
+		assert document.content == raw_content
+
+		# The raw blobs are left to the garbage collection, which waits for the grace
+
+		assert isinstance(blob.store, blob.LocalBlobStore)
+		assert blob.store.exists(document.sha256)
+		now = datetime.datetime.now(datetime.timezone.utc)
+		grace = datetime.timedelta(hours=1)
+		assert model.Document.collect_garbage(session, now, grace) == 0
+
+		old = (now - grace * 2).timestamp()
+		os.utime(blob.store.path(document.sha256), (old, old))
+		assert document.stored_sha256 is not None
+		os.utime(blob.store.path(document.stored_sha256), (old, old))
+		assert model.Document.collect_garbage(session, now, grace, batch_size=1) >= 1
+		assert not blob.store.exists(document.sha256)
+		assert document.content == raw_content
+
+		# Storing the same content again touches the blob, so a new upload keeps it
+
+		os.utime(blob.store.path(document.stored_sha256), (old, old))
+		model.Document(doc_type=model.DocumentType.JSON, content=raw_content)
+		modified = blob.store.modified(document.stored_sha256)
+		assert modified is not None and modified > now - grace
+
+		session.delete(document)
+		session.commit()
+
+	@pytest.mark.dependency(
+		scope="session",
+		name="test_failable_orders",
+		depends=["test_user_creation"]
+	)
+	def test_failable_orders(self, session: orm.Session, sender: model.User) -> None:
+		assert sender.sender_role is not None
+		now = datetime.datetime.now(datetime.timezone.utc)
+		document = model.Document(doc_type=model.DocumentType.PDF, content=b"document")
+		session.add(document)
+		session.flush([document])
+
+		# Only the orders shipping for FAILABLE_AFTER or longer fail
+
+		orders = [model.Order(
+			did=document.id, sender_role_id=sender.sender_role.id,
+			state=state, shipped_time=now - age
+		) for state, age in [
+			(model.OrderStatusEnum.SHIPPING, model.FAILABLE_AFTER * 2),
+			(model.OrderStatusEnum.SHIPPING, model.FAILABLE_AFTER + datetime.timedelta(minutes=1)),
+			(model.OrderStatusEnum.SHIPPING, model.FAILABLE_AFTER - datetime.timedelta(minutes=1)),
+			(model.OrderStatusEnum.COMPLETED, model.FAILABLE_AFTER * 2),
+		]]
+		session.add_all(orders)
+		session.commit()
+
+		async def sweep() -> int:
+			async with AsyncSession(model.async_engine, expire_on_commit=False) as async_session:
+				return await model.Order.afail_failable(async_session, now, batch_size=1)
+
+		assert asyncio.run(sweep()) == 2
+		assert asyncio.run(sweep()) == 0
+
+		for order, state in zip(orders, [
+			model.OrderStatusEnum.FAILED, model.OrderStatusEnum.FAILED,
+			model.OrderStatusEnum.SHIPPING, model.OrderStatusEnum.COMPLETED,
+		]):
+			session.refresh(order)
+			assert order.state == state
+			assert [action.action for action in order.actions] == (
+				[model.OrderActionEnum.SET_FAILED] if state == model.OrderStatusEnum.FAILED else []
+			)
+
+		for order in orders:
+			for action in order.actions: session.delete(action)
+			session.delete(order)
+		session.delete(document)
+		session.commit()
+
+	@pytest.mark.dependency(
+		scope="session",
+		name="test_job_queue",
+		depends=["TestModelDummy"]
+	)
+	def test_job_queue(self, session: orm.Session) -> None:
+		now = datetime.datetime.now(datetime.timezone.utc)
+		jobs = [
+			model.Job(kind="test", payload={"index": index}, run_after=now - datetime.timedelta(seconds=index))
+			for index in range(2)
+		]
+		jobs.append(model.Job(kind="test", payload={}, run_after=now + datetime.timedelta(minutes=1)))
+		jobs.append(model.Job(kind="other", payload={}, run_after=now))
+		session.add_all(jobs)
+		session.commit()
+
+		async def claim(now: datetime.datetime, limit: int = 1) -> list[int]:
+			async with AsyncSession(model.async_engine, expire_on_commit=False) as async_session:
+				return [job.id for job in await model.Job.aclaim(async_session, ["test"], limit, now)]
+
+		# Due jobs are claimed in the order of run_after and leased
+
+		assert asyncio.run(claim(now)) == [jobs[1].id]
+		assert asyncio.run(claim(now, limit=10)) == [jobs[0].id]
+		assert asyncio.run(claim(now, limit=10)) == []
+
+		# A job whose lease has passed is claimed again
+
+		assert asyncio.run(claim(now + model.JOB_LEASE, limit=2)) == [jobs[2].id, jobs[0].id]
+		session.refresh(jobs[0])
+		assert jobs[0].attempts == 2
+
+		# Deferred jobs keep their attempts
+
+		session.refresh(jobs[2])
+		attempts = jobs[2].attempts
+		jobs[2].defer(datetime.timedelta(seconds=1), now)
+		session.commit()
+		assert asyncio.run(claim(now + datetime.timedelta(seconds=1))) == [jobs[2].id]
+		session.refresh(jobs[2])
+		assert jobs[2].attempts == attempts
+
+		# Failed attempts are retried with backoff until max_attempts
+
+		jobs[0].retry("error", now)
+		assert jobs[0].run_after == now + model.JOB_RETRY_DELAY * 2
+		jobs[0].attempts = jobs[0].max_attempts
+		jobs[0].retry("error", now)
+		assert jobs[0].state == model.JobStateEnum.FAILED
+		assert jobs[0].last_error == "error"
+
+		for job in jobs: session.delete(job)
+		session.commit()
+
+	@pytest.mark.dependency(
+		scope="session",
+		name="test_document_ingest",
+		depends=["test_blob_store"]
+	)
+	def test_document_ingest(self) -> None:
+		chunks = [uuid.uuid4().bytes * 1000 for _ in range(5)]
+		content = b"".join(chunks)
+
+		async def achunks() -> AsyncIterator[bytes]:
+			for chunk in chunks: yield chunk
+
+		documents = [
+			model.Document.ingest(model.DocumentType.PDF, iter(chunks)),
+			asyncio.run(model.Document.aingest(model.DocumentType.PDF, achunks())),
+			asyncio.run(model.Document.aingest(model.DocumentType.PDF, chunks)),
+			model.Document(doc_type=model.DocumentType.PDF, content=content),
+		]
+
+		for document in documents:
+			assert document.sha256 == hashlib.sha256(content).digest()
+			assert document.sha512 == hashlib.sha512(content).digest()
+			assert document.size == len(content)
+			assert document.content == content
+
+		# Spooled files are linked into the store and removed
+
+		assert isinstance(blob.store, blob.LocalBlobStore)
+		assert not list(blob.store.root.glob(".tmp-*"))
@@ -1,6 +1,7 @@
-import time, pytest
+from typing import Any, Iterator
+import asyncio, contextlib, datetime, json, pathlib, time, types, barocert, pypdf, pytest
 
-from jhsolution import utils
+from jhsolution import order_csv, order_json, pdf, utils
 
 @pytest.mark.dependency(name='test_signer', scope='session')
 def test_signer() -> None:
@@ -22,3 +23,221 @@ def test_signer() -> None:
 
 	assert signer1.unsign(token1) is None
 	assert signer2.unsign(token2) is None
+
+@pytest.mark.dependency(name='test_order_json_parser', scope='session')
+def test_order_json_parser() -> None:
+	def parse(body: bytes, chunk_size: int) -> order_json.OrderDataParser:
+		parser = order_json.OrderDataParser(max_row_size=100)
+		for i in range(0, len(body), chunk_size):
+			parser.feed(body[i:i + chunk_size])
+		parser.close()
+		return parser
+
+	data = {"columns": ["이름", "주소"], "data": [["a\"b", "ሴ"]] * 20 + [["c", "d"]]}
+	for body in [json.dumps(data).encode(), json.dumps(data, indent=2, ensure_ascii=False).encode()]:
+		for chunk_size in [1, 3, 1000]:
+			assert parse(body, chunk_size).num_rows == 21
+
+	broken = [
+		b'', b'[]', b'{"columns": [], "data": []}', b'{"columns": ["a"]}',
+		b'{"data": [], "columns": ["a"]}', b'{"columns": ["a"], "columns": ["a"], "data": []}',
+		b'{"columns": ["a"], "data": [["a", "b"]]}', b'{"columns": ["a"], "data": [[1]]}',
+		b'{"columns": ["a"], "data": [["a"]]', b'{"columns": ["a"], "data": []} []',
+		b'{"columns": ["a"], "data": [], "extra": 1}', b'{"columns": ["a"], "data": [["\\u12"]]}',
+		b'{"columns": ["a"], "data": [["' + b"a" * 200 + b'"]]}', b'\xff',
+	]
+	for body in broken:
+		for chunk_size in [1, 3, 1000]:
+			with pytest.raises(order_json.OrderDataError):
+				parse(body, chunk_size)
+
+def test_order_csv_converter() -> None:
+	def convert(body: bytes, chunk_size: int) -> tuple[bytes, order_csv.OrderCsvConverter]:
+		converter = order_csv.OrderCsvConverter(max_row_size=100)
+		output = [converter.feed(body[i:i + chunk_size]) for i in range(0, len(body), chunk_size)]
+		output.append(converter.close())
+		return b"".join(output), converter
+
+	body = '﻿이름,주소\r\n"a ""b""","c,\nd"\r\n,\r\n\ne,ሴ'.encode()
+	data = {"columns": ["이름", "주소"], "data": [['a "b"', "c,\nd"], ["e", "ሴ"]]}
+	for chunk_size in [1, 3, 1000]:
+		output, converter = convert(body, chunk_size)
+		assert json.loads(output) == data
+		assert output == json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode()
+		assert converter.row_index() == order_json.build_row_index([output])
+
+	broken = [b'', b',,\n', b'a,b\n1\n', b'a\n"b\n', b'a\n"b"c\n', b'a\n' + b'b' * 200 + b'\n', b'\xff']
+	for body in broken:
+		for chunk_size in [1, 3, 1000]:
+			with pytest.raises(order_json.OrderDataError):
+				convert(body, chunk_size)
+
+def test_pdf_optimization() -> None:
+	path = pathlib.Path(__file__).parent / "test_file.pdf"
+	writer = pypdf.PdfWriter()
+	for _ in range(2):
+		for page in pypdf.PdfReader(path).pages:
+			writer.add_page(page)
+
+	def xobjects(page: pypdf.PageObject) -> Any:
+		resources: Any = page["/Resources"]
+		return resources["/XObject"]
+
+	xobjects(writer.pages[0])[pypdf.generic.NameObject("/unused")] = xobjects(writer.pages[0])["/x6"]
+	pdf.optimize_writer(writer)
+
+	for page in writer.pages:
+		assert list(xobjects(page)) == ["/x6"]
+	references = [xobjects(page).raw_get("/x6") for page in writer.pages]
+	assert references[0].idnum == references[1].idnum
+
+def test_pdf_merger(tmp_path: pathlib.Path) -> None:
+	path = str(pathlib.Path(__file__).parent / "test_file.pdf")
+	merger = pdf.PdfMerger(workers=1, max_pending=2)
+
+	merged = asyncio.run(merger.merge([path, path], str(tmp_path)))
+	assert len(pypdf.PdfReader(merged).pages) == 2 * len(pypdf.PdfReader(path).pages)
+
+	# The workers are stopped on shutdown and spawned again by the next merge
+
+	assert merger.executor is not None
+	processes = list(merger.executor._processes.values())
+	merger.shutdown()
+	assert processes and all(not process.is_alive() for process in processes)
+	asyncio.run(merger.merge([path], str(tmp_path)))
+	merger.shutdown()
+
+def test_barocert_poller() -> None:
+	class FakeService:
+		def __init__(self, states: list[int], expireIn: float):
+			self.states = states
+			self.expireIn = expireIn
+			self.polls = 0
+
+		def getStatus(self, receipt_id: str) -> Any:
+			self.polls += 1
+			if not self.states: raise RuntimeError("failed to get the status")
+			if (state := self.states.pop(0)) < 0: raise utils.BarocertUnavailable("busy")
+			return types.SimpleNamespace(receiptID=receipt_id, state=state)
+
+	poller = utils.BarocertPoller(min_interval=0.01, max_interval=0.02, max_threads=2)
+
+	async def wait_all(services: list[Any]) -> list[Any]:
+		waits = [poller.wait(service, str(i)) for i, service in enumerate(services)]
+		return await asyncio.gather(*waits, return_exceptions=True)
+
+	# Receipts are polled until they leave the standby or expire, all in one loop
+
+	services: list[Any] = [
+		FakeService([0, 0, 1], 10), FakeService([3], 10), FakeService([0] * 1000, 0.1), FakeService([], 10),
+		FakeService([-1, 1], 10), # the vender is busy at first
+	]
+	results = asyncio.run(wait_all(services))
+	assert [result.state for result in results[:3]] == [1, 3, 0]
+	assert isinstance(results[3], RuntimeError)
+	assert results[4].state == 1
+	assert [service.polls for service in services[:2]] == [3, 1]
+	assert 2 < services[2].polls < 20
+	assert services[4].polls == 2
+
+	# The poller restarts on a new event loop
+	assert asyncio.run(wait_all([FakeService([1], 10)]))[0].state == 1
+
+def test_barocert_client_pool(monkeypatch: pytest.MonkeyPatch) -> None:
+	# Fails once the SDK changes the internals the pool relies on, see requirements.txt
+
+	assert barocert.KakaocertService("linkid", "c2VjcmV0a2V5") is barocert.KakaocertService("a", "b")
+	pool = utils.BarocertClientPool(barocert.KakaocertService, "linkid", "c2VjcmV0a2V5", size=2)
+
+	# Each thread checks out a client of its own, which is reused once returned
+
+	with pool.client() as client1, pool.client() as client2:
+		assert client1 is not client2
+		assert barocert.KakaocertService("linkid", "c2VjcmV0a2V5") not in [client1, client2]
+	with pool.client() as client3:
+		assert client3 in [client1, client2]
+	assert pool.created == 2
+
+	# Each client keeps its connection and its auth token until they expire
+
+	assert client1._getConn() is client1._getConn()
+	assert client1._getConn() is not client2._getConn()
+
+	def generate_token(*args: Any) -> Any:
+		generated.append(args)
+		expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
+		return types.SimpleNamespace(
+			session_token="token", expiration=expiration.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+		)
+
+	def get_time(*args: Any) -> str:
+		return datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+	generated: list[Any] = []
+	monkeypatch.setattr(barocert.base.linkhub, "generateToken", generate_token)
+	monkeypatch.setattr(barocert.base.linkhub, "getTime", get_time)
+
+	assert client1._getToken() is client1._getToken()
+	assert client2._getToken() is not client1._getToken()
+	assert len(generated) == 2
+
+def test_barocert_breaker(monkeypatch: pytest.MonkeyPatch) -> None:
+	breaker = utils.BarocertBreaker(max_concurrency=4, failure_threshold=3, reset_timeout=0.05, slow_call=1)
+
+	# Requests are admitted up to the limit, which shrinks while the calls are slow
+
+	assert [breaker.admit() for _ in range(5)] == ["admitted"] * 4 + ["busy"]
+	for _ in range(4): breaker.release("admitted")
+	breaker.latency = 2
+	assert [breaker.admit() for _ in range(3)] == ["admitted"] * 2 + ["busy"]
+	for _ in range(2): breaker.release("admitted")
+	breaker.latency = 0
+
+	# Failed or slow calls in a row open the circuit, which fails fast until a probe passes
+
+	breaker.record(0.1, failed=True)
+	breaker.record(0.1, failed=False)
+	breaker.record(0.1, failed=True)
+	breaker.record(0.1, failed=True)
+	assert breaker.admit() == "admitted" # still running once the circuit is half open
+	breaker.record(5, failed=False)
+	assert breaker.state == "open"
+	assert breaker.admit() == "open"
+
+	time.sleep(0.05)
+	assert breaker.admit() == "probe"
+	breaker.release("admitted")
+	assert breaker.admit() == "open" # one probe at once
+	breaker.record(0.1, failed=True)
+	breaker.release("probe")
+	assert breaker.admit() == "open"
+
+	time.sleep(0.05)
+	assert breaker.admit() == "probe"
+	breaker.record(0.1, failed=False)
+	breaker.release("probe")
+	assert [breaker.admit() for _ in range(2)] == ["admitted"] * 2
+
+	# Each call to the vender holds an admission only while it runs
+
+	breaker = utils.BarocertBreaker(max_concurrency=1)
+	service = utils.BarocertService("kakao", "Sign", "code", "linkid", "c2VjcmV0a2V5", "", 300, breaker)
+	in_flight: list[int] = []
+
+	class FakeClient:
+		def getSignStatus(self, client_code: str, receipt_id: str) -> Any:
+			in_flight.append(breaker.in_flight)
+			return types.SimpleNamespace(receiptID=receipt_id, state=0)
+
+	@contextlib.contextmanager
+	def client() -> Iterator[Any]:
+		yield FakeClient()
+
+	monkeypatch.setattr(service.clients, "client", client)
+	assert service.getStatus("receipt").state == 0
+	assert in_flight == [1] and breaker.in_flight == 0
+
+	assert breaker.admit() == "admitted"
+	with pytest.raises(utils.BarocertUnavailable):
+		service.getStatus("receipt")
+	assert in_flight == [1]
@@ -1,7 +1,7 @@
-from typing import Any, Literal, Optional
+from typing import Any, Iterator, Literal, Optional
 from types import SimpleNamespace
 from collections import namedtuple
-import base64, datetime, itsdangerous, json, requests, smtplib, ssl, structlog, time
+import asyncio, base64, contextlib, itsdangerous, json, queue, requests, smtplib, ssl, structlog, threading, time
 
 #from asn1crypto import cms
 #from oscrypto import asymmetric
@@ -11,8 +11,10 @@ from barocert import BarocertException
 
 import sqlalchemy as sa
 from sqlalchemy import orm
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from fastapi import HTTPException
+from fastapi import HTTPException, Response
+from fastapi.responses import StreamingResponse
 
 from starlette.config import Config
 from starlette.requests import Request
@@ -51,6 +53,74 @@ class TokenSigner:
 			logger.warning("Failed to unsign token", token=token)
 			return None
 
+################################################################################
+# Document download
+################################################################################
+
+DOCUMENT_MEDIA_TYPES = {
+	model.DocumentType.PDF: "application/pdf",
+	model.DocumentType.JSON: "application/json",
+}
+
+def parse_range(header: str, size: int) -> Optional[tuple[int, int]]:
+	"""[start, stop) of a single byte range, None if the header should be ignored"""
+	unit, _, byte_range = header.partition("=")
+	first, dash, last = byte_range.strip().partition("-")
+	if unit.strip().lower() != "bytes" or not dash: return None
+	if (first and not first.isdigit()) or (last and not last.isdigit()): return None
+
+	if first:
+		start = int(first)
+		stop = min(int(last) + 1, size) if last else size
+		if last and int(last) < start: return None
+	elif last:
+		start, stop = max(size - int(last), 0), size
+		if int(last) == 0: start = size
+	else:
+		return None
+
+	if start >= size:
+		raise HTTPException(416, headers={"Content-Range": f"bytes */{size}"})
+	return start, stop
+
+async def document_response(
+	request: Request,
+	session: AsyncSession,
+	document: model.Document,
+	filename: Optional[str] = None,
+) -> Response:
+	"""Streams the document in chunks with ETag, HEAD and single Range support"""
+	etag = f'"{document.sha256.hex()}"'
+	headers = {"ETag": etag, "Accept-Ranges": "bytes"}
+	if filename: headers["Content-Disposition"] = f'filename="{filename}"'
+
+	if if_none_match := request.headers.get("if-none-match"):
+		tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+		if etag in tags or "*" in tags:
+			return Response(status_code=304, headers=headers)
+
+	size, inline = await document.aget_size(session)
+	start, stop, status_code = 0, size, 200
+
+	# A range of another version of the document is answered with the whole document
+	range_header = request.headers.get("range")
+	if range_header and request.headers.get("if-range", etag) == etag:
+		if byte_range := parse_range(range_header, size):
+			start, stop = byte_range
+			status_code = 206
+			headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+
+	headers["Content-Length"] = str(stop - start)
+	media_type = DOCUMENT_MEDIA_TYPES[document.doc_type]
+
+	if request.method == "HEAD":
+		return Response(status_code=status_code, headers=headers, media_type=media_type)
+	if inline:
+		# The session is gone once the response streams, so the range is read beforehand
+		content = await document.aread_inline(session, start, stop)
+		return Response(content, status_code, headers, media_type)
+	return StreamingResponse(document.iter_content(start, stop), status_code, headers, media_type)
+
 ################################################################################
 # Email
 ################################################################################
@@ -151,6 +221,132 @@ CertResult = namedtuple("CertResult", ["receiptID", "state", "signedData", "ci"]
 
 # Pure barocert wrapper, does not depend on our code
 # TODO: Add signature verification
+class BarocertClientPool:
+	"""Clients of a barocert service shared by the threads of a process
+
+	The SDK services are singletons whose one HTTP connection is not safe to share between
+	threads, so each thread checks out a client of its own, which keeps its connection and
+	its auth token between the requests. The SDK version is pinned in requirements.txt,
+	see test_barocert_client_pool.
+	"""
+
+	def __init__(self, service_class: type, linkid: str, secretkey: str, size: int = 8):
+		self.service_class = service_class
+		self.linkid = linkid
+		self.secretkey = secretkey
+		self.size = size
+		self.created = 0
+		self.idle: queue.LifoQueue[Any] = queue.LifoQueue() # the last used has the warmest connection
+		self.lock = threading.Lock()
+
+	def create(self) -> Any:
+		# The constructor of the service class returns its singleton, so it is run on a new instance
+		client: Any = object.__new__(self.service_class)
+		client.__init__(self.linkid, self.secretkey)
+		return client
+
+	@contextlib.contextmanager
+	def client(self) -> Iterator[Any]:
+		"""Check out an idle client, waiting for one if all the size clients are in use"""
+		with self.lock:
+			create = self.idle.empty() and self.created < self.size
+			if create: self.created += 1
+
+		if not create:
+			client = self.idle.get()
+		else:
+			try:
+				client = self.create()
+			except:
+				with self.lock: self.created -= 1
+				raise
+
+		try:
+			yield client
+		finally:
+			self.idle.put(client)
+
+class BarocertUnavailable(Exception):
+	"""A call which the breaker of the vender has not admitted, as it is busy or open"""
+
+	def __init__(self, admission: Literal["busy", "open"]):
+		super().__init__(f"Vender is {admission}")
+		self.admission = admission
+
+class BarocertBreaker:
+	"""Admission of the calls to a vender, failing fast while the vender is down
+
+	At most max_concurrency calls are admitted at once, and fewer while the calls take
+	longer than slow_call on average. After failure_threshold failed or slow calls in a row
+	the circuit opens and rejects every call for reset_timeout seconds, then admits one
+	call to probe whether the vender has recovered.
+	"""
+
+	def __init__(
+		self, max_concurrency: int = 8, failure_threshold: int = 5,
+		reset_timeout: float = 30, slow_call: float = 5, smoothing: float = 0.2,
+	):
+		self.max_concurrency = max_concurrency
+		self.failure_threshold = failure_threshold
+		self.reset_timeout = reset_timeout
+		self.slow_call = slow_call
+		self.smoothing = smoothing
+
+		self.lock = threading.Lock() # the calls are recorded on threads
+		self.state: Literal["closed", "open", "half_open"] = "closed"
+		self.failures = 0
+		self.opened = 0.0
+		self.probing = False
+		self.in_flight = 0
+		self.latency = 0.0 # moving average of the calls
+
+	def limit(self) -> int:
+		if self.latency <= self.slow_call: return self.max_concurrency
+		return max(1, int(self.max_concurrency * self.slow_call / self.latency))
+
+	def admit(self) -> Literal["admitted", "probe", "busy", "open"]:
+		"""Admit a call unless the vender is busy or down, then release it with the admission
+
+		While the circuit is half open only the call admitted as the probe is let in.
+		"""
+		with self.lock:
+			if self.state == "open":
+				if time.monotonic() - self.opened < self.reset_timeout: return "open"
+				self.state = "half_open"
+
+			admission: Literal["admitted", "probe"] = "admitted"
+			if self.state == "half_open":
+				if self.probing: return "open"
+				self.probing, admission = True, "probe"
+			elif self.in_flight >= self.limit():
+				return "busy"
+
+			self.in_flight += 1
+			return admission
+
+	def release(self, admission: Literal["admitted", "probe"]) -> None:
+		with self.lock:
+			self.in_flight -= 1
+			# A probe without any record lets the next call probe, the others finishing don't
+			if admission == "probe": self.probing = False
+
+	def record(self, latency: float, failed: bool) -> None:
+		with self.lock:
+			self.latency += self.smoothing * (latency - self.latency)
+
+			if failed or latency > self.slow_call:
+				self.failures += 1
+				if self.state == "half_open" or (
+					self.state == "closed" and self.failures >= self.failure_threshold
+				):
+					logger.warning("Barocert circuit has opened", failures=self.failures, latency=latency)
+					self.state, self.opened, self.probing = "open", time.monotonic(), False
+			else:
+				self.failures = 0
+				if self.state == "half_open":
+					logger.info("Barocert circuit has closed")
+					self.state, self.probing = "closed", False
+
 class BarocertService:
 	def __init__(
 		self,
@@ -158,22 +354,26 @@ class BarocertService:
 		certPurpose: Literal["CMS", "Identity", "Sign"],
 		clientCode: str, linkid: str, secretkey: str,
 		callCenterNum: str,
-		expireIn: int
+		expireIn: int,
+		breaker: Optional[BarocertBreaker] = None,
 	):
 		self.vender = vender
 		self.clientCode = clientCode
 		self.certPurpose = certPurpose
 		self.callCenterNum = callCenterNum
 		self.expireIn = expireIn 
+		self.breaker = BarocertBreaker() if breaker is None else breaker
 
 		if self.vender == "kakao":
-			self.service = barocert.KakaocertService(linkid, secretkey)
+			service_class = barocert.KakaocertService
 		elif self.vender == "naver":
-			self.service = barocert.NavercertService(linkid, secretkey)
+			service_class = barocert.NavercertService
 		elif self.vender == "pass":
-			self.service = barocert.PasscertService(linkid, secretkey)
+			service_class = barocert.PasscertService
 		else:
 			raise NotImplementedError()
+
+		self.clients = BarocertClientPool(service_class, linkid, secretkey)
 	
 	def encrypt(self, **kwargs: Any) -> dict[str, Any]:
 		encrypted_arguments = [
@@ -185,9 +385,10 @@ class BarocertService:
 			"extraMessage",
 		]
 
-		for key, arg in kwargs.items():
-			if key in encrypted_arguments:
-				kwargs[key] = self.service._encrypt(arg)
+		with self.clients.client() as service:
+			for key, arg in kwargs.items():
+				if key in encrypted_arguments:
+					kwargs[key] = service._encrypt(arg)
 
 		return kwargs
 
@@ -197,36 +398,42 @@ class BarocertService:
 			kwargs["callCenterNum"] = self.callCenterNum
 
 		kwargs = self.encrypt(**kwargs)
-		method = getattr(self.service, f"request{self.certPurpose}")
-		return method(self.clientCode, SimpleNamespace(**kwargs))
+		return self.call(f"request{self.certPurpose}", self.clientCode, SimpleNamespace(**kwargs))
 	
 	def getStatus(self, receipt_id: str) -> Any:
-		method = getattr(self.service, f"get{self.certPurpose}Status")
-		return method(self.clientCode, receipt_id)
+		return self.call(f"get{self.certPurpose}Status", self.clientCode, receipt_id)
 
 	def verify(self, receipt_id: str, **kwargs: Any) -> Any:
-		method = getattr(self.service, f'verify{self.certPurpose}')
 		if self.vender == "pass":
 			kwargs = self.encrypt(**kwargs)
-			return method(self.clientCode, receipt_id, SimpleNamespace(**kwargs))
+			return self.call(f'verify{self.certPurpose}', self.clientCode, receipt_id, SimpleNamespace(**kwargs))
 		else:
-			return method(self.clientCode, receipt_id)
-
-	def try_request(self, **kwargs: Any) -> CertResult:
-		# Request stage
-
-		response = self.request(**kwargs)
-		receipt_id = response.receiptID
+			return self.call(f'verify{self.certPurpose}', self.clientCode, receipt_id)
 
-		# Status check stage
+	def call(self, name: str, *args: Any) -> Any:
+		"""Call the method of a client admitted by the breaker, recording its latency and failure
 
-		status = self.getStatus(receipt_id)
-		expire = datetime.datetime.now() + datetime.timedelta(seconds=self.expireIn)
-
-		while status.state == 0 and datetime.datetime.now() < expire:
-			status = self.getStatus(receipt_id)
-			time.sleep(1)
+		Only the call holds the admission, not the wait for the receiver between the calls.
+		Any error counts as a failure, a vender being down surfaces as barocert errors
+		as well as connection errors.
+		"""
+		admission = self.breaker.admit()
+		if admission == "busy" or admission == "open": raise BarocertUnavailable(admission)
 
+		try:
+			with self.clients.client() as service:
+				start = time.monotonic()
+				try:
+					ret = getattr(service, name)(*args)
+				except:
+					self.breaker.record(time.monotonic() - start, failed=True)
+					raise
+				self.breaker.record(time.monotonic() - start, failed=False)
+				return ret
+		finally:
+			self.breaker.release(admission)
+
+	def result(self, receipt_id: str, status: Any, **kwargs: Any) -> CertResult:
 		# Verification stage
 		# 0: standby
 		# 1: completed
@@ -255,3 +462,84 @@ class BarocertService:
 			signedData=signed_data,
 			ci=ci
 		)
+
+class PendingReceipt:
+	def __init__(self, service: BarocertService, receipt_id: str, expire: float, interval: float):
+		self.service = service
+		self.receipt_id = receipt_id
+		self.expire = expire
+		self.interval = interval
+		self.due = 0.0 # the first status is requested right away
+		self.future: asyncio.Future[Any] = asyncio.get_running_loop().create_future()
+
+class BarocertPoller:
+	"""Waits for the pending sign requests in one asyncio loop instead of a thread each
+
+	The receivers take from seconds to minutes to sign, so each receipt is polled less
+	often the longer it stays on standby. Only the status requests run on threads, at most
+	max_threads at once, and no thread is held while waiting on the receivers.
+	"""
+
+	def __init__(
+		self, min_interval: float = 1, max_interval: float = 5,
+		backoff: float = 1.5, max_threads: int = 4,
+	):
+		self.min_interval = min_interval
+		self.max_interval = max_interval
+		self.backoff = backoff
+		self.max_threads = max_threads
+		self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+	def start(self) -> None:
+		# Started by the first wait of each event loop, the test clients run one loop per request
+		self.loop = asyncio.get_running_loop()
+		self.pending: list[PendingReceipt] = []
+		self.wakeup = asyncio.Event()
+		self.threads = asyncio.Semaphore(self.max_threads)
+		self.task = self.loop.create_task(self.run())
+
+	async def wait(self, service: BarocertService, receipt_id: str) -> Any:
+		"""The last status of the receipt, which is on standby only if the request has expired"""
+		if self.loop is not asyncio.get_running_loop() or self.task.done(): self.start()
+
+		expire = time.monotonic() + service.expireIn
+		receipt = PendingReceipt(service, receipt_id, expire, self.min_interval)
+		self.pending.append(receipt)
+		self.wakeup.set()
+		return await receipt.future
+
+	async def run(self) -> None:
+		while True:
+			now = time.monotonic()
+			due = [receipt for receipt in self.pending if receipt.due <= now]
+			if due: await asyncio.gather(*[self.poll(receipt) for receipt in due])
+			self.pending = [receipt for receipt in self.pending if not receipt.future.done()]
+
+			# Sleep until the next receipt is due or a new one arrives
+			self.wakeup.clear()
+			timeout = min((receipt.due for receipt in self.pending), default=now + 60) - time.monotonic()
+			try:
+				await asyncio.wait_for(self.wakeup.wait(), max(timeout, 0))
+			except asyncio.TimeoutError:
+				pass
+
+	async def poll(self, receipt: PendingReceipt) -> None:
+		if receipt.future.done(): return # the waiter has been cancelled
+		try:
+			async with self.threads:
+				status = await asyncio.to_thread(receipt.service.getStatus, receipt.receipt_id)
+		except BarocertUnavailable:
+			# Polled again later, the vender reports the receipt as expired once it is up
+			receipt.due = time.monotonic() + receipt.interval
+			return
+		except Exception as e:
+			if not receipt.future.done(): receipt.future.set_exception(e)
+			return
+
+		if receipt.future.done(): return
+		if status.state != 0 or time.monotonic() >= receipt.expire:
+			receipt.future.set_result(status)
+			return
+
+		receipt.due = time.monotonic() + receipt.interval
+		receipt.interval = min(receipt.interval * self.backoff, self.max_interval)
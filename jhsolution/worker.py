@@ -0,0 +1,21 @@
+"""Job worker running apart from the web processes
+
+	python -m jhsolution.worker [--concurrency 16] [--poll-interval 1]
+
+Any number of workers can run on any node with the web processes, each job is run by
+one of them. Set JOB_CONCURRENCY=0 to leave the jobs to these workers only.
+"""
+import argparse, asyncio
+
+from jhsolution.router import background
+
+def main() -> None:
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--concurrency", type=int, default=16)
+	parser.add_argument("--poll-interval", type=float, default=1)
+	args = parser.parse_args()
+
+	asyncio.run(background.run_jobs(args.concurrency, args.poll_interval))
+
+if __name__ == "__main__":
+	main()